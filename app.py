@@ -15,21 +15,57 @@
 import signal
 import sys
 import traceback
-from datetime import date
+from time import perf_counter
 from types import FrameType
+from typing import Dict, List
 
-from flask import Flask, jsonify, make_response, request
+from flask import Flask, g, jsonify, make_response, request, url_for
 from google.api_core.exceptions import BadRequest
 from google.cloud.exceptions import NotFound
 
-from utils.bigquery import bq_export, bq_header, get_bigquery_client
-from utils.compose import compose_file, list_file, get_gcs_client
+from utils import checkpoint, metrics, startup, tracing
+from utils.admission import Overloaded, Ticket, admission, cached_table_bytes, table_bytes
+from utils.batch import batch_configs, export_batch
+from utils.checkpoint import Terminated
+from utils.clients import registry
+from utils.coalesce import export_once
+from utils.export import ExportConfig, Progress, STAGES
+from utils.jobs import jobs
 from utils.logging import logger
 
 app = Flask(__name__)
 app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
 
 
+@app.before_request
+def start_timer() -> None:
+    g.start = perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.span, g.trace_token = tracing.start_trace("{} {}".format(request.method, route),
+                                                request.headers.get("X-Cloud-Trace-Context"))
+
+
+@app.after_request
+def record_request(response):
+    # the rule, not the path, keeps one series per route
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    if "start" in g:
+        metrics.REQUEST_SECONDS.labels(route=route, method=request.method, status=str(response.status_code)) \
+            .observe(perf_counter() - g.start)
+        g.span.set_attribute("http.status_code", response.status_code)
+    startup.profile.first_response()
+    return response
+
+
+@app.teardown_request
+def end_request(err) -> None:
+    # request contexts pushed outside of a request are torn down too
+    if "start" in g:
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        tracing.end_trace(g.span, g.trace_token)
+
+
 @app.errorhandler(NotFound)
 def handle_exception(err):
     """Handler missing file for composing"""
@@ -66,6 +102,22 @@ def handle_exception(err):
     return jsonify(response), 400
 
 
+@app.errorhandler(Overloaded)
+def handle_exception(err):
+    """Handler export rejected over capacity, retried by the client on this or another instance"""
+    logger.warning(f"Overloaded: {str(err)}")
+    response = {"status": 429, "error": str(err)}
+    return jsonify(response), 429, {"Retry-After": str(err.retry_after)}
+
+
+@app.errorhandler(Terminated)
+def handle_exception(err):
+    """Handler export interrupted by the shutdown of the instance, a retry resumes it"""
+    logger.warning(f"Terminated: {str(err)}")
+    response = {"error": "The instance is shutting down, retry to resume the export"}
+    return jsonify(response), 503
+
+
 @app.errorhandler(400)
 @app.route("/export/<dataset_id>/<table_id>", methods=["POST"])
 def export(dataset_id: str, table_id: str) -> str:
@@ -82,42 +134,116 @@ def export(dataset_id: str, table_id: str) -> str:
         return make_response(jsonify(response), 400)
 
     logger.info("Starting export bq:{}/{}".format(dataset_id, table_id))
-
-    # config
-    project: str = request.json.get("project", "cel-em-prj-dpf-shr-01-dev")
-    bucket: str = request.json.get("bucket", "cel-em-gcs-dpf-shr-01-dev")
-    location: str = request.json.get("location", "europe-west1")
-    folder: str = request.json.get("output", dataset_id)
-    file_name: str = request.json.get("file_name", "export-{}-{}".format(table_id, date.today().isoformat()))
-    with_header: bool = request.json.get("with_header", False)
-    temp_file_prefix: str = f'{folder}/tmp/{table_id}/partition'
-    temp_destination_uri: str = f'gs://{bucket}/{folder}/tmp/{table_id}/partition*.csv'
-    file_path: str = f'{folder}/{file_name}.csv'
-    file_uri: str = "gs://{}/{}".format(bucket, file_path)
-
     logger.info("Payload : {}".format(request.json))
-    logger.info("Filename : {}.csv".format(file_name))
-    logger.info("With Header : {}".format(with_header))
-    # Get Cloud Clients
-    storage_client = get_gcs_client()
-    bigquery_client = get_bigquery_client()
 
-    bq_export(project, dataset_id, table_id, location, temp_destination_uri, bigquery_client)
-    blobs = list_file(bucket, temp_file_prefix, storage_client)
-    header = bq_header(project, dataset_id, table_id, bigquery_client)
-
-    final_result = compose_file(file_uri, blobs, storage_client, header)
+    config = ExportConfig.from_payload(dataset_id, table_id, request.json)
+
+    # Borrow the shared Cloud Clients of the worker
+    storage_client = registry.gcs_client()
+    bigquery_client = registry.bigquery_client()
+    # a background job holds no request thread
+    ticket = admission.admit_export(config, table_bytes(config, bigquery_client),
+                                    threaded=not request.json.get("async", False))
+
+    if request.json.get("async", False):
+        try:
+            job = jobs.submit(lambda job: _run_export(config, storage_client, bigquery_client, ticket,
+                                                      job.progress), STAGES)
+        except Exception:
+            # the export never runs
+            admission.release(ticket)
+            raise
+        response = {
+            "status": 202,
+            "job_id": job.id,
+            "location": url_for("get_job", job_id=job.id),
+        }
+        return jsonify(response), 202, {"Location": response["location"]}
 
-    logger.info("final result : {}".format(final_result.path))
+    result = _run_export(config, storage_client, bigquery_client, ticket)
 
     response = {
         "status": 200,
-        "path": file_uri,
+        "path": result["path"],
+        "cached": result.get("cached", False),
     }
+    if "plan" in result:
+        # only the extracts are planned, not the cached or incremental exports
+        response["plan"] = result["plan"]
 
     return jsonify(response)
 
 
+def _run_export(config: ExportConfig, storage_client, bigquery_client, ticket: Ticket,
+                progress: Progress = None) -> Dict:
+    # the admission is released once the export is done
+    with ticket:
+        return export_once(config, storage_client, bigquery_client, progress)
+
+
+@app.route("/export/batch", methods=["POST"])
+def export_batch_route() -> str:
+    if not request.is_json:
+        response = {
+            "status": 400,
+            "error": "Content-Type must be application/json",
+        }
+        return make_response(jsonify(response), 400)
+
+    logger.info("Payload : {}".format(request.json))
+
+    storage_client = registry.gcs_client()
+    bigquery_client = registry.bigquery_client()
+    configs = batch_configs(request.json, bigquery_client)
+    ticket = admission.admit_batch(configs, [cached_table_bytes(config) for config in configs],
+                                   threaded=not request.json.get("async", False))
+    logger.info("Starting batch export of {} tables".format(len(configs)))
+
+    if request.json.get("async", False):
+        tables = ["{}.{}".format(config.dataset_id, config.table_id) for config in configs]
+        try:
+            job = jobs.submit(lambda job: _run_batch(configs, storage_client, bigquery_client, ticket,
+                                                     job.progress), tables)
+        except Exception:
+            # the batch never runs
+            admission.release(ticket)
+            raise
+        response = {
+            "status": 202,
+            "job_id": job.id,
+            "location": url_for("get_job", job_id=job.id),
+        }
+        return jsonify(response), 202, {"Location": response["location"]}
+
+    result = _run_batch(configs, storage_client, bigquery_client, ticket)
+    response = dict(status=200, **result)
+    return jsonify(response)
+
+
+def _run_batch(configs: List[ExportConfig], storage_client, bigquery_client, ticket: Ticket,
+               progress: Progress = None) -> Dict:
+    # the admission is released once every table is exported
+    with ticket:
+        return export_batch(configs, storage_client, bigquery_client, progress)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id: str) -> str:
+    job = jobs.get(job_id)
+    if job is None:
+        response = {
+            "status": 404,
+            "error": "job {} not found".format(job_id),
+        }
+        return make_response(jsonify(response), 404)
+    return jsonify(job.to_dict())
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return metrics.exposition(), 200, {"Content-Type": metrics.CONTENT_TYPE_LATEST}
+
+
 @app.route("/")
 def hello() -> str:
     # Use basic logging with custom fields
@@ -134,6 +260,10 @@ def shutdown_handler(signal_int: int, frame: FrameType) -> None:
 
     from utils.logging import flush
 
+    # the running exports save their progress for the retries
+    checkpoint.terminate()
+
+    tracing.flush()
     flush()
 
     # Safely exit program
@@ -0,0 +1,302 @@
+# Copyright 2021 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The routes of ``app.py`` served by an ASGI server, see the asgi command of the Procfile.
+
+The extract exports run on the event loop with ``utils.aio_export``, so an
+export waiting on BigQuery or GCS holds no thread. The incremental and
+Storage Read API exports, and the batches, run in threads on the shared
+clients of ``utils.clients``.
+"""
+import asyncio
+import traceback
+from time import perf_counter
+from typing import Dict, List, Optional
+
+from google.api_core.exceptions import BadRequest
+from google.cloud.exceptions import NotFound
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Match, Route
+
+from utils import aio_export, checkpoint, metrics, startup, tracing
+from utils.admission import Overloaded, Ticket, admission, cached_table_bytes
+from utils.aio import AsyncClient
+from utils.batch import batch_configs, export_batch
+from utils.checkpoint import Terminated
+from utils.clients import registry
+from utils.coalesce import export_once
+from utils.export import ExportConfig, Progress, STAGES
+from utils.jobs import jobs
+from utils.logging import logger
+from utils.table_cache import table_cache
+
+# Shared by the exports of the worker
+client = AsyncClient()
+
+
+def _is_json(request: Request) -> bool:
+    mimetype = request.headers.get("content-type", "").split(";")[0].strip()
+    return mimetype == "application/json" or (mimetype.startswith("application/") and mimetype.endswith("+json"))
+
+
+def _not_json() -> JSONResponse:
+    response = {
+        "status": 400,
+        "error": "Content-Type must be application/json",
+    }
+    return JSONResponse(response, 400)
+
+
+def _accepted(request: Request, job_id: str) -> JSONResponse:
+    response = {
+        "status": 202,
+        "job_id": job_id,
+        "location": request.app.url_path_for("get_job", job_id=job_id),
+    }
+    return JSONResponse(response, 202, {"Location": response["location"]})
+
+
+async def _table_bytes(config: ExportConfig) -> Optional[int]:
+    """
+    :return: the size of the exported table, None for a query, see ``utils.admission.table_bytes``
+    """
+    if config.query:
+        return None
+    table = await table_cache.aget(client, config.project, config.dataset_id, config.table_id)
+    return table.num_bytes
+
+
+async def export(request: Request) -> Response:
+    if not _is_json(request):
+        return _not_json()
+    dataset_id, table_id = request.path_params["dataset_id"], request.path_params["table_id"]
+    payload = await request.json()
+
+    logger.info("Starting export bq:{}/{}".format(dataset_id, table_id))
+    logger.info("Payload : {}".format(payload))
+
+    config = ExportConfig.from_payload(dataset_id, table_id, payload)
+    # the requests wait on the event loop, not on a thread
+    ticket = admission.admit_export(config, await _table_bytes(config), threaded=False)
+
+    if payload.get("async", False):
+        try:
+            if aio_export.is_native(config):
+                job = jobs.submit_async(lambda job: _run_native_export(config, ticket, job.progress), STAGES)
+            else:
+                job = jobs.submit(lambda job: _run_export(config, ticket, job.progress), STAGES)
+        except Exception:
+            # the export never runs
+            admission.release(ticket)
+            raise
+        return _accepted(request, job.id)
+
+    if aio_export.is_native(config):
+        result = await _run_native_export(config, ticket)
+    else:
+        result = await asyncio.to_thread(_run_export, config, ticket)
+
+    response = {
+        "status": 200,
+        "path": result["path"],
+        "cached": result.get("cached", False),
+    }
+    if "plan" in result:
+        # only the extracts are planned, not the cached or incremental exports
+        response["plan"] = result["plan"]
+
+    return JSONResponse(response)
+
+
+async def _run_native_export(config: ExportConfig, ticket: Ticket, progress: Progress = None) -> Dict:
+    # the admission is released once the export is done
+    with ticket:
+        return await aio_export.export_once(config, client, progress)
+
+
+def _run_export(config: ExportConfig, ticket: Ticket, progress: Progress = None) -> Dict:
+    # Borrow the shared Cloud Clients of the worker
+    storage_client = registry.gcs_client()
+    bigquery_client = registry.bigquery_client()
+
+    with ticket:
+        return export_once(config, storage_client, bigquery_client, progress)
+
+
+async def export_batch_route(request: Request) -> Response:
+    if not _is_json(request):
+        return _not_json()
+    payload = await request.json()
+
+    logger.info("Payload : {}".format(payload))
+
+    storage_client = registry.gcs_client()
+    bigquery_client = registry.bigquery_client()
+    configs = await asyncio.to_thread(batch_configs, payload, bigquery_client)
+    ticket = admission.admit_batch(configs, [cached_table_bytes(config) for config in configs], threaded=False)
+    logger.info("Starting batch export of {} tables".format(len(configs)))
+
+    if payload.get("async", False):
+        tables = ["{}.{}".format(config.dataset_id, config.table_id) for config in configs]
+        try:
+            job = jobs.submit(lambda job: _run_batch(configs, storage_client, bigquery_client, ticket,
+                                                     job.progress), tables)
+        except Exception:
+            # the batch never runs
+            admission.release(ticket)
+            raise
+        return _accepted(request, job.id)
+
+    result = await asyncio.to_thread(_run_batch, configs, storage_client, bigquery_client, ticket)
+    response = dict(status=200, **result)
+    return JSONResponse(response)
+
+
+def _run_batch(configs: List[ExportConfig], storage_client, bigquery_client, ticket: Ticket,
+               progress: Progress = None) -> Dict:
+    # the admission is released once every table is exported
+    with ticket:
+        return export_batch(configs, storage_client, bigquery_client, progress)
+
+
+async def get_job(request: Request) -> Response:
+    job_id = request.path_params["job_id"]
+    # a job of another instance is read from its status object
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        response = {
+            "status": 404,
+            "error": "job {} not found".format(job_id),
+        }
+        return JSONResponse(response, 404)
+    return JSONResponse(job.to_dict())
+
+
+async def get_metrics(request: Request) -> Response:
+    return Response(metrics.exposition(), 200, media_type=metrics.CONTENT_TYPE_LATEST)
+
+
+async def hello(request: Request) -> Response:
+    logger.info("Child logger with trace Id.")
+    return PlainTextResponse("Hello, World!")
+
+
+def _log(err: Exception, kind: str) -> None:
+    logger.error(f"{kind}: {str(err)}")
+    logger.debug(''.join(traceback.format_exception(type(err), value=err, tb=err.__traceback__)))
+
+
+async def handle_not_found(request: Request, err: Exception) -> Response:
+    _log(err, "NotFound")
+    return JSONResponse({"error": "URI,Location, or Project is wrong"}, 404)
+
+
+async def handle_value_error(request: Request, err: Exception) -> Response:
+    _log(err, "ValueError")
+    return JSONResponse({"error": "file uri not found"}, 400)
+
+
+async def handle_bad_request(request: Request, err: Exception) -> Response:
+    _log(err, "BadRequest")
+    return JSONResponse({"error": str(err)}, 400)
+
+
+async def handle_overloaded(request: Request, err: Exception) -> Response:
+    logger.warning(f"Overloaded: {str(err)}")
+    return JSONResponse({"status": 429, "error": str(err)}, 429, {"Retry-After": str(err.retry_after)})
+
+
+async def handle_terminated(request: Request, err: Exception) -> Response:
+    logger.warning(f"Terminated: {str(err)}")
+    return JSONResponse({"error": "The instance is shutting down, retry to resume the export"}, 503)
+
+
+async def handle_exception(request: Request, err: Exception) -> Response:
+    _log(err, "Unknown Exception")
+    return JSONResponse({"error": "Sorry, internal error, please check logs"}, 500)
+
+
+class RequestMetrics:
+    """Times the requests and traces them as ``app.py`` does, labelled by the route in the Flask notation
+    so both apps report the same series"""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = routes
+
+    def _route(self, scope) -> str:
+        for route in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path.replace("{", "<").replace("}", ">")
+        return "unmatched"
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = self._route(scope)
+        status = {"code": 500}
+
+        async def send_status(message) -> None:
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+            await send(message)
+
+        headers = dict((key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"])
+        metrics.REQUESTS_IN_FLIGHT.inc()
+        span, token = tracing.start_trace("{} {}".format(scope["method"], route if route != "unmatched"
+                                                         else scope["path"]),
+                                          headers.get("x-cloud-trace-context"))
+        start = perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            metrics.REQUEST_SECONDS.labels(route=route, method=scope["method"], status=str(status["code"])) \
+                .observe(perf_counter() - start)
+            span.set_attribute("http.status_code", status["code"])
+            metrics.REQUESTS_IN_FLIGHT.dec()
+            tracing.end_trace(span, token)
+            startup.profile.first_response()
+
+
+async def shutdown() -> None:
+    from utils.logging import flush
+
+    # the exports running in threads save their progress for the retries
+    await asyncio.to_thread(checkpoint.terminate)
+    await client.aclose()
+    tracing.flush()
+    flush()
+
+
+routes = [
+    Route("/export/batch", export_batch_route, methods=["POST"]),
+    Route("/export/{dataset_id}/{table_id}", export, methods=["POST"]),
+    Route("/jobs/{job_id}", get_job, methods=["GET"], name="get_job"),
+    Route("/metrics", get_metrics, methods=["GET"]),
+    Route("/", hello),
+]
+
+app = Starlette(routes=routes, on_shutdown=[shutdown], exception_handlers={
+    NotFound: handle_not_found,
+    ValueError: handle_value_error,
+    BadRequest: handle_bad_request,
+    Overloaded: handle_overloaded,
+    Terminated: handle_terminated,
+    Exception: handle_exception,
+})
+app.add_middleware(RequestMetrics, routes=routes)
@@ -0,0 +1,56 @@
+"""Compare two runs of ``benchmarks.suite``.
+
+Prints the median time of every benchmark in both runs and exits with status 1
+if any is slower than ``--threshold`` times its baseline.
+
+Usage: python -m benchmarks.compare baseline.json candidate.json --threshold 1.1
+"""
+import argparse
+import json
+import sys
+from typing import Dict, List, Tuple
+
+
+def load(path: str) -> Dict[Tuple[str, int], Dict]:
+    with open(path) as file:
+        report = json.load(file)
+    return {(result["benchmark"], result["shards"]): result for result in report["results"]}
+
+
+def compare(baseline: Dict[Tuple[str, int], Dict], candidate: Dict[Tuple[str, int], Dict],
+            threshold: float) -> Tuple[List[str], List[Tuple[str, int]]]:
+    """
+    :return: the lines of the report, and the benchmarks slower than the threshold
+    """
+    lines = ["{:<26} {:>7} {:>12} {:>12} {:>7}".format("benchmark", "shards", "baseline", "candidate", "ratio")]
+    regressions = []
+    for key in sorted(set(baseline) & set(candidate)):
+        before = baseline[key]["seconds"]["median"]
+        after = candidate[key]["seconds"]["median"]
+        ratio = after / before if before else float("inf")
+        flag = ""
+        if ratio > threshold:
+            regressions.append(key)
+            flag = "  slower"
+        lines.append("{:<26} {:>7} {:>11.6f}s {:>11.6f}s {:>6.2f}x{}".format(key[0], key[1], before, after, ratio,
+                                                                           flag))
+    for key in sorted(set(baseline) ^ set(candidate)):
+        lines.append("{:<26} {:>7} only in the {}".format(key[0], key[1],
+                                                         "baseline" if key in baseline else "candidate"))
+    return lines, regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=1.1, help="ratio of the medians flagged as slower")
+    args = parser.parse_args()
+
+    lines, regressions = compare(load(args.baseline), load(args.candidate), args.threshold)
+    print("\n".join(lines))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Benchmark ``compose_file`` against the former sequential chained compose.
+
+Usage: python -m benchmarks.compose --shards 100 1000 --latency 0.05
+"""
+import argparse
+import concurrent.futures
+import io
+from time import perf_counter, sleep
+from typing import List
+
+import structlog
+
+from benchmarks.fake_storage import FakeBlob, FakeStorageClient, patch_storage
+from utils.compose import compose_file, delete_objects_concurrent, generate_chunks
+
+BUCKET = "bench-bucket"
+PREFIX = "dataset/tmp/table/partition"
+FILE_URI = f"gs://{BUCKET}/dataset/export.csv"
+
+
+def sequential_compose_file(file_uri: str, list_object: List[FakeBlob], gcs_client: FakeStorageClient,
+                            header: List[str], pause: float) -> FakeBlob:
+    """The chained compose used before the tree reduction: one 31-blob chunk at a time"""
+    final_blob = gcs_client.blob_from_string(file_uri)
+    final_blob.upload_from_file(io.StringIO(f"{','.join(header)} \n"), content_type='text/csv', client=gcs_client)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
+    for chunk in generate_chunks(list_object=list_object):
+        chunk.insert(0, final_blob)
+        final_blob.compose(chunk, client=gcs_client)
+        delete_objects_concurrent(chunk[1:], executor, storage_client=gcs_client)
+        sleep(pause)
+    executor.shutdown(True)
+    return final_blob
+
+
+def expected_content(header: List[str], shards: int) -> bytes:
+    return f"{','.join(header)} \n".encode("utf-8") + b"".join(f"{i}\n".encode("utf-8") for i in range(shards))
+
+
+def run(shards: int, latency: float, pause: float) -> None:
+    header = ["col1", "col2"]
+    results = {}
+    for name in ("sequential", "tree"):
+        client = FakeStorageClient(latency=latency)
+        blobs = client.add_shards(BUCKET, PREFIX, shards)
+        start = perf_counter()
+        with patch_storage(client):
+            if name == "sequential":
+                final_blob = sequential_compose_file(FILE_URI, blobs, client, header, pause)
+            else:
+                final_blob = compose_file(FILE_URI, blobs, client, header)
+        results[name] = perf_counter() - start
+        assert final_blob.download_as_bytes(client=client) == expected_content(header, shards), name
+    print("shards={:>6} latency={:.3f}s sequential={:8.2f}s tree={:8.2f}s speedup={:6.1f}x".format(
+        shards, latency, results["sequential"], results["tree"], results["sequential"] / results["tree"]))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated seconds per GCS call")
+    parser.add_argument("--pause", type=float, default=1.0, help="sleep between chunks of the sequential compose")
+    args = parser.parse_args()
+    # the processors still run, the events are neither queued nor rendered
+    structlog.configure(logger_factory=structlog.ReturnLoggerFactory())
+    for shards in args.shards:
+        run(shards, args.latency, args.pause)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+"""Local HTTP stand-ins of the GCS JSON API and of BigQuery, for the load tests.
+
+One threaded server answers both APIs: point ``STORAGE_EMULATOR_HOST`` and
+``BIGQUERY_EMULATOR_HOST`` at it. GCS objects are kept in memory with their
+generation and metadata (get, list, multipart and resumable uploads, compose,
+delete and batch deletes, with the ``ifGenerationMatch`` preconditions). Every
+BigQuery table exists, with a fixed schema, and an extract job writes ``shards``
+files of ``rows`` rows each to its destination after ``extract_seconds``, or a
+single file to a destination without wildcard. The tables report ``num_bytes``
+to the export planner and an etag which never changes. Every
+call waits ``latency`` seconds first.
+
+Usage: python -m benchmarks.emulator --port 9023 --latency 0.02 --extract-seconds 1
+"""
+import argparse
+import base64
+import gzip
+import hashlib
+import json
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep, time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import google_crc32c
+
+SCHEMA = [{"name": "id", "type": "INTEGER", "mode": "NULLABLE"},
+          {"name": "name", "type": "STRING", "mode": "NULLABLE"}]
+LIST_PAGE_SIZE = 1000
+
+OBJECT = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>[^/]+)(?P<compose>/compose)?$")
+BUCKET = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)$")
+OBJECTS = re.compile(r"^/storage/v1/b/(?P<bucket>[^/]+)/o$")
+UPLOAD = re.compile(r"^/upload/storage/v1/b/(?P<bucket>[^/]+)/o$")
+DOWNLOAD = re.compile(r"^/download/storage/v1/b/(?P<bucket>[^/]+)/o/(?P<name>[^/]+)$")
+TABLES = re.compile(r"^/bigquery/v2/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables$")
+TABLE = re.compile(r"^/bigquery/v2/projects/(?P<project>[^/]+)/datasets/(?P<dataset>[^/]+)/tables/(?P<table>[^/]+)$")
+JOBS = re.compile(r"^/bigquery/v2/projects/(?P<project>[^/]+)/jobs$")
+JOB = re.compile(r"^/bigquery/v2/projects/(?P<project>[^/]+)/jobs/(?P<job_id>[^/]+)$")
+JOB_CANCEL = re.compile(r"^/bigquery/v2/projects/(?P<project>[^/]+)/jobs/(?P<job_id>[^/]+)/cancel$")
+
+# status, json body or raw bytes, content type, and the extra headers if any
+Response = Tuple
+
+
+def _error(code: int, message: str) -> Response:
+    return code, {"error": {"code": code, "message": message, "errors": [{"message": message}]}}, "application/json"
+
+
+def table_rows(shard: int, rows: int) -> List[Tuple[int, str]]:
+    return [(i, "name-{}".format(i)) for i in range(shard * rows, (shard + 1) * rows)]
+
+
+def expected_csv(shards: int, rows: int, with_header: bool = True) -> bytes:
+    """
+    :return: the file a csv export of any table of the emulator should produce
+    """
+    header = "{} \n".format(",".join(field["name"] for field in SCHEMA)) if with_header else ""
+    return header.encode("utf-8") + b"".join(
+        "{},{}\n".format(*row).encode("utf-8") for shard in range(shards) for row in table_rows(shard, rows))
+
+
+class Emulator:
+    """The state of both APIs, requests are routed by ``route``"""
+
+    def __init__(self, latency: float = 0.0, extract_seconds: float = 0.0, shards: int = 4, rows: int = 100,
+                 num_bytes: int = None):
+        self.latency = latency
+        self.extract_seconds = extract_seconds
+        self.shards = shards
+        self.rows = rows
+        # the size reported for the planner, unknown if None
+        self.num_bytes = num_bytes
+        self.objects: Dict[Tuple[str, str], Dict] = {}
+        self.jobs: Dict[str, Dict] = {}
+        # the tables created by the exports, the query results, by project.dataset.table
+        self.tables: Dict[str, Dict] = {}
+        # the configuration of the query jobs, with the expiration of their destination table when inserted
+        self.queries: List[Dict] = []
+        self.uploads: Dict[str, Dict] = {}
+        self.calls: Dict[str, int] = {}
+        # the statuses answered to the next calls, by call as counted in ``calls``, instead of running them
+        self.errors: Dict[str, List[int]] = {}
+        self._generation = 0
+        self._lock = threading.RLock()
+
+    # ---------------------------------------------------------------------------------------------------------- gcs
+
+    def _resource(self, bucket: str, name: str) -> Dict:
+        stored = self.objects[(bucket, name)]
+        resource = {
+            "kind": "storage#object", "id": "{}/{}/{}".format(bucket, name, stored["generation"]),
+            "bucket": bucket, "name": name, "generation": str(stored["generation"]), "metageneration": "1",
+            "size": str(len(stored["data"])), "contentType": stored["contentType"],
+            # checked by the client after an upload
+            "crc32c": base64.b64encode(google_crc32c.value(stored["data"]).to_bytes(4, "big")).decode(),
+            "md5Hash": base64.b64encode(hashlib.md5(stored["data"]).digest()).decode(),
+            "timeCreated": stored["updated"], "updated": stored["updated"],
+        }
+        if stored["contentEncoding"]:
+            resource["contentEncoding"] = stored["contentEncoding"]
+        if stored["metadata"]:
+            resource["metadata"] = stored["metadata"]
+        return resource
+
+    def _precondition(self, bucket: str, name: str, query: Dict) -> Optional[Response]:
+        if "ifGenerationMatch" not in query:
+            return None
+        expected = int(query["ifGenerationMatch"])
+        current = self.objects.get((bucket, name), {}).get("generation", 0)
+        if expected != current:
+            return _error(412, "At least one of the pre-conditions you specified did not hold.")
+        return None
+
+    def _store(self, bucket: str, name: str, data: bytes, resource: Dict) -> Response:
+        self._generation += 1
+        self.objects[(bucket, name)] = {
+            "data": data, "generation": self._generation,
+            "contentType": resource.get("contentType") or "application/octet-stream",
+            "contentEncoding": resource.get("contentEncoding"), "metadata": resource.get("metadata"),
+            "updated": "{:.3f}".format(time()),
+        }
+        return 200, self._resource(bucket, name), "application/json"
+
+    def put(self, bucket: str, name: str, data: bytes, **resource) -> None:
+        with self._lock:
+            self._store(bucket, name, data, resource)
+
+    def get(self, bucket: str, name: str) -> Optional[bytes]:
+        stored = self.objects.get((bucket, name))
+        return stored["data"] if stored else None
+
+    def _get_object(self, bucket: str, name: str) -> Response:
+        if (bucket, name) not in self.objects:
+            return _error(404, "No such object: {}/{}".format(bucket, name))
+        return 200, self._resource(bucket, name), "application/json"
+
+    def _list(self, bucket: str, query: Dict) -> Response:
+        prefix = query.get("prefix", "")
+        size = int(query.get("maxResults", LIST_PAGE_SIZE))
+        names = sorted(name for (b, name) in self.objects if b == bucket and name.startswith(prefix)
+                       and name > query.get("pageToken", ""))
+        body = {"kind": "storage#objects", "items": [self._resource(bucket, name) for name in names[:size]]}
+        if len(names) > size:
+            body["nextPageToken"] = names[size - 1]
+        return 200, body, "application/json"
+
+    def _upload(self, bucket: str, query: Dict, headers: Dict, body: bytes) -> Response:
+        if query.get("uploadType") == "resumable":
+            upload_id = uuid.uuid4().hex
+            resource = json.loads(body or b"{}")
+            resource.setdefault("contentType", headers.get("x-upload-content-type"))
+            self.uploads[upload_id] = {"bucket": bucket, "query": query, "resource": resource, "data": b""}
+            location = "http://{}/upload/storage/v1/b/{}/o?uploadType=resumable&upload_id={}".format(
+                headers.get("host"), bucket, upload_id)
+            return 200, b"", "application/json", {"Location": location}
+        if query.get("uploadType") != "multipart":
+            return _error(501, "only multipart and resumable uploads are emulated")
+        boundary = re.search(r'boundary="?([^";]+)"?', headers.get("content-type", "")).group(1).encode()
+        parts = [part.split(b"\r\n\r\n", 1)[1][:-2] for part in body.split(b"--" + boundary)[1:-1]]
+        resource, data = json.loads(parts[0]), parts[1]
+        name = query.get("name") or resource["name"]
+        return self._precondition(bucket, name, query) or self._store(bucket, name, data, resource)
+
+    def _upload_chunk(self, query: Dict, headers: Dict, body: bytes) -> Response:
+        upload = self.uploads.get(query.get("upload_id"))
+        if upload is None:
+            return _error(404, "No such upload")
+        upload["data"] += body
+        # bytes 0-99/100, bytes 0-99/* or bytes */100
+        total = headers.get("content-range", "").rpartition("/")[2]
+        if total != "*" and int(total or 0) == len(upload["data"]):
+            del self.uploads[query["upload_id"]]
+            name = upload["query"].get("name") or upload["resource"]["name"]
+            return self._precondition(upload["bucket"], name, upload["query"]) or \
+                self._store(upload["bucket"], name, upload["data"], upload["resource"])
+        received = {"Range": "bytes=0-{}".format(len(upload["data"]) - 1)} if upload["data"] else {}
+        return 308, b"", "application/json", received
+
+    def _compose(self, bucket: str, name: str, query: Dict, body: Dict) -> Response:
+        sources = [source["name"] for source in body["sourceObjects"]]
+        if len(sources) > 32:
+            return _error(400, "The number of source components provided ({}) exceeds the maximum (32)".format(
+                len(sources)))
+        missing = [source for source in sources if (bucket, source) not in self.objects]
+        if missing:
+            return _error(404, "Object {} not found".format(missing[0]))
+        data = b"".join(self.objects[(bucket, source)]["data"] for source in sources)
+        return self._precondition(bucket, name, query) or self._store(bucket, name, data,
+                                                                      body.get("destination") or {})
+
+    def _delete(self, bucket: str, name: str, query: Dict) -> Response:
+        if (bucket, name) not in self.objects:
+            return _error(404, "No such object: {}/{}".format(bucket, name))
+        failed = self._precondition(bucket, name, query)
+        if failed:
+            return failed
+        del self.objects[(bucket, name)]
+        return 204, b"", "application/json"
+
+    def _batch(self, headers: Dict, body: bytes) -> Response:
+        boundary = re.search(r'boundary="?([^";]+)"?', headers.get("content-type", "")).group(1).encode()
+        parts = []
+        for part in body.split(b"--" + boundary)[1:-1]:
+            # the envelope is written with bare line feeds, the requests with carriage returns
+            request = re.split(rb"\r?\n\r?\n", part, 1)[1].decode("utf-8")
+            request_line, _, rest = request.partition("\r\n")
+            method, uri, _ = request_line.split(" ", 2)
+            request_headers, _, request_body = rest.partition("\r\n\r\n")
+            status, payload, content_type = self.route(method, uri, {}, request_body.strip().encode("utf-8"),
+                                                       batched=True)[:3]
+            payload = json.dumps(payload) if isinstance(payload, dict) else payload.decode("utf-8")
+            parts.append("--batch_response\r\nContent-Type: application/http\r\nContent-ID: <response-{}>\r\n\r\n"
+                         "HTTP/1.1 {} Status\r\nContent-Type: {}\r\n\r\n{}\r\n".format(
+                             len(parts) + 1, status, content_type, payload))
+        return 200, ("".join(parts) + "--batch_response--\r\n").encode("utf-8"), \
+            "multipart/mixed; boundary=batch_response"
+
+    # ----------------------------------------------------------------------------------------------------- bigquery
+
+    def _table(self, project: str, dataset: str, table: str) -> Response:
+        # the tables never change
+        etag = '"{}"'.format(hashlib.md5("{}.{}.{}".format(project, dataset, table).encode("utf-8")).hexdigest())
+        resource = {
+            "kind": "bigquery#table", "id": "{}:{}.{}".format(project, dataset, table),
+            "tableReference": {"projectId": project, "datasetId": dataset, "tableId": table},
+            "schema": {"fields": SCHEMA}, "numRows": str(self.shards * self.rows), "type": "TABLE", "etag": etag,
+            # fixed, the result of an export stays up to date
+            "creationTime": "1600000000000", "lastModifiedTime": "1600000000000",
+        }
+        if self.num_bytes is not None:
+            resource["numBytes"] = str(self.num_bytes)
+        return 200, resource, "application/json"
+
+    def _insert_table(self, project: str, dataset: str, body: Dict) -> Response:
+        key = "{}.{}.{}".format(project, dataset, body["tableReference"]["tableId"])
+        if key in self.tables:
+            return _error(409, "Already Exists: Table {}".format(key))
+        self.tables[key] = body
+        return self._table(project, dataset, body["tableReference"]["tableId"])
+
+    def _delete_table(self, project: str, dataset: str, table: str) -> Response:
+        if self.tables.pop("{}.{}.{}".format(project, dataset, table), None) is None:
+            return _error(404, "Not found: Table {}:{}.{}".format(project, dataset, table))
+        return 204, b"", "application/json"
+
+    def _query(self, query: Dict) -> None:
+        destination = query["destinationTable"]
+        table = self.tables.get("{projectId}.{datasetId}.{tableId}".format(**destination), {})
+        self.queries.append(dict(query, expirationTime=table.get("expirationTime")))
+
+    def _write_shards(self, extract: Dict) -> None:
+        uris = extract["destinationUris"]
+        json_rows = extract.get("destinationFormat") == "NEWLINE_DELIMITED_JSON"
+        shards = []
+        for shard in range(self.shards):
+            lines = [json.dumps({"id": i, "name": name}) if json_rows else "{},{}".format(i, name)
+                     for i, name in table_rows(shard, self.rows)]
+            shards.append("".join(line + "\n" for line in lines).encode("utf-8"))
+        if "*" not in uris[0]:
+            # a single file, as BigQuery writes a table under 1 GB
+            files = [(uris[0], b"".join(shards))]
+        else:
+            # consecutive shards per writer, numbered from 0 in every uri
+            files = []
+            for index, uri in enumerate(uris):
+                mine = shards[index * len(shards) // len(uris):(index + 1) * len(shards) // len(uris)]
+                files.extend((uri.replace("*", "{:012d}".format(i)), data) for i, data in enumerate(mine))
+        for uri, data in files:
+            if extract.get("compression") == "GZIP":
+                data = gzip.compress(data)
+            bucket, _, name = uri[len("gs://"):].partition("/")
+            self._store(bucket, name, data, {})
+
+    def _insert_job(self, project: str, body: Dict) -> Response:
+        configuration = body.get("configuration", {})
+        if "extract" not in configuration and "query" not in configuration:
+            return _error(501, "only extract and query jobs are emulated")
+        reference = dict(body.get("jobReference") or {}, projectId=project)
+        reference.setdefault("jobId", uuid.uuid4().hex)
+        if reference["jobId"] in self.jobs:
+            return _error(409, "Already Exists: Job {}:{}".format(project, reference["jobId"]))
+        job = dict(body, jobReference=reference, id="{}:{}".format(project, reference["jobId"]),
+                   statistics={"creationTime": str(int(time() * 1000))})
+        self.jobs[reference["jobId"]] = {"resource": job, "done_at": monotonic() + self.extract_seconds}
+        return self._job(project, reference["jobId"])
+
+    def _cancel_job(self, project: str, job_id: str) -> Response:
+        if job_id not in self.jobs:
+            return _error(404, "Not found: Job {}:{}".format(project, job_id))
+        job = self.jobs[job_id]
+        if "done" not in job:
+            # stopped before it wrote its files
+            job["done"] = True
+            job["resource"]["status"] = {"errorResult": {"reason": "stopped", "message": "Job cancelled"}}
+        status, resource, content_type = self._job(project, job_id)
+        return status, {"kind": "bigquery#jobCancelResponse", "job": resource}, content_type
+
+    def _job(self, project: str, job_id: str) -> Response:
+        if job_id not in self.jobs:
+            return _error(404, "Not found: Job {}:{}".format(project, job_id))
+        job = self.jobs[job_id]
+        if "done" not in job and monotonic() >= job["done_at"]:
+            configuration = job["resource"]["configuration"]
+            if "extract" in configuration:
+                self._write_shards(configuration["extract"])
+            else:
+                self._query(configuration["query"])
+            job["done"] = True
+        status = dict(job["resource"].get("status", {}), state="DONE" if "done" in job else "RUNNING")
+        return 200, dict(job["resource"], status=status), "application/json"
+
+    # -------------------------------------------------------------------------------------------------------- route
+
+    def route(self, method: str, uri: str, headers: Dict, body: bytes, batched: bool = False) -> Response:
+        """
+        :param uri: the path and query of the request, percent-encoded
+        :param batched: a request of a batch, the latency was already paid by the batch
+        :return: the status, the body and its content type
+        """
+        split = urlsplit(uri)
+        path, query = split.path, {key: values[0] for key, values in parse_qs(split.query).items()}
+        name = method + " " + re.sub(r"/(o|tables|jobs)/[^/]+", r"/\1/*", path)
+        if not batched and self.latency:
+            sleep(self.latency)
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            if self.errors.get(name):
+                return _error(self.errors[name].pop(0), "injected error")
+            if path == "/batch/storage/v1" and method == "POST":
+                return self._batch(headers, body)
+            match = OBJECT.match(path)
+            if match:
+                bucket, object_name = match.group("bucket"), unquote(match.group("name"))
+                if match.group("compose") and method == "POST":
+                    return self._compose(bucket, object_name, query, json.loads(body))
+                if method == "GET" and query.get("alt") == "media":
+                    return self._download(bucket, object_name)
+                if method == "GET":
+                    return self._get_object(bucket, object_name)
+                if method == "DELETE":
+                    return self._delete(bucket, object_name, query)
+            match = DOWNLOAD.match(path)
+            if match and method == "GET":
+                return self._download(match.group("bucket"), unquote(match.group("name")))
+            match = BUCKET.match(path)
+            if match and method == "GET":
+                # every bucket exists
+                return 200, {"kind": "storage#bucket", "id": match.group("bucket"), "name": match.group("bucket"),
+                             "location": "EUROPE-WEST1", "storageClass": "STANDARD"}, "application/json"
+            match = OBJECTS.match(path)
+            if match and method == "GET":
+                return self._list(match.group("bucket"), query)
+            match = UPLOAD.match(path)
+            if match and method == "POST":
+                return self._upload(match.group("bucket"), query, headers, body)
+            if match and method == "PUT":
+                return self._upload_chunk(query, headers, body)
+            match = TABLES.match(path)
+            if match and method == "POST":
+                return self._insert_table(match.group("project"), match.group("dataset"), json.loads(body))
+            match = TABLE.match(path)
+            if match and method == "GET":
+                return self._table(match.group("project"), match.group("dataset"), match.group("table"))
+            if match and method == "DELETE":
+                return self._delete_table(match.group("project"), match.group("dataset"), match.group("table"))
+            match = JOBS.match(path)
+            if match and method == "POST":
+                return self._insert_job(match.group("project"), json.loads(body))
+            match = JOB_CANCEL.match(path)
+            if match and method == "POST":
+                return self._cancel_job(match.group("project"), match.group("job_id"))
+            match = JOB.match(path)
+            if match and method == "GET":
+                return self._job(match.group("project"), match.group("job_id"))
+        return _error(501, "{} {} is not emulated".format(method, path))
+
+    def _download(self, bucket: str, name: str) -> Response:
+        if (bucket, name) not in self.objects:
+            return _error(404, "No such object: {}/{}".format(bucket, name))
+        return 200, self.objects[(bucket, name)]["data"], "application/octet-stream"
+
+    def temporaries(self) -> List[str]:
+        """
+        :return: the temporary files, composites and locks left in the buckets
+        """
+        with self._lock:
+            return sorted("gs://{}/{}".format(bucket, name) for bucket, name in self.objects
+                          if "/tmp/" in name or ".compose/" in name or name.endswith(".lock"))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    emulator: Emulator = None
+
+    def _serve(self) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        headers = {key.lower(): value for key, value in self.headers.items()}
+        status, payload, content_type, *extra = self.emulator.route(self.command, self.path, headers, body)
+        data = json.dumps(payload).encode("utf-8") if isinstance(payload, dict) else payload
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for key, value in (extra[0] if extra else {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+
+    do_GET = do_POST = do_DELETE = do_PATCH = do_PUT = do_HEAD = _serve
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+def serve(emulator: Emulator, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Answer the requests from a background thread
+    :param port: 0 picks a free port, read it from ``server.server_address``
+    :return: the server, stopped with ``shutdown()``
+    """
+    handler = type("Handler", (_Handler,), {"emulator": emulator})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="emulator", daemon=True).start()
+    return server
+
+
+def endpoint(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return "http://{}:{}".format(host, port)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=9023)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds waited by every call")
+    parser.add_argument("--extract-seconds", type=float, default=0.0, help="duration of an extract job")
+    parser.add_argument("--shards", type=int, default=4, help="files written by an extract job")
+    parser.add_argument("--rows", type=int, default=100, help="rows of every file")
+    parser.add_argument("--num-bytes", type=int, default=None, help="size of the tables, unknown by default")
+    args = parser.parse_args()
+
+    server = serve(Emulator(args.latency, args.extract_seconds, args.shards, args.rows, args.num_bytes),
+                   port=args.port)
+    print("export STORAGE_EMULATOR_HOST={0} BIGQUERY_EMULATOR_HOST={0}".format(endpoint(server)))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""In-memory stand-in for the BigQuery Storage Read API client.
+
+Sessions split the rows of a table across streams, like the service does,
+and every page read sleeps for ``latency`` seconds to simulate a round trip.
+"""
+import threading
+from time import sleep
+from typing import Dict, Iterator, List
+
+
+class FakeReadStream:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeReadSession:
+    def __init__(self, name: str, table: str, streams: List[FakeReadStream], read_options: Dict):
+        self.name = name
+        self.table = table
+        self.streams = streams
+        self.read_options = read_options
+
+
+class FakeRows:
+    def __init__(self, rows: List[Dict], page_size: int, latency: float):
+        self._rows = rows
+        self._page_size = page_size
+        self._latency = latency
+
+    @property
+    def pages(self) -> Iterator[List[Dict]]:
+        for i in range(0, len(self._rows), self._page_size):
+            if self._latency:
+                sleep(self._latency)
+            yield self._rows[i:i + self._page_size]
+
+    def __iter__(self) -> Iterator[Dict]:
+        for page in self.pages:
+            yield from page
+
+
+class FakeReader:
+    def __init__(self, rows: List[Dict], page_size: int, latency: float):
+        self._rows = FakeRows(rows, page_size, latency)
+
+    def rows(self, read_session: FakeReadSession = None) -> FakeRows:
+        return self._rows
+
+
+class FakeReadClient:
+    """Serves the rows of ``tables``, keyed by "projects/{p}/datasets/{d}/tables/{t}"."""
+
+    def __init__(self, tables: Dict[str, List[Dict]], page_size: int = 100, latency: float = 0.0):
+        self.tables = tables
+        self.page_size = page_size
+        self.latency = latency
+        self.sessions: List[FakeReadSession] = []
+        # names of the streams which fail when read
+        self.failing: List[str] = []
+        self._streams: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+
+    def create_read_session(self, parent: str, read_session: Dict, max_stream_count: int = 0) -> FakeReadSession:
+        rows = self.tables[read_session["table"]]
+        read_options = read_session.get("read_options", {})
+        selected = read_options.get("selected_fields")
+        if selected:
+            rows = [{name: row[name] for name in selected} for row in rows]
+        count = max(min(max_stream_count or 1, len(rows)), 1)
+        with self._lock:
+            name = "{}/locations/us/sessions/{}".format(parent, len(self.sessions))
+            streams = [FakeReadStream("{}/streams/{}".format(name, i)) for i in range(count)]
+            for i, stream in enumerate(streams):
+                self._streams[stream.name] = rows[i::count]
+            session = FakeReadSession(name, read_session["table"], streams, read_options)
+            self.sessions.append(session)
+        return session
+
+    def read_rows(self, name: str, offset: int = 0) -> FakeReader:
+        if name in self.failing:
+            raise RuntimeError("stream {} failed".format(name))
+        return FakeReader(self._streams[name][offset:], self.page_size, self.latency)
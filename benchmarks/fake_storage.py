@@ -0,0 +1,266 @@
+"""In-memory stand-in for ``google.cloud.storage`` used by the benchmarks.
+
+Only the subset of the API touched by ``utils.compose`` is implemented. Every
+call sleeps for ``latency`` seconds to simulate a round trip to GCS, and the
+calls of a method are paced to at most ``rate_limits[method]`` per second.
+"""
+import io
+import threading
+from contextlib import contextmanager
+from time import monotonic, sleep
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+from unittest.mock import patch
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud import storage
+from google.cloud.exceptions import NotFound
+
+MAX_COMPOSE_SOURCES = 32
+
+
+class FakeBlob:
+    def __init__(self, bucket: "FakeBucket", name: str):
+        self.bucket = bucket
+        self.name = name
+        self.content_type: Optional[str] = None
+        self.content_encoding: Optional[str] = None
+        self.metadata: Optional[Dict[str, str]] = None
+        self.generation: Optional[int] = None
+
+    @property
+    def path(self) -> str:
+        return f"/b/{self.bucket.name}/o/{self.name}"
+
+    def _key(self) -> Tuple[str, str]:
+        return self.bucket.name, self.name
+
+    def _properties(self, content_type: str = None) -> Dict:
+        return {"content_type": content_type or self.content_type, "content_encoding": self.content_encoding,
+                "metadata": self.metadata}
+
+    def upload_from_file(self, file_obj, content_type: str = None, client: "FakeStorageClient" = None,
+                         if_generation_match: int = None) -> None:
+        self.upload_from_string(file_obj.read(), content_type, client, if_generation_match)
+
+    def upload_from_string(self, data, content_type: str = None, client: "FakeStorageClient" = None,
+                           if_generation_match: int = None) -> None:
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        client = client or self.bucket.client
+        client.call("upload")
+        self.generation = client.put(self._key(), data, self._properties(content_type), if_generation_match)
+
+    def compose(self, sources: List["FakeBlob"], client: "FakeStorageClient" = None,
+                if_generation_match: int = None) -> None:
+        if len(sources) > MAX_COMPOSE_SOURCES:
+            raise ValueError(f"compose accepts at most {MAX_COMPOSE_SOURCES} sources, got {len(sources)}")
+        client = client or self.bucket.client
+        client.call("compose")
+        data = b"".join(client.get(source._key()) for source in sources)
+        self.generation = client.put(self._key(), data, self._properties(), if_generation_match)
+
+    def delete(self, client: "FakeStorageClient" = None, if_generation_match: int = None) -> None:
+        client = client or self.bucket.client
+        client.call("delete")
+        if not client.remove(self._key(), if_generation_match):
+            raise NotFound(f"gs://{self.bucket.name}/{self.name} not found")
+
+    def download_as_bytes(self, client: "FakeStorageClient" = None) -> bytes:
+        client = client or self.bucket.client
+        client.call("download")
+        return client.get(self._key())
+
+    def reload(self, client: "FakeStorageClient" = None) -> None:
+        client = client or self.bucket.client
+        client.call("get")
+        properties = client.stat(self._key())
+        self.generation = properties["generation"]
+        self.content_type = properties["content_type"]
+        self.content_encoding = properties["content_encoding"]
+        self.metadata = properties["metadata"]
+
+    def open(self, mode: str = "r", chunk_size: int = None, content_type: str = None, **kwargs) -> "FakeBlobWriter":
+        if mode != "wb":
+            raise ValueError(f"mode {mode} is not supported")
+        return FakeBlobWriter(self, content_type)
+
+    def exists(self, client: "FakeStorageClient" = None) -> bool:
+        client = client or self.bucket.client
+        client.call("get")
+        with client._lock:
+            return self._key() in client.objects
+
+
+class FakeBlobWriter(io.BytesIO):
+    """Resumable upload, the object is created when the writer is closed and never if the upload is terminated"""
+
+    def __init__(self, blob: FakeBlob, content_type: str = None):
+        super().__init__()
+        self.blob = blob
+        self.content_type = content_type
+
+    def close(self) -> None:
+        if not self.closed:
+            self.blob.upload_from_string(self.getvalue(), content_type=self.content_type)
+        super().close()
+
+    def terminate(self) -> None:
+        super().close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.close()
+
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+
+
+class FakeBatch:
+    """Deferred deletes sent as a single call by ``finish``"""
+
+    def __init__(self, client: "FakeStorageClient"):
+        self.client = client
+        self.deferred: List[Tuple[str, str]] = []
+
+    def api_request(self, method: str, path: str) -> None:
+        if method != "DELETE":
+            raise NotImplementedError(f"only deletes are batched, got {method}")
+        if len(self.deferred) >= 100:
+            raise ValueError("batch accepts at most 100 calls")
+        # /b/{bucket}/o/{name}
+        _, _, bucket, _, name = path.split("/", 4)
+        self.deferred.append((bucket, name))
+
+    def finish(self, raise_exception: bool = True) -> List[FakeResponse]:
+        self.client.call("batch")
+        responses = []
+        for key in self.deferred:
+            if self.client.fail_once(key[1]):
+                responses.append(FakeResponse(503))
+            elif self.client.remove(key):
+                responses.append(FakeResponse(204))
+            else:
+                responses.append(FakeResponse(404))
+        return responses
+
+
+class FakeBucket:
+    def __init__(self, client: "FakeStorageClient", name: str):
+        self.client = client
+        self.name = name
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+
+class FakeStorageClient:
+    """Thread-safe in-memory object store with a fixed per-call latency"""
+
+    def __init__(self, latency: float = 0.0, rate_limits: Dict[str, float] = None):
+        self.latency = latency
+        self.rate_limits = rate_limits or {}
+        # the earliest start of the next call of each rate limited method
+        self._next_call: Dict[str, float] = {}
+        self.objects: Dict[Tuple[str, str], bytes] = {}
+        # generation, content type, content encoding and custom metadata of each object
+        self.properties: Dict[Tuple[str, str], Dict] = {}
+        self.calls: Dict[str, int] = {}
+        # names of the blobs whose next batched delete answers 503
+        self.failing: Set[str] = set()
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def call(self, method: str) -> None:
+        wait = 0.0
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            rate = self.rate_limits.get(method)
+            if rate:
+                now = monotonic()
+                start = max(now, self._next_call.get(method, now))
+                self._next_call[method] = start + 1 / rate
+                wait = start - now
+        if wait + self.latency > 0:
+            sleep(wait + self.latency)
+
+    def _check_generation(self, key: Tuple[str, str], if_generation_match: Optional[int]) -> None:
+        if if_generation_match is None:
+            return
+        generation = self.properties[key]["generation"] if key in self.objects else 0
+        if generation != if_generation_match:
+            raise PreconditionFailed(f"gs://{key[0]}/{key[1]} is at generation {generation}, "
+                                     f"not {if_generation_match}")
+
+    def put(self, key: Tuple[str, str], data: bytes, properties: Dict = None,
+            if_generation_match: int = None) -> int:
+        with self._lock:
+            self._check_generation(key, if_generation_match)
+            self._generation += 1
+            self.objects[key] = data
+            self.properties[key] = dict(properties or {"content_type": None, "content_encoding": None,
+                                                       "metadata": None}, generation=self._generation)
+            return self._generation
+
+    def get(self, key: Tuple[str, str]) -> bytes:
+        with self._lock:
+            if key not in self.objects:
+                raise NotFound(f"gs://{key[0]}/{key[1]} not found")
+            return self.objects[key]
+
+    def stat(self, key: Tuple[str, str]) -> Dict:
+        with self._lock:
+            if key not in self.objects:
+                raise NotFound(f"gs://{key[0]}/{key[1]} not found")
+            return dict(self.properties[key])
+
+    def remove(self, key: Tuple[str, str], if_generation_match: int = None) -> bool:
+        with self._lock:
+            if key not in self.objects:
+                return False
+            self._check_generation(key, if_generation_match)
+            del self.objects[key]
+            del self.properties[key]
+            return True
+
+    def fail_once(self, name: str) -> bool:
+        with self._lock:
+            if name in self.failing:
+                self.failing.discard(name)
+                return True
+            return False
+
+    def batch(self, raise_exception: bool = True) -> FakeBatch:
+        return FakeBatch(self)
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self, name)
+
+    def list_blobs(self, bucket: str, prefix: str = "") -> List[FakeBlob]:
+        self.call("list")
+        with self._lock:
+            names = sorted(name for b, name in self.objects if b == bucket and name.startswith(prefix))
+        return [self.bucket(bucket).blob(name) for name in names]
+
+    def blob_from_string(self, uri: str) -> FakeBlob:
+        bucket, _, name = uri[len("gs://"):].partition("/")
+        return self.bucket(bucket).blob(name)
+
+    def add_shards(self, bucket: str, prefix: str, count: int) -> List[FakeBlob]:
+        """Create ``count`` shards named like BigQuery wildcard extract output"""
+        blobs = []
+        for i in range(count):
+            blob = self.bucket(bucket).blob(f"{prefix}{i:012d}.csv")
+            self.put(blob._key(), f"{i}\n".encode("utf-8"))
+            blobs.append(blob)
+        return blobs
+
+
+@contextmanager
+def patch_storage(fake: FakeStorageClient) -> Iterator[FakeStorageClient]:
+    """Route ``storage.Blob.from_string`` to the fake client"""
+    with patch.object(storage.Blob, "from_string", side_effect=lambda uri, client=None: fake.blob_from_string(uri)):
+        yield fake
@@ -0,0 +1,250 @@
+"""Load test of the app under a gunicorn command of the Procfile, against the local API stand-ins.
+
+The stand-ins of ``benchmarks.emulator`` run in this process, gunicorn in a
+child process pointed at them. ``--concurrency`` clients fire ``--requests``
+synchronous exports spread over ``--tables`` tables, while ``/metrics`` is
+scraped to follow the busy request threads. The final files are then checked
+against the rows of the stand-in, and the temporary files must all be deleted.
+A request rejected with 429 is retried after its ``Retry-After`` delay, up to
+``--retries`` times. Exits with status 1 on any failed request or inconsistent file. ``--process asgi``
+runs the ``asgi_app:app`` command instead of the ``app:app`` one.
+
+Usage: python -m benchmarks.loadtest --workers 1 --threads 8 --concurrency 16 --requests 200 \\
+           --tables 4 --latency 0.02 --extract-seconds 0.5 --output results.json
+"""
+import argparse
+import concurrent.futures
+import json
+import os
+import re
+import shlex
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+from time import monotonic, perf_counter, sleep
+from typing import Dict, List, Optional
+
+import requests
+
+from benchmarks.emulator import Emulator, endpoint, expected_csv, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROJECT = "loadtest-project"
+BUCKET = "loadtest-bucket"
+DATASET = "loadtest"
+IN_FLIGHT = re.compile(r"^http_requests_in_flight (?P<value>\S+)$", re.MULTILINE)
+
+
+def gunicorn_command(port: int, workers: Optional[int], threads: Optional[int], process: str = "web") -> List[str]:
+    """
+    :param process: the process type of the Procfile
+    :return: the command of the process, bound to ``port``, with the workers and threads overridden if given
+    """
+    with open(os.path.join(ROOT, "Procfile")) as file:
+        line = next(line for line in file if line.startswith(process + ":"))
+    args = shlex.split(line[len(process) + 1:])
+    overrides = {"--bind": "127.0.0.1:{}".format(port), "--workers": workers, "--threads": threads}
+    for option, value in overrides.items():
+        if value is None:
+            continue
+        if option in args:
+            args[args.index(option) + 1] = str(value)
+        else:
+            args[1:1] = [option, str(value)]
+    # the gunicorn of this interpreter
+    return [sys.executable, "-m"] + args
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("gunicorn exited with status {}".format(process.returncode))
+        try:
+            if requests.get(url + "/", timeout=1).status_code == 200:
+                return
+        except requests.ConnectionError:
+            pass
+        sleep(.1)
+    raise TimeoutError("gunicorn not ready in {}s".format(timeout))
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    :param q: the percentile, between 0 and 100
+    :return: the nearest-rank percentile
+    """
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))]
+
+
+class InFlightSampler(threading.Thread):
+    """Scrapes the request threads in use from /metrics, the scrape itself is not counted.
+    A scrape waits for a free thread, its duration grows once the threads are saturated."""
+
+    def __init__(self, url: str, interval: float):
+        super().__init__(name="in-flight-sampler", daemon=True)
+        self.url = url
+        self.interval = interval
+        self.samples: List[float] = []
+        self.seconds: List[float] = []
+        self._done = threading.Event()
+
+    def run(self) -> None:
+        while not self._done.wait(self.interval):
+            start = perf_counter()
+            try:
+                match = IN_FLIGHT.search(requests.get(self.url + "/metrics", timeout=30).text)
+            except requests.RequestException:
+                continue
+            if match:
+                self.samples.append(float(match.group("value")) - 1)
+                self.seconds.append(perf_counter() - start)
+
+    def stop(self) -> None:
+        self._done.set()
+        self.join()
+
+
+def fire(url: str, index: int, tables: int, payload: Dict, retries: int = 0) -> Dict:
+    table = "table_{}".format(index % tables)
+    start = perf_counter()
+    rejected = 0
+    while True:
+        try:
+            response = requests.post("{}/export/{}/{}".format(url, DATASET, table), json=payload, timeout=600)
+            status, body = response.status_code, response.json()
+        except (requests.RequestException, ValueError) as err:
+            status, body = 0, {"error": str(err)}
+        if status != 429 or rejected >= retries:
+            break
+        # shed by the admission control of the app, as a client would do
+        rejected += 1
+        sleep(float(response.headers.get("Retry-After", 1)))
+    return {"table": table, "status": status, "seconds": perf_counter() - start, "body": body, "rejected": rejected}
+
+
+def check_files(emulator: Emulator, results: List[Dict], payload: Dict, timeout: float) -> Dict:
+    """
+    :param timeout: seconds left to the background deletes of the temporary files
+    :return: the final files whose content is not the expected one, and the temporary files left
+    """
+    expected = expected_csv(emulator.shards, emulator.rows, payload["with_header"])
+    paths = {result["body"]["path"] for result in results if result["status"] == 200}
+    mismatched = sorted(path for path in paths
+                        if emulator.get(BUCKET, path[len("gs://{}/".format(BUCKET)):]) != expected)
+    deadline = monotonic() + timeout
+    while emulator.temporaries() and monotonic() < deadline:
+        sleep(.1)
+    return {"mismatched": mismatched, "leftovers": emulator.temporaries()}
+
+
+def run_load(args: argparse.Namespace) -> Dict:
+    emulator = Emulator(args.latency, args.extract_seconds, args.shards, args.rows, args.num_bytes)
+    server = serve(emulator)
+    port = _free_port()
+    url = "http://127.0.0.1:{}".format(port)
+    env = dict(os.environ, STORAGE_EMULATOR_HOST=endpoint(server), BIGQUERY_EMULATOR_HOST=endpoint(server),
+               GOOGLE_CLOUD_PROJECT=PROJECT)
+    command = gunicorn_command(port, args.workers, args.threads, args.process)
+    log = open(args.app_log, "w") if args.app_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    payload = {"project": PROJECT, "bucket": BUCKET, "with_header": True, "force": args.force}
+    try:
+        _wait_ready(url, process)
+        sampler = InFlightSampler(url, args.sample_interval)
+        sampler.start()
+        start = perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            results = list(executor.map(lambda index: fire(url, index, args.tables, payload, args.retries),
+                                        range(args.requests)))
+        elapsed = perf_counter() - start
+        sampler.stop()
+        # before the shutdown, the cleanups run in the background of the worker
+        files = check_files(emulator, results, payload, args.drain_seconds)
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=30)
+        if args.app_log:
+            log.close()
+        server.shutdown()
+
+    # the async workers hold every request on one thread, they are never saturated by threads
+    threads = int(command[command.index("--threads") + 1]) if "--threads" in command else None
+    seconds = [result["seconds"] for result in results]
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    samples, scrapes = sampler.samples or [0.0], sampler.seconds or [0.0]
+    return {
+        "meta": {
+            "process": args.process, "command": " ".join(command[2:]), "concurrency": args.concurrency, "requests": args.requests,
+            "tables": args.tables, "force": args.force, "latency": args.latency,
+            "extract_seconds": args.extract_seconds, "shards": args.shards, "rows": args.rows,
+            "num_bytes": args.num_bytes,
+        },
+        "statuses": statuses,
+        "rejected": sum(result["rejected"] for result in results),
+        "throughput": len(results) / elapsed,
+        "seconds": {"p50": percentile(seconds, 50), "p95": percentile(seconds, 95), "p99": percentile(seconds, 99),
+                    "max": max(seconds), "mean": statistics.mean(seconds)},
+        # the gauge is per worker, each scrape reads the worker which answered it, saturated when it found
+        # every other thread busy
+        "in_flight": {"max": max(samples), "mean": statistics.mean(samples),
+                      "saturated": sum(sample >= threads - 1 for sample in samples) / len(samples) if threads else 0.0,
+                      "scrape_p95": percentile(scrapes, 95)},
+        "api_calls": dict(emulator.calls),
+        "files": files,
+        "errors": sorted({json.dumps(result["body"]) for result in results if result["status"] != 200})[:10],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--process", default="web", choices=["web", "asgi"], help="the command of the Procfile")
+    parser.add_argument("--workers", type=int, help="overrides the workers of the Procfile")
+    parser.add_argument("--threads", type=int, help="overrides the threads of the Procfile")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--tables", type=int, default=4, help="the requests are spread over this many tables")
+    parser.add_argument("--retries", type=int, default=10, help="retries of a request rejected with 429")
+    parser.add_argument("--force", action="store_true", help="skip the result cache, every request exports")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds waited by every API call")
+    parser.add_argument("--extract-seconds", type=float, default=0.5, help="duration of an extract job")
+    parser.add_argument("--shards", type=int, default=40, help="files written by an extract job")
+    parser.add_argument("--rows", type=int, default=100, help="rows of every file")
+    parser.add_argument("--num-bytes", type=int, help="size of the tables, picks the plan of the exports")
+    parser.add_argument("--sample-interval", type=float, default=0.1, help="seconds between two /metrics scrapes")
+    parser.add_argument("--drain-seconds", type=float, default=30.0,
+                        help="seconds left to the background cleanups once the requests are answered")
+    parser.add_argument("--app-log", help="file receiving the output of gunicorn, dropped by default")
+    parser.add_argument("--output", help="json file of the results, stdout by default")
+    args = parser.parse_args()
+
+    report = run_load(args)
+    print("{} requests {} after {} rejections in {:.1f} req/s, p50={:.3f}s p95={:.3f}s p99={:.3f}s, "
+          "in flight max={:.0f} mean={:.1f} saturated={:.0%} scrape p95={:.3f}s, {} mismatched files, {} leftovers".format(
+              args.requests, report["statuses"], report["rejected"], report["throughput"], report["seconds"]["p50"],
+              report["seconds"]["p95"], report["seconds"]["p99"], report["in_flight"]["max"],
+              report["in_flight"]["mean"], report["in_flight"]["saturated"], report["in_flight"]["scrape_p95"], len(report["files"]["mismatched"]),
+              len(report["files"]["leftovers"])), file=sys.stderr)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    failed = set(report["statuses"]) != {"200"} or report["files"]["mismatched"] or report["files"]["leftovers"]
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Micro-benchmarks of the compose and delete hot paths against the in-memory fake GCS.
+
+Each benchmark runs on fresh shards, ``--repeat`` times per shard count, and the
+results are written as json to compare runs with ``benchmarks.compare``.
+
+Usage: python -m benchmarks.suite --shards 10 100 1000 10000 --latency 0.01 \\
+           --rate-limit compose=200 --rate-limit batch=50 --output results.json
+"""
+import argparse
+import concurrent.futures
+import json
+import platform
+import statistics
+import subprocess
+import sys
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+from unittest.mock import patch
+
+import structlog
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.compose import compose_file, delete_objects_concurrent, generate_chunks
+from utils.ratelimit import MutationScheduler
+
+BUCKET = "bench-bucket"
+PREFIX = "dataset/tmp/table/partition"
+FILE_URI = f"gs://{BUCKET}/dataset/export.csv"
+HEADER = ["col1", "col2"]
+SHARDS = [10, 100, 1000, 10000]
+
+
+def bench_generate_chunks(client: FakeStorageClient, shards: int) -> Callable[[], None]:
+    blobs = client.add_shards(BUCKET, PREFIX, shards)
+    return lambda: generate_chunks(blobs)
+
+
+def bench_compose_file(client: FakeStorageClient, shards: int) -> Callable[[], None]:
+    blobs = client.add_shards(BUCKET, PREFIX, shards)
+
+    def run() -> None:
+        with patch_storage(client):
+            compose_file(FILE_URI, blobs, client, HEADER)
+        assert len(client.objects) == 1, "temporary files left"
+
+    return run
+
+
+def bench_delete_objects_concurrent(client: FakeStorageClient, shards: int) -> Callable[[], None]:
+    blobs = client.add_shards(BUCKET, PREFIX, shards)
+
+    def run() -> None:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
+            summary = delete_objects_concurrent(blobs, executor, client)
+        assert summary["deleted"] == shards, summary
+
+    return run
+
+
+# the setup of each benchmark, and the number of calls timed together, the pure cpu ones are too fast to time once
+BENCHMARKS = {
+    "generate_chunks": (bench_generate_chunks, 1000),
+    "compose_file": (bench_compose_file, 1),
+    "delete_objects_concurrent": (bench_delete_objects_concurrent, 1),
+}
+
+
+def measure(setup: Callable[[FakeStorageClient, int], Callable[[], None]], number: int, shards: int, repeat: int,
+            latency: float, rate_limits: Dict[str, float]) -> Dict:
+    """
+    :param setup: prepares the shards on a fresh client and returns the measured call
+    :param number: the number of calls timed together, their mean is reported
+    :return: the timings of a call and the GCS calls of the last one
+    """
+    timings = []
+    calls = {}
+    for _ in range(repeat):
+        client = FakeStorageClient(latency=latency, rate_limits=rate_limits)
+        run = setup(client, shards)
+        client.calls.clear()
+        # the pacing of the mutations starts afresh with the fake service
+        with patch("utils.compose.scheduler", MutationScheduler()):
+            start = perf_counter()
+            for _ in range(number):
+                run()
+            timings.append((perf_counter() - start) / number)
+        calls = dict(client.calls)
+    return {
+        "seconds": {"min": min(timings), "median": statistics.median(timings), "max": max(timings)},
+        "calls": calls,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run_suite(benchmarks: List[str], shards: List[int], repeat: int, latency: float,
+              rate_limits: Dict[str, float]) -> Dict:
+    results = []
+    for name in benchmarks:
+        for count in shards:
+            setup, number = BENCHMARKS[name]
+            result = dict(benchmark=name, shards=count, **measure(setup, number, count, repeat, latency,
+                                                                   rate_limits))
+            print("{:<26} shards={:>6} median={:10.6f}s min={:10.6f}s calls={}".format(
+                name, count, result["seconds"]["median"], result["seconds"]["min"], result["calls"]),
+                file=sys.stderr)
+            results.append(result)
+    return {
+        "meta": {
+            "commit": _git_commit(),
+            "created": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "latency": latency,
+            "rate_limits": rate_limits,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def _rate_limit(value: str):
+    method, _, rate = value.partition("=")
+    return method, float(rate)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--shards", type=int, nargs="+", default=SHARDS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated seconds per GCS call")
+    parser.add_argument("--rate-limit", type=_rate_limit, action="append", default=[],
+                        help="METHOD=CALLS_PER_SECOND, METHOD among upload, compose, delete, batch, list")
+    parser.add_argument("--output", help="json file of the results, stdout by default")
+    args = parser.parse_args()
+    # the processors still run, the events are neither queued nor rendered
+    structlog.configure(logger_factory=structlog.ReturnLoggerFactory())
+
+    report = run_suite(args.benchmarks, args.shards, args.repeat, args.latency, dict(args.rate_limit))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""Benchmark the per-log-line cost of ``trace_modifier`` with and without the metadata cache.
+
+google.auth.default() resolves throwaway authorized_user credentials from a
+temporary file, the cheapest discovery path: on Cloud Run the uncached lookup
+also queries the metadata server.
+
+Usage: python -m benchmarks.trace_logging --lines 10000
+"""
+import argparse
+import json
+import os
+import tempfile
+from time import perf_counter
+
+from flask import Flask
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=10000)
+    args = parser.parse_args()
+
+    credentials = {"type": "authorized_user", "client_id": "id", "client_secret": "secret",
+                   "refresh_token": "token", "quota_project_id": "bench-project"}
+    with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+        json.dump(credentials, f)
+    os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = f.name
+    os.environ["GOOGLE_CLOUD_PROJECT"] = "bench-project"
+
+    from utils import metadata
+    from utils.logging import trace_modifier
+
+    app = Flask(__name__)
+    try:
+        with app.test_request_context(headers={"X-Cloud-Trace-Context": "105445aa7843bc8bf206b12000100000/1;o=1"}):
+            for name, ttl in (("uncached", 0), ("cached", metadata.METADATA_TTL)):
+                metadata.project_id.ttl = ttl
+                metadata.project_id.invalidate()
+                start = perf_counter()
+                for _ in range(args.lines):
+                    trace_modifier(None, "info", {"message": "Deleting slice"})
+                elapsed = perf_counter() - start
+                print("{:>8}: {:9.2f} us per log line".format(name, elapsed / args.lines * 1e6))
+    finally:
+        os.unlink(f.name)
+
+
+if __name__ == "__main__":
+    main()
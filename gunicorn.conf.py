@@ -0,0 +1,26 @@
+# Gunicorn loads ./gunicorn.conf.py automatically, the command line of the
+# Dockerfile and Procfile still sets the bind address, workers and threads.
+# https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+
+
+def post_fork(server, worker) -> None:  # noqa: ANN001
+    """Profile the boot of the worker, from the import of the app"""
+    from utils.startup import profile
+
+    profile.start()
+    profile.begin("app_import")
+
+
+def post_worker_init(worker) -> None:  # noqa: ANN001
+    """Warm the shared clients of the worker in the background, it accepts requests meanwhile"""
+    import threading
+
+    from utils.clients import pool_size, registry
+    from utils.startup import profile, warm_up
+
+    profile.end("app_import")
+
+    # the async workers of asgi_app have a single thread, their threaded exports keep the default pool
+    if worker.cfg.threads > 1:
+        registry.configure(pool_size=pool_size(worker.cfg.threads))
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
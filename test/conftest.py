@@ -17,6 +17,9 @@ import pytest
 from flask.testing import FlaskClient
 
 from app import app as flask_app
+from utils import checkpoint
+from utils.ratelimit import MutationScheduler
+from utils.table_cache import table_cache
 
 
 @pytest.fixture
@@ -27,3 +30,28 @@ def app() -> None:
 @pytest.fixture
 def client(app: flask.app.Flask) -> FlaskClient:
     return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def scheduler(monkeypatch) -> MutationScheduler:
+    """The tests write the same objects again and again, faster than GCS would allow"""
+    scheduler = MutationScheduler(object_rate=1e6, object_burst=1e6, bucket_rate=1e6, bucket_burst=1e6)
+    monkeypatch.setattr("utils.compose.scheduler", scheduler)
+    monkeypatch.setattr("utils.aio_export.scheduler", scheduler)
+    monkeypatch.setattr("utils.checkpoint.scheduler", scheduler)
+    monkeypatch.setattr("utils.jobs.scheduler", scheduler)
+    return scheduler
+
+
+@pytest.fixture(autouse=True)
+def terminating() -> None:
+    """The shutdown of the ASGI app in a test stops the exports of the next tests"""
+    yield checkpoint.terminating
+    checkpoint.terminating.clear()
+
+
+@pytest.fixture(autouse=True)
+def tables() -> None:
+    """The tests reuse the same table names with other schemas and sizes"""
+    yield table_cache
+    table_cache.clear()
@@ -0,0 +1,90 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from utils.admission import SHARD_BYTES, AdmissionController, Overloaded, cached_table_bytes, estimate_shards
+from utils.export import ExportConfig
+from utils.table_cache import table_cache
+
+
+def test_estimate_shards():
+    assert estimate_shards(None) == 1
+    assert estimate_shards(0) == 1
+    assert estimate_shards(SHARD_BYTES + 1) == 2
+
+
+def test_identical_exports_share_their_admission():
+    admission = AdmissionController(max_exports=1)
+    first = admission.admit("key", 10)
+    second = admission.admit("key", 10)
+    assert first is second
+    with pytest.raises(Overloaded):
+        admission.admit("other", 1)
+    with first:
+        pass
+    # still held by the second request
+    with pytest.raises(Overloaded):
+        admission.admit("other", 1)
+    with second:
+        pass
+    with admission.admit("other", 1):
+        pass
+
+
+def test_exports_are_bounded_by_their_shards():
+    admission = AdmissionController(max_shards=100)
+    with admission.admit("small", 60):
+        with pytest.raises(Overloaded) as err:
+            admission.admit("medium", 50)
+        assert err.value.retry_after == 5
+    # alone, an export larger than the budget is admitted
+    with admission.admit("large", 500):
+        pass
+
+
+@patch("utils.admission.monotonic")
+def test_retry_after_the_first_export_expected_done(monotonic):
+    admission = AdmissionController(max_exports=1)
+    monotonic.return_value = 0.0
+    with admission.admit("first", 10):
+        monotonic.return_value = 20.0
+    # 2 seconds per shard
+    admission.admit("second", 10)
+    monotonic.return_value = 25.0
+    with pytest.raises(Overloaded) as err:
+        admission.admit("third", 1)
+    assert err.value.retry_after == 15
+
+
+def test_batch_is_admitted_as_a_whole():
+    admission = AdmissionController(max_shards=10)
+    configs = [ExportConfig.from_payload("dataset", table_id, {}) for table_id in ["a", "b"]]
+    with admission.admit_batch(configs, [4 * SHARD_BYTES, None]) as ticket:
+        assert ticket.shards == 5
+        assert admission.admit_batch(list(reversed(configs)), [4 * SHARD_BYTES, None]) is ticket
+        with pytest.raises(Overloaded):
+            admission.admit_export(ExportConfig.from_payload("dataset", "c", {}), 6 * SHARD_BYTES)
+        admission.release(ticket)
+
+
+def test_exports_holding_no_thread_are_bound_by_their_shards_only():
+    admission = AdmissionController(max_exports=1, max_shards=10)
+    with admission.admit("request", 1):
+        with pytest.raises(Overloaded):
+            admission.admit("another request", 1)
+        jobs = [admission.admit("job {}".format(i), 1, threaded=False) for i in range(9)]
+        with pytest.raises(Overloaded):
+            admission.admit("job 9", 1, threaded=False)
+        for ticket in jobs:
+            admission.release(ticket)
+
+
+def test_batch_sizes_are_read_from_the_cache_only():
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project"})
+    table_cache.clear()
+    assert cached_table_bytes(config) is None
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value.num_bytes = 10
+    table_cache.get(bigquery_client, "project", "dataset", "table")
+    assert cached_table_bytes(config) == 10
+    table_cache.clear()
@@ -0,0 +1,198 @@
+import asyncio
+import uuid
+from unittest.mock import patch
+
+import pytest
+
+from benchmarks.emulator import Emulator, endpoint, expected_csv, serve
+from utils import aio_export, checkpoint, metrics, pipeline
+from utils.aio import AsyncClient
+from utils.checkpoint import Terminated
+from utils.compose import compose_progress
+from utils.export import ExportConfig
+
+
+@pytest.fixture
+def emulator(monkeypatch):
+    emulator = Emulator(shards=40, rows=3)
+    server = serve(emulator)
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", endpoint(server))
+    monkeypatch.setenv("BIGQUERY_EMULATOR_HOST", endpoint(server))
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "project")
+    yield emulator
+    server.shutdown()
+
+
+async def settle():
+    """Wait for the temporary files deleted in the background, before the client is closed"""
+    await asyncio.gather(*pipeline._background_tasks)
+
+
+def test_is_native():
+    assert aio_export.is_native(ExportConfig.from_payload("dataset", "table", {}))
+    assert not aio_export.is_native(ExportConfig.from_payload("dataset", "table", {"engine": "storage_read"}))
+
+
+def test_concurrent_exports_are_coalesced(emulator):
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project", "bucket": "bucket",
+                                                            "with_header": True})
+
+    async def export():
+        client = AsyncClient()
+        results = await asyncio.gather(*[aio_export.export_once(config, client) for _ in range(3)])
+        cached = await aio_export.export_once(config, client)
+        await settle()
+        await client.aclose()
+        return results, cached
+
+    results, cached = asyncio.run(export())
+    assert emulator.get("bucket", config.file_path) == expected_csv(40, 3)
+    assert sum(result.get("coalesced", False) for result in results) == 2
+    assert cached["cached"]
+    assert emulator.calls["POST /bigquery/v2/projects/project/jobs"] == 1
+    # 41 sources, composed in two rounds
+    assert emulator.calls["POST /storage/v1/b/bucket/o/*/compose"] == 3
+    assert emulator.temporaries() == []
+
+
+def test_query_results_are_created_with_their_expiration(emulator):
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project", "bucket": "bucket",
+                                                            "query": "SELECT id, name FROM dataset.table"})
+
+    async def export():
+        client = AsyncClient()
+        await aio_export.run_export(config, client)
+        await settle()
+        await client.aclose()
+
+    asyncio.run(export())
+    # the query wrote into a table which already had its expiration
+    [query] = emulator.queries
+    assert query["destinationTable"]["tableId"].startswith("_export_tmp_")
+    assert query["expirationTime"] is not None
+    assert emulator.tables == {}
+
+
+def test_failed_export_cancels_its_extract_job(emulator):
+    emulator.extract_seconds = 30
+    emulator.errors["POST /upload/storage/v1/b/bucket/o"] = [400]
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project", "bucket": "bucket",
+                                                            "with_header": True})
+
+    async def export():
+        client = AsyncClient()
+        with pytest.raises(Exception):
+            await aio_export.run_export(config, client)
+        await settle()
+        await client.aclose()
+
+    asyncio.run(export())
+    # the header upload failed while the extract job ran
+    assert emulator.calls["POST /bigquery/v2/projects/project/jobs/*/cancel"] == 1
+    assert emulator.temporaries() == []
+
+
+@pytest.mark.parametrize("num_bytes, strategy, composes", [(1 << 10, "tiny", 1), (1 << 40, "huge", 3)])
+def test_export_follows_the_plan(emulator, num_bytes, strategy, composes):
+    emulator.num_bytes = num_bytes
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project", "bucket": "bucket",
+                                                            "with_header": True})
+
+    async def export():
+        client = AsyncClient()
+        result = await aio_export.export_once(config, client)
+        await settle()
+        await client.aclose()
+        return result
+
+    result = asyncio.run(export())
+    assert result["plan"]["strategy"] == strategy
+    assert emulator.get("bucket", config.file_path) == expected_csv(40, 3)
+    assert emulator.calls.get("GET /storage/v1/b/bucket/o", 0) == (0 if strategy == "tiny" else 1)
+    assert emulator.calls["POST /storage/v1/b/bucket/o/*/compose"] == composes
+
+
+def test_compose_tree_keeps_the_order(emulator):
+    async def compose():
+        client = AsyncClient()
+        for i in range(70):
+            await client.upload("bucket", "part-{:03d}".format(i), str(i).encode("utf-8"))
+        sources = await client.list_objects("bucket", "part-")
+        intermediates = await aio_export.compose_tree(client, "bucket", "final", sources, fan_in=4)
+        summary = await aio_export.delete_objects(client, "bucket", intermediates)
+        await client.aclose()
+        return summary
+
+    summary = asyncio.run(compose())
+    assert emulator.get("bucket", "final") == "".join(str(i) for i in range(70)).encode("utf-8")
+    assert summary["failed"] == []
+    assert emulator.temporaries() == []
+
+
+def test_throttled_composes_are_retried_by_the_scheduler(emulator):
+    retries = metrics.registry.get_sample_value("gcs_mutation_retries_total", {"status": "429"}) or 0
+    emulator.errors["POST /storage/v1/b/bucket/o/*/compose"] = [429, 429]
+
+    async def compose():
+        client = AsyncClient()
+        for i in range(10):
+            await client.upload("bucket", "part-{:03d}".format(i), str(i).encode("utf-8"))
+        sources = await client.list_objects("bucket", "part-")
+        await aio_export.compose_tree(client, "bucket", "final", sources, fan_in=4)
+        await client.aclose()
+
+    asyncio.run(compose())
+    assert emulator.get("bucket", "final") == "".join(str(i) for i in range(10)).encode("utf-8")
+    # 3 composites and the final compose, the throttled ones retried once by the scheduler, not by the client
+    assert emulator.calls["POST /storage/v1/b/bucket/o/*/compose"] == 4 + 2
+    assert metrics.registry.get_sample_value("gcs_mutation_retries_total", {"status": "429"}) == retries + 2
+
+
+def test_run_job_attaches_to_the_inserted_job(emulator):
+    extract = {"sourceTable": {"projectId": "project", "datasetId": "dataset", "tableId": "table"},
+               "destinationUris": ["gs://bucket/part-*.csv"], "destinationFormat": "CSV"}
+
+    async def run():
+        client = AsyncClient()
+        # the insert applied before the answer was lost, the retry finds the job
+        await client.request("POST", "{}/bigquery/v2/projects/project/jobs".format(client.bigquery_api), json={
+            "jobReference": {"jobId": "export_" + "0" * 32}, "configuration": {"extract": extract}})
+        with patch("utils.aio.uuid.uuid4", return_value=uuid.UUID(int=0)):
+            job = await client.run_job("project", "US", {"extract": extract})
+        await client.aclose()
+        return job
+
+    job = asyncio.run(run())
+    assert job["status"]["state"] == "DONE"
+    assert emulator.calls["POST /bigquery/v2/projects/project/jobs"] == 2
+    assert len(emulator.jobs) == 1
+
+
+def test_export_resumes_after_termination(emulator):
+    payload = {"project": "project", "bucket": "bucket", "with_header": True}
+    config = ExportConfig.from_payload("dataset", "table", payload)
+
+    def round_then_terminate(*args):
+        checkpoint.terminating.set()
+        return compose_progress(*args)
+
+    async def export():
+        client = AsyncClient()
+        with patch("utils.aio_export.compose_progress", side_effect=round_then_terminate), \
+                pytest.raises(Terminated):
+            await aio_export.export_once(config, client)
+        checkpoint.terminating.clear()
+        composes = emulator.calls["POST /storage/v1/b/bucket/o/*/compose"]
+        # a retry of the same export, with a run of its own
+        await aio_export.export_once(ExportConfig.from_payload("dataset", "table", payload), client)
+        await settle()
+        await client.aclose()
+        return composes
+
+    composes = asyncio.run(export())
+    assert emulator.calls["POST /bigquery/v2/projects/project/jobs"] == 1
+    assert list(emulator.jobs) == ["export_{}".format(config.run_id)]
+    # only the final compose of the two composites of the first round
+    assert emulator.calls["POST /storage/v1/b/bucket/o/*/compose"] == composes + 1
+    assert emulator.get("bucket", config.file_path) == expected_csv(40, 3)
+    assert emulator.temporaries() == []
@@ -15,9 +15,22 @@ from datetime import date
 from unittest.mock import patch
 
 import flask
+import pytest
 from flask import json
 from flask.testing import FlaskClient
 
+from utils.admission import AdmissionController
+from utils.export import ExportConfig
+
+
+@pytest.fixture(autouse=True)
+def admission(monkeypatch) -> AdmissionController:
+    """An admission controller of its own for each test, which does not look up the size of the tables"""
+    controller = AdmissionController()
+    monkeypatch.setattr("app.admission", controller)
+    monkeypatch.setattr("app.table_bytes", lambda config, bigquery_client: 0)
+    return controller
+
 
 def test_get_index(app: flask.app.Flask, client: FlaskClient) -> None:
     res = client.get("/")
@@ -29,13 +42,9 @@ def test_post_index(app: flask.app.Flask, client: FlaskClient) -> None:
     assert res.status_code == 405
 
 
-@patch("app.compose_file")
-@patch("app.bq_header")
-@patch("app.list_file")
-@patch("app.bq_export")
-@patch("app.get_bigquery_client")
-@patch("app.get_gcs_client")
-def test_post_export(get_gcs_client, get_bigquery_client, bq_export, list_file, bq_header, compose_file,
+@patch("app.export_once")
+@patch("app.registry")
+def test_post_export(registry, export_once,
                      app: flask.app.Flask,
                      client: FlaskClient) -> None:
     # initialise json input data
@@ -52,29 +61,25 @@ def test_post_export(get_gcs_client, get_bigquery_client, bq_export, list_file,
 
     # Create test variables
     file_name: str = "export-{}-{}".format(table_id, date.today().isoformat())
-    temp_file_prefix: str = f'{dataset_id}/tmp/{table_id}/partition'
-    temp_destination_uri: str = f'gs://{json_input["bucket"]}/{dataset_id}/tmp/{table_id}/partition*.csv'
     file_path: str = f'{dataset_id}/{file_name}.csv'
     file_uri: str = "gs://{}/{}".format(json_input["bucket"], file_path)
-    list_file.return_value = [x for x in range(100)]
-    bq_header.return_value = ['header1', 'header_2']
+    export_once.return_value = {"path": file_uri}
 
     # Get cloud clients
-    storage_client = get_gcs_client.return_value
-    bigquery_client = get_bigquery_client.return_value
+    storage_client = registry.gcs_client.return_value
+    bigquery_client = registry.bigquery_client.return_value
 
     # Test POST API
     response = client.post(f"/export/{dataset_id}/{table_id}", json=json_input)
     data = json.loads(response.data)
 
     # Assertions
-    get_gcs_client.assert_called_once_with()
-    get_bigquery_client.assert_called_once_with()
-    bq_export.assert_called_once_with(json_input["project"], dataset_id, table_id, json_input["location"],
-                                      temp_destination_uri, bigquery_client)
-    list_file.assert_called_once_with(json_input["bucket"], temp_file_prefix, storage_client)
-    bq_header.assert_called_once_with(json_input["project"], dataset_id, table_id, bigquery_client)
-    compose_file.assert_called_once_with(file_uri, list_file(), storage_client, bq_header())
+    registry.gcs_client.assert_called_once_with()
+    registry.bigquery_client.assert_called_once_with()
+    config = ExportConfig(project=json_input["project"], dataset_id=dataset_id, table_id=table_id,
+                          bucket=json_input["bucket"], location=json_input["location"], folder=dataset_id,
+                          file_name=file_name, with_header="false")
+    export_once.assert_called_once_with(config, storage_client, bigquery_client, None)
 
     assert response.status_code == 200
     assert data["status"] == 200
@@ -89,3 +94,98 @@ def test_export_is_no_json(client: FlaskClient):
     assert response.status_code == 400
     assert data["status"] == 400
     assert data["error"] == "Content-Type must be application/json"
+
+
+@patch("app.jobs")
+@patch("app.registry")
+def test_post_export_async(registry, jobs, client: FlaskClient) -> None:
+    job = jobs.submit.return_value
+    job.id = "job_id"
+    response = client.post("/export/dataset_id/table_id", json={"async": True})
+    data = json.loads(response.data)
+    jobs.submit.assert_called_once()
+    assert response.status_code == 202
+    assert response.headers["Location"] == "/jobs/job_id"
+    assert data["job_id"] == "job_id"
+
+
+@patch("app.jobs")
+def test_get_job(jobs, client: FlaskClient) -> None:
+    jobs.get.return_value.to_dict.return_value = {"job_id": "job_id", "status": "running"}
+    response = client.get("/jobs/job_id")
+    jobs.get.assert_called_once_with("job_id")
+    assert response.status_code == 200
+    assert json.loads(response.data)["status"] == "running"
+
+
+@patch("app.jobs")
+def test_get_job_not_found(jobs, client: FlaskClient) -> None:
+    jobs.get.return_value = None
+    response = client.get("/jobs/job_id")
+    assert response.status_code == 404
+
+
+@patch("app.export_batch")
+@patch("app.registry")
+def test_post_export_batch(registry, export_batch, client: FlaskClient) -> None:
+    export_batch.return_value = {"tables": 2, "succeeded": 2, "failed": 0, "results": []}
+    response = client.post("/export/batch", json={"tables": ["dataset.table_1", "dataset.table_2"]})
+    data = json.loads(response.data)
+    configs = export_batch.call_args.args[0]
+    assert [config.table_id for config in configs] == ["table_1", "table_2"]
+    assert response.status_code == 200
+    assert data["succeeded"] == 2
+
+
+def test_post_export_batch_bad_request(client: FlaskClient) -> None:
+    with patch("app.registry"):
+        response = client.post("/export/batch", json={})
+    assert response.status_code == 400
+
+
+@patch("app.export_once")
+@patch("app.registry")
+def test_post_export_over_capacity(registry, export_once, admission: AdmissionController,
+                                   client: FlaskClient) -> None:
+    admission.max_exports = 1
+    admission.admit("another export", 1)
+    response = client.post("/export/dataset_id/table_id", json={})
+    export_once.assert_not_called()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+
+
+@patch("app.export_batch")
+@patch("app.registry")
+def test_post_export_batch_over_capacity(registry, export_batch, admission: AdmissionController,
+                                         client: FlaskClient) -> None:
+    admission.max_exports = 1
+    admission.admit("another export", 1)
+    response = client.post("/export/batch", json={"tables": ["dataset.table_1", "dataset.table_2"]})
+    export_batch.assert_not_called()
+    assert response.status_code == 429
+
+
+@patch("app.jobs")
+@patch("app.registry")
+def test_async_exports_are_not_bound_by_the_threads(registry, jobs, admission: AdmissionController,
+                                                    client: FlaskClient) -> None:
+    admission.max_exports = 1
+    jobs.submit.return_value.id = "job"
+    admission.admit("another export", 1)
+    response = client.post("/export/dataset_id/table_id", json={"async": True})
+    assert response.status_code == 202
+    response = client.post("/export/batch", json={"tables": ["dataset.table_1"], "async": True})
+    assert response.status_code == 202
+
+
+@patch("app.jobs")
+@patch("app.registry")
+def test_admission_is_released_when_the_job_is_not_submitted(registry, jobs, admission: AdmissionController,
+                                                             client: FlaskClient) -> None:
+    admission.max_shards = 1
+    jobs.submit.side_effect = RuntimeError("cannot schedule new futures after shutdown")
+    response = client.post("/export/dataset_id/table_id", json={"async": True})
+    assert response.status_code == 500
+    with admission.admit("another export", 1):
+        pass
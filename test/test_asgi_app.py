@@ -0,0 +1,102 @@
+from unittest.mock import AsyncMock, patch
+
+import pytest
+from google.api_core.exceptions import NotFound
+from starlette.testclient import TestClient
+
+from asgi_app import app
+from utils.admission import AdmissionController
+
+
+@pytest.fixture(autouse=True)
+def admission(monkeypatch) -> AdmissionController:
+    """An admission controller of its own for each test, which does not look up the size of the tables"""
+    controller = AdmissionController()
+    monkeypatch.setattr("asgi_app.admission", controller)
+    monkeypatch.setattr("asgi_app._table_bytes", AsyncMock(return_value=0))
+    return controller
+
+
+@pytest.fixture
+def client() -> TestClient:
+    with TestClient(app, raise_server_exceptions=False) as client:
+        yield client
+
+
+@patch("asgi_app.aio_export.export_once", new_callable=AsyncMock)
+def test_post_export(export_once, client: TestClient) -> None:
+    export_once.return_value = {"path": "gs://bucket/dataset_id/file.csv"}
+    response = client.post("/export/dataset_id/table_id", json={"bucket": "bucket"})
+    config = export_once.call_args.args[0]
+    assert (config.dataset_id, config.table_id, config.bucket) == ("dataset_id", "table_id", "bucket")
+    assert response.status_code == 200
+    assert response.json() == {"status": 200, "path": "gs://bucket/dataset_id/file.csv", "cached": False}
+
+
+@patch("asgi_app.export_once")
+@patch("asgi_app.registry")
+def test_post_export_in_a_thread(registry, export_once, client: TestClient) -> None:
+    export_once.return_value = {"path": "gs://bucket/file.csv", "cached": True}
+    response = client.post("/export/dataset_id/table_id", json={"engine": "storage_read"})
+    export_once.assert_called_once()
+    assert response.json()["cached"]
+
+
+def test_export_is_no_json(client: TestClient) -> None:
+    response = client.post("/export/dataset_id/table_id")
+    assert response.status_code == 400
+    assert response.json() == {"status": 400, "error": "Content-Type must be application/json"}
+
+
+@patch("asgi_app.jobs")
+def test_post_export_async(jobs, client: TestClient) -> None:
+    jobs.submit_async.return_value.id = "job_id"
+    response = client.post("/export/dataset_id/table_id", json={"async": True})
+    jobs.submit_async.assert_called_once()
+    assert response.status_code == 202
+    assert response.headers["Location"] == "/jobs/job_id"
+    assert response.json()["job_id"] == "job_id"
+
+
+@patch("asgi_app.jobs")
+def test_get_job_not_found(jobs, client: TestClient) -> None:
+    jobs.get.return_value = None
+    response = client.get("/jobs/job_id")
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize("error, status, body", [
+    (NotFound("table"), 404, {"error": "URI,Location, or Project is wrong"}),
+    (ValueError("file not found"), 400, {"error": "file uri not found"}),
+    (RuntimeError("boom"), 500, {"error": "Sorry, internal error, please check logs"}),
+])
+def test_errors(error, status, body, client: TestClient) -> None:
+    with patch("asgi_app.aio_export.export_once", new_callable=AsyncMock, side_effect=error):
+        response = client.post("/export/dataset_id/table_id", json={})
+    assert response.status_code == status
+    assert response.json() == body
+
+
+def test_post_export_batch_bad_request(client: TestClient) -> None:
+    with patch("asgi_app.registry"):
+        response = client.post("/export/batch", json={})
+    assert response.status_code == 400
+
+
+def test_requests_are_labelled_by_route(client: TestClient) -> None:
+    client.get("/jobs/unknown")
+    assert 'route="/jobs/<job_id>"' in client.get("/metrics").text
+
+
+@patch("asgi_app.export_batch")
+@patch("asgi_app.registry")
+def test_post_export_batch_over_capacity(registry, export_batch, admission: AdmissionController,
+                                         client: TestClient) -> None:
+    # the exports of the service hold no thread, only their shards bound them
+    admission.max_exports = 0
+    admission.max_shards = 2
+    admission.admit("another export", 1, threaded=False)
+    response = client.post("/export/batch", json={"tables": ["dataset.table_1", "dataset.table_2"]})
+    export_batch.assert_not_called()
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
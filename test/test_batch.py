@@ -0,0 +1,72 @@
+import threading
+from time import sleep
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import BadRequest
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.batch import batch_configs, export_batch
+
+
+def test_batch_configs_from_tables():
+    payload = {"bucket": "bucket", "format": "ndjson", "file_name": "ignored",
+               "tables": ["dataset_1.table_1", {"dataset": "dataset_2", "table": "table_2", "file_name": "custom"}]}
+    configs = batch_configs(payload, MagicMock())
+    assert [(config.dataset_id, config.table_id) for config in configs] == [("dataset_1", "table_1"),
+                                                                          ("dataset_2", "table_2")]
+    assert all(config.bucket == "bucket" and config.format == "ndjson" for config in configs)
+    assert configs[0].file_name.startswith("export-table_1-")
+    assert configs[1].file_name == "custom"
+
+
+def test_batch_configs_from_dataset():
+    bigquery_client = MagicMock()
+    table, view = MagicMock(table_id="table_1", table_type="TABLE"), MagicMock(table_id="view", table_type="VIEW")
+    query_result = MagicMock(table_id="_export_tmp_0123", table_type="TABLE")
+    bigquery_client.list_tables.return_value = [table, view, query_result]
+    configs = batch_configs({"project": "project_id", "dataset": "dataset_id"}, bigquery_client)
+    bigquery_client.list_tables.assert_called_once_with("project_id.dataset_id")
+    assert [config.table_id for config in configs] == ["table_1"]
+
+
+@pytest.mark.parametrize("payload", [{}, {"tables": []}, {"tables": ["no_dataset"]}])
+def test_batch_configs_bad_request(payload):
+    with pytest.raises(BadRequest):
+        batch_configs(payload, MagicMock())
+
+
+def test_export_batch_limits_extracts():
+    storage_client = FakeStorageClient()
+    configs = batch_configs({"bucket": "bucket", "format": "ndjson",
+                             "tables": ["dataset.table_{}".format(i) for i in range(6)]}, MagicMock())
+    running, peak, lock = [0], [0], threading.Lock()
+
+    def extract_table(table_ref, destination_uris, **kwargs):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        sleep(.05)
+        with lock:
+            running[0] -= 1
+        if table_ref.table_id == "table_3":
+            raise ValueError("extract failed")
+        prefix = destination_uris[0][len("gs://bucket/"):-len("*.json")]
+        storage_client.add_shards("bucket", prefix, 2)
+        return MagicMock()
+
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = MagicMock(full_table_id="project:dataset.table", modified=None,
+                                                       schema=[], streaming_buffer=None, num_bytes=None,
+                                                       num_rows=None)
+    bigquery_client.extract_table.side_effect = extract_table
+
+    with patch_storage(storage_client):
+        result = export_batch(configs, storage_client, bigquery_client, stage_limits={"extract": 2})
+
+    assert peak[0] == 2
+    assert result["tables"] == 6
+    assert result["succeeded"] == 5
+    assert result["failed"] == 1
+    failed = [table for table in result["results"] if table["status"] == "failed"]
+    assert failed == [{"table": "dataset.table_3", "status": "failed", "error": "extract failed"}]
@@ -1,10 +1,11 @@
-from unittest.mock import patch, PropertyMock
+from unittest.mock import MagicMock, patch, PropertyMock
 
 import pytest
-from google.api_core.exceptions import NotFound, BadRequest
+from google.api_core.exceptions import BadRequest, Conflict, NotFound
 from google.cloud.bigquery import SchemaField
 
-from utils.bigquery import bq_export, get_bigquery_client, bq_header
+from utils.bigquery import bq_export, get_bigquery_client, bq_header, bq_partitions, bq_query_to_table
+from utils.pipeline import Cancelled
 
 
 @patch("utils.bigquery.bigquery")
@@ -74,6 +75,31 @@ def test_export_bad_request_exception(bigquery):
 
 
 @patch("utils.bigquery.bigquery")
+def test_export_reattaches_to_the_job(bigquery):
+    bigquery_client = bigquery.Client()
+    bigquery_client.extract_table.side_effect = Conflict("Already Exists: Job")
+    job = bigquery_client.get_job.return_value
+    job.result.side_effect = [TimeoutError(), None]
+    poll = MagicMock()
+    bq_export("project_id", "dataset_id", "table_id", "us", "gs://bucket/partition*.csv", bigquery_client,
+              job_id="export_run_1", poll=poll)
+    bigquery_client.get_job.assert_called_once_with("export_run_1", location="us")
+    assert job.result.call_count == 2
+    poll.assert_called_once_with()
+
+
+@patch("utils.bigquery.bigquery")
+def test_export_cancels_the_job_of_a_failed_pipeline(bigquery):
+    bigquery_client = bigquery.Client()
+    job = bigquery_client.extract_table.return_value
+    job.result.side_effect = TimeoutError()
+    with pytest.raises(Cancelled):
+        bq_export("project_id", "dataset_id", "table_id", "us", "gs://bucket/partition*.csv", bigquery_client,
+                  poll=MagicMock(side_effect=Cancelled("failed")))
+    job.cancel.assert_called_once_with()
+
+
+@patch("utils.table_cache.bigquery")
 def test_bq_header(bigquery):
     project = "project_id"
     dataset_id = "dataset_id"
@@ -96,3 +122,47 @@ def test_bq_header(bigquery):
     dataset_ref.table.assert_called_once_with(table_id)
     bigquery_client.get_table.assert_called_once_with(table_ref)
     assert header == ["header1", "header2"]
+    # from the cache
+    assert bq_header(project, dataset_id, table_id, bigquery_client) == header
+    bigquery_client.get_table.assert_called_once()
+
+
+@patch("utils.bigquery.bigquery")
+def test_bq_partitions(bigquery):
+    bigquery_client = bigquery.Client()
+    bigquery_client.query.return_value.result.return_value = [{"partition_id": "20220101", "last_modified": 1},
+                                                              {"partition_id": "20220102", "last_modified": 2}]
+    partitions = bq_partitions("project_id", "dataset_id", "table_id", "us", bigquery_client)
+    bigquery.ScalarQueryParameter.assert_called_once_with("table_name", "STRING", "table_id")
+    query = bigquery_client.query.call_args.args[0]
+    assert "`project_id.dataset_id.INFORMATION_SCHEMA.PARTITIONS`" in query
+    assert bigquery_client.query.call_args.kwargs["location"] == "us"
+    assert partitions == {"20220101": 1, "20220102": 2}
+
+
+@pytest.mark.parametrize("total_rows, expected", [(0, {"20220101": 1}), (3, None), (None, None)])
+@patch("utils.bigquery.bigquery")
+def test_bq_partitions_with_rows_out_of_any_partition(bigquery, total_rows, expected):
+    bigquery_client = bigquery.Client()
+    bigquery_client.query.return_value.result.return_value = [
+        {"partition_id": "20220101", "last_modified": 1, "total_rows": 2},
+        {"partition_id": "__NULL__", "last_modified": 1, "total_rows": total_rows}]
+    assert bq_partitions("project_id", "dataset_id", "table_id", "us", bigquery_client) == expected
+
+
+@patch("utils.bigquery.bigquery")
+def test_bq_query_to_table(bigquery):
+    bigquery_client = bigquery.Client()
+    table_id = bq_query_to_table("project_id", "dataset_id", "SELECT 1", "us", bigquery_client)
+    assert table_id.startswith("_export_tmp_")
+    bigquery.DatasetReference.return_value.table.assert_called_once_with(table_id)
+    table_ref = bigquery.DatasetReference.return_value.table.return_value
+    assert bigquery.QueryJobConfig.call_args.kwargs["destination"] == table_ref
+    bigquery_client.query.assert_called_once_with("SELECT 1", job_config=bigquery.QueryJobConfig.return_value,
+                                                  location="us")
+    # the table is created with its expiration before the query writes it
+    table = bigquery.Table.return_value
+    bigquery.Table.assert_called_once_with(table_ref)
+    bigquery_client.create_table.assert_called_once_with(table, exists_ok=True)
+    assert table.expires is not None
+    bigquery_client.update_table.assert_not_called()
@@ -0,0 +1,124 @@
+import threading
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.cloud import bigquery
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils import checkpoint
+from utils.checkpoint import Checkpoint, Terminated, terminate
+from utils.coalesce import export_once
+from utils.compose import compose_round
+from utils.export import ExportConfig
+
+
+def fake_bigquery(storage_client, shards):
+    table = MagicMock()
+    table.full_table_id = "project:dataset_id.table_id"
+    table.modified = datetime(2022, 1, 1, tzinfo=timezone.utc)
+    table.schema = [bigquery.SchemaField("header1", "STRING")]
+    table.streaming_buffer = None
+    table.num_bytes = None
+    table.num_rows = None
+    table.etag = None
+
+    def extract_table(table_ref, destination_uris, **kwargs):
+        prefix = destination_uris[0][len("gs://bucket/"):-len("*.json")]
+        storage_client.add_shards("bucket", prefix, shards)
+        return MagicMock()
+
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = table
+    bigquery_client.extract_table.side_effect = extract_table
+    return bigquery_client
+
+
+def test_export_resumes_after_termination():
+    payload = {"bucket": "bucket", "format": "ndjson", "file_name": "export"}
+    config = ExportConfig.from_payload("dataset_id", "table_id", payload)
+    storage_client = FakeStorageClient()
+    bigquery_client = fake_bigquery(storage_client, 40)
+
+    def round_then_terminate(*args, **kwargs):
+        composites = compose_round(*args, **kwargs)
+        checkpoint.terminating.set()
+        return composites
+
+    with patch_storage(storage_client):
+        with patch("utils.compose.compose_round", side_effect=round_then_terminate), pytest.raises(Terminated):
+            export_once(config, storage_client, bigquery_client)
+        checkpoint.terminating.clear()
+        composes = storage_client.calls["compose"]
+
+        # a retry of the same export, with a run of its own
+        retry = ExportConfig.from_payload("dataset_id", "table_id", payload)
+        export_once(retry, storage_client, bigquery_client)
+
+    assert bigquery_client.extract_table.call_count == 1
+    assert bigquery_client.extract_table.call_args.kwargs["job_id"] == "export_{}".format(config.run_id)
+    # only the final compose of the two composites of the first round
+    assert storage_client.calls["compose"] == composes + 1
+    assert storage_client.get(("bucket", config.file_path)) == b"".join(b"%d\n" % i for i in range(40))
+    assert not any(name.endswith(".json") and "checkpoint-" in name for _, name in storage_client.objects)
+
+
+def test_outdated_checkpoint_is_dropped():
+    storage_client = FakeStorageClient()
+    uri = "gs://bucket/folder/tmp/table/checkpoint-key.json"
+    with patch_storage(storage_client):
+        first = Checkpoint(uri, storage_client, fingerprint={"source_last_modified": "1"})
+        assert first.resume("run1") == "run1"
+        first.save("extract", "export_run1_1")
+
+        assert Checkpoint(uri, storage_client, fingerprint={"source_last_modified": "1"}).resume("run2") == "run1"
+        changed = Checkpoint(uri, storage_client, fingerprint={"source_last_modified": "2"})
+        assert changed.resume("run3") == "run3"
+        assert changed.get("extract") is None
+
+
+def test_terminate_waits_for_the_running_exports():
+    stopped = []
+
+    def export():
+        with Checkpoint("gs://bucket/checkpoint.json", FakeStorageClient()) as running:
+            try:
+                while True:
+                    running.check()
+                    sleep(.01)
+            except Terminated:
+                stopped.append(True)
+
+    thread = threading.Thread(target=export)
+    thread.start()
+    sleep(.05)
+    assert terminate(timeout=1)
+    thread.join()
+    assert stopped == [True]
+
+
+def test_failed_export_deletes_its_temporary_files():
+    payload = {"bucket": "bucket", "format": "ndjson", "file_name": "export"}
+    config = ExportConfig.from_payload("dataset_id", "table_id", payload)
+    storage_client = FakeStorageClient()
+    # two compose rounds before the final compose
+    bigquery_client = fake_bigquery(storage_client, 32 * 33)
+
+    def fail_in_second_round(blobs, destination, round_index, *args, **kwargs):
+        if round_index == 1:
+            raise ValueError("boom")
+        return compose_round(blobs, destination, round_index, *args, **kwargs)
+
+    with patch_storage(storage_client), \
+            patch("utils.compose.compose_round", side_effect=fail_in_second_round), pytest.raises(ValueError):
+        export_once(config, storage_client, bigquery_client)
+
+    # deleted in the background with the composites of the first round, and the checkpoint, a retry starts over
+    def temporaries():
+        return [name for _, name in storage_client.objects if "/tmp/" in name or ".compose/" in name]
+
+    deadline = monotonic() + 5
+    while temporaries() and monotonic() < deadline:
+        sleep(.01)
+    assert temporaries() == []
@@ -0,0 +1,51 @@
+from unittest.mock import patch
+
+from utils.clients import ClientRegistry, pool_size
+from utils.compose import COMPOSE_WORKERS
+
+
+@patch("utils.clients.get_bigquery_client")
+@patch("utils.clients.get_gcs_client")
+@patch("utils.clients.transport.AuthorizedSession")
+@patch("utils.clients.google.auth.default")
+def test_clients_are_created_once(auth_default, authorized_session, get_gcs_client, get_bigquery_client):
+    credentials = object()
+    auth_default.return_value = (credentials, "project_id")
+    registry = ClientRegistry(pool_size=4)
+
+    assert registry.gcs_client() is registry.gcs_client()
+    assert registry.bigquery_client() is registry.bigquery_client()
+
+    auth_default.assert_called_once()
+    authorized_session.assert_called_once_with(credentials)
+    session = authorized_session.return_value
+    get_gcs_client.assert_called_once_with(project="project_id", credentials=credentials, _http=session)
+    get_bigquery_client.assert_called_once_with(project="project_id", credentials=credentials, _http=session)
+
+
+@patch("utils.clients.transport.AuthorizedSession")
+@patch("utils.clients.google.auth.default")
+def test_pool_size_follows_configure(auth_default, authorized_session):
+    auth_default.return_value = (object(), "project_id")
+    registry = ClientRegistry()
+    registry.configure(pool_size=16)
+    registry.session()
+
+    adapter = authorized_session.return_value.mount.call_args.args[1]
+    assert adapter._pool_connections == 16
+    assert adapter._pool_maxsize == 16
+
+
+def test_pool_size_holds_the_compose_calls_of_every_thread(monkeypatch):
+    monkeypatch.delenv("HTTP_POOL_SIZE", raising=False)
+    assert pool_size(8) == 8 * COMPOSE_WORKERS
+    monkeypatch.setenv("HTTP_POOL_SIZE", "24")
+    assert pool_size(8) == 24
+
+
+@patch("utils.clients.google.auth.default")
+def test_warm_up_failure_is_not_raised(auth_default):
+    auth_default.side_effect = Exception("no credentials")
+    registry = ClientRegistry()
+    registry.warm_up()
+    auth_default.assert_called_once()
@@ -0,0 +1,155 @@
+import asyncio
+import threading
+from datetime import datetime, timezone
+from time import sleep
+from unittest.mock import MagicMock, patch
+
+from google.cloud import bigquery
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.coalesce import GcsLock, SingleFlight, export_once
+from utils.export import ExportConfig
+
+
+def fake_bigquery(storage_client, modified):
+    table = MagicMock()
+    table.full_table_id = "project:dataset_id.table_id"
+    table.modified = modified
+    table.schema = [bigquery.SchemaField("header1", "STRING")]
+    table.streaming_buffer = None
+    table.num_bytes = None
+    table.num_rows = None
+    table.etag = None
+
+    def extract_table(table_ref, destination_uris, **kwargs):
+        sleep(.05)
+        prefix = destination_uris[0][len("gs://bucket/"):-len("*.json")]
+        storage_client.add_shards("bucket", prefix, 2)
+        return MagicMock()
+
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = table
+    bigquery_client.extract_table.side_effect = extract_table
+    return bigquery_client
+
+
+def test_single_flight_shares_concurrent_calls():
+    flights = SingleFlight()
+    barrier = threading.Barrier(4)
+    calls = []
+
+    def work():
+        calls.append(1)
+        sleep(.1)
+        return "result"
+
+    def call():
+        barrier.wait()
+        return flights.do("key", work)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(call())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert sorted(results) == [("result", False)] + [("result", True)] * 3
+
+
+def test_single_flight_is_shared_by_threads_and_the_event_loop():
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+
+    def work():
+        started.set()
+        release.wait(5)
+        return "result"
+
+    thread = threading.Thread(target=flights.do, args=("key", work))
+    thread.start()
+    started.wait(5)
+
+    async def attach():
+        follower = asyncio.ensure_future(flights.ado("key", lambda: asyncio.sleep(0, "other")))
+        await asyncio.sleep(.05)
+        release.set()
+        return await follower
+
+    assert asyncio.run(attach()) == ("result", True)
+    thread.join()
+
+
+def test_gcs_lock_is_exclusive():
+    storage_client = FakeStorageClient()
+    with patch_storage(storage_client):
+        first = GcsLock("gs://bucket/file.lock", storage_client)
+        second = GcsLock("gs://bucket/file.lock", storage_client)
+        assert first.try_acquire()
+        assert not second.try_acquire()
+        first.release()
+        assert second.try_acquire()
+        second.release()
+    assert storage_client.objects == {}
+
+
+def test_gcs_lock_breaks_expired_lease():
+    storage_client = FakeStorageClient()
+    with patch_storage(storage_client):
+        crashed = GcsLock("gs://bucket/file.lock", storage_client, ttl=-1)
+        crashed._write(if_generation_match=0)
+        lock = GcsLock("gs://bucket/file.lock", storage_client)
+        assert not lock.try_acquire()
+        assert lock.try_acquire()
+        lock.release()
+
+
+def test_gcs_lock_renews_lease():
+    storage_client = FakeStorageClient()
+    with patch_storage(storage_client):
+        lock = GcsLock("gs://bucket/file.lock", storage_client, ttl=.15)
+        lock.acquire()
+        generation = lock.generation
+        sleep(.2)
+        assert lock.generation > generation
+        lock.release()
+
+
+@patch("utils.coalesce.LOCK_POLL", .01)
+def test_export_once_coalesces_and_caches():
+    payload = {"bucket": "bucket", "format": "ndjson", "file_name": "export"}
+    config = ExportConfig.from_payload("dataset_id", "table_id", payload)
+    storage_client = FakeStorageClient()
+    bigquery_client = fake_bigquery(storage_client, datetime(2022, 1, 1, tzinfo=timezone.utc))
+    barrier = threading.Barrier(3)
+    results = []
+
+    def request():
+        barrier.wait()
+        results.append(export_once(ExportConfig.from_payload("dataset_id", "table_id", payload),
+                                   storage_client, bigquery_client))
+
+    with patch_storage(storage_client):
+        threads = [threading.Thread(target=request) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert bigquery_client.extract_table.call_count == 1
+        assert sum(1 for result in results if result.get("coalesced")) == 2
+        assert storage_client.get(("bucket", config.file_path)) == b"0\n1\n"
+
+        # the table did not change since
+        assert export_once(config, storage_client, bigquery_client)["cached"]
+        assert bigquery_client.extract_table.call_count == 1
+
+        bigquery_client.get_table.return_value.modified = datetime(2022, 1, 2, tzinfo=timezone.utc)
+        assert "cached" not in export_once(config, storage_client, bigquery_client)
+        assert bigquery_client.extract_table.call_count == 2
+
+        # forced exports skip the cache
+        forced = ExportConfig.from_payload("dataset_id", "table_id", dict(payload, force=True))
+        export_once(forced, storage_client, bigquery_client)
+        assert bigquery_client.extract_table.call_count == 3
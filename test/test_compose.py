@@ -1,11 +1,13 @@
 import concurrent.futures
+import gzip
 import io
-from unittest.mock import patch
+from unittest.mock import call, patch
 
 import pytest
 
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
 from utils.compose import get_gcs_client, list_file, generate_chunks, write_initial_file_with_header, \
-    delete_objects_concurrent, compose_file
+    delete_objects_concurrent, compose_file, compose_tree
 
 
 def test_get_gcs_client_exception():
@@ -57,7 +59,7 @@ def test_write_initial_file_with_header(storage, io_string):
     file_uri = "gs://bucket/file.csv"
     header = ['header1', 'header2']
     final_blob = storage.Blob.from_string.return_value
-    blob_with_header = io_string.StringIO.return_value
+    blob_with_header = io_string.BytesIO.return_value
     blob = write_initial_file_with_header(file_uri, header, storage_client)
     storage.Blob.from_string.assert_called_once_with(file_uri)
     final_blob.upload_from_file.assert_called_once_with(blob_with_header, content_type='text/csv',
@@ -79,6 +81,14 @@ def test_write_initial_file_without_header(storage, io_bytes):
     assert blob == final_blob
 
 
+def test_write_initial_file_with_gzip_header():
+    client = FakeStorageClient()
+    with patch_storage(client):
+        blob = write_initial_file_with_header("gs://bucket/header.csv.gz", ['header1', 'header2'], client,
+                                              compression="gzip")
+    assert gzip.decompress(blob.download_as_bytes(client=client)) == b"header1,header2 \n"
+
+
 @patch("utils.compose.storage")
 def test_write_initial_file__with_header_exception(storage):
     storage_client = storage.Client.return_value
@@ -99,8 +109,33 @@ def test_de_objects_concurrent(storage):
     executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
     storage_client = storage.Client.return_value
     delete_objects_concurrent(blobs, executor, storage_client)
-    blobs[0].delete.assert_called_with(client=storage_client)
-    blobs[1].delete.assert_called_with(client=storage_client)
+    batch = storage_client.batch.return_value
+    assert batch.api_request.call_args_list == [call(method="DELETE", path=blob.path) for blob in blobs]
+    batch.finish.assert_called_once_with(raise_exception=False)
+
+
+@patch("utils.ratelimit.sleep")
+def test_delete_objects_concurrent_batches(sleep):
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "prefix", 250)
+    client.failing = {blobs[3].name, blobs[120].name}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    summary = delete_objects_concurrent(blobs, executor, client)
+    executor.shutdown(True)
+    assert summary == {"deleted": 250, "failed": []}
+    # 3 batches of up to 100, then one batch retrying the 2 failed deletes
+    assert client.calls["batch"] == 4
+    assert client.objects == {}
+
+
+def test_delete_objects_concurrent_reports_failures():
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "prefix", 3)
+    client.failing = {blobs[1].name}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    summary = delete_objects_concurrent(blobs, executor, client, retries=0)
+    executor.shutdown(True)
+    assert summary == {"deleted": 2, "failed": [blobs[1].name]}
 
 
 @patch("utils.compose.write_initial_file_with_header")
@@ -128,3 +163,27 @@ def test_compose_file_empty_list(storage):
         final_blob = compose_file(file_uri, list_object, gcs_client,
                                   header)
     assert exception.value.__str__() == "file not found"
+
+
+def test_compose_file_keeps_shard_order():
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "dataset/tmp/table/partition", 1000)
+    with patch_storage(client):
+        final_blob = compose_file("gs://bucket/dataset/file.csv", blobs, client, ["header1", "header2"])
+    expected = b"header1,header2 \n" + b"".join(f"{i}\n".encode() for i in range(1000))
+    assert final_blob.download_as_bytes(client=client) == expected
+    # header and 1000 shards -> 32 composites, then the final compose
+    assert client.calls["compose"] == 32 + 1
+    assert [name for _, name in client.objects] == ["dataset/file.csv"]
+
+
+def test_compose_tree_single_round():
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "prefix", 31)
+    final_blob = client.blob_from_string("gs://bucket/file.csv")
+    final_blob.upload_from_file(io.BytesIO(b""), client=client)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    intermediates = compose_tree(final_blob, [final_blob] + blobs, client, executor)
+    executor.shutdown(True)
+    assert intermediates == []
+    assert client.calls["compose"] == 1
@@ -0,0 +1,243 @@
+import gzip
+import json
+from datetime import date
+from time import sleep
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.export import ExportConfig, run_export
+
+
+def fake_table(*header: str) -> bigquery.Table:
+    """A table without statistics, planned like before the planner"""
+    return bigquery.Table("project_id.dataset_id.table_id",
+                          schema=[bigquery.SchemaField(name, "STRING") for name in header])
+
+
+@pytest.fixture
+def config() -> ExportConfig:
+    return ExportConfig.from_payload("dataset_id", "table_id", {"project": "project_id", "bucket": "bucket",
+                                                                "location": "us"})
+
+
+def test_config_from_payload(config):
+    file_name = "export-table_id-{}".format(date.today().isoformat())
+    assert config.file_name == file_name
+    assert config.temp_file_prefix == f"dataset_id/tmp/table_id/{config.run_id}/partition"
+    assert config.temp_destination_uri == f"gs://bucket/dataset_id/tmp/table_id/{config.run_id}/partition*.csv"
+    assert config.file_uri == f"gs://bucket/dataset_id/{file_name}.csv"
+
+
+def test_run_export(config):
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 40) and MagicMock()
+    bigquery_client.get_table.return_value = fake_table("header1", "header2")
+    progress = []
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client, lambda *args: progress.append(args))
+
+    bigquery_client.extract_table.assert_called_once()
+    assert bigquery_client.extract_table.call_args.args[1] == [config.temp_destination_uri]
+    assert result["path"] == config.file_uri
+    assert set(result["timings"]) >= {"extract", "header", "header_file", "list_shards", "compose"}
+    expected = b"header1,header2 \n" + b"".join(f"{i}\n".encode() for i in range(40))
+    assert storage_client.get(("bucket", config.file_path)) == expected
+    assert ("compose", "done") in progress
+
+    # the temporary files are deleted in the background
+    for _ in range(100):
+        if list(storage_client.objects) == [("bucket", config.file_path)]:
+            break
+        sleep(.05)
+    assert list(storage_client.objects) == [("bucket", config.file_path)]
+
+
+def test_run_export_tiny_table(config):
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 1) and MagicMock()
+    table = fake_table("header1")
+    table._properties["numBytes"] = "5120"
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client, table=table)
+
+    assert result["plan"]["strategy"] == "tiny"
+    assert bigquery_client.extract_table.call_args.args[1] == \
+        ["gs://bucket/{}000000000000.csv".format(config.temp_file_prefix)]
+    # neither listed nor looked up again
+    assert "list" not in storage_client.calls
+    bigquery_client.get_table.assert_not_called()
+    assert storage_client.get(("bucket", config.file_path)) == b"header1 \n0\n"
+
+
+def test_run_export_without_shards(config):
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = fake_table()
+
+    with patch_storage(storage_client), pytest.raises(ValueError) as exception:
+        run_export(config, storage_client, bigquery_client)
+    assert exception.value.__str__() == "file not found"
+    assert ("bucket", config.file_path) not in storage_client.objects
+
+
+def test_run_export_gzip():
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "compression": "gzip"})
+    storage_client = FakeStorageClient()
+
+    def extract_table(*args, **kwargs):
+        for i in range(40):
+            storage_client.put(("bucket", "{}{:012d}.csv.gz".format(config.temp_file_prefix, i)),
+                               gzip.compress(f"{i}\n".encode()))
+        return MagicMock()
+
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = extract_table
+    bigquery_client.get_table.return_value = fake_table("header1", "header2")
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client)
+
+    assert result["path"].endswith(".csv.gz")
+    assert config.temp_destination_uri.endswith("partition*.csv.gz")
+    job_config = bigquery_client.extract_table.call_args.kwargs["job_config"]
+    assert job_config.compression == "GZIP"
+    expected = b"header1,header2 \n" + b"".join(f"{i}\n".encode() for i in range(40))
+    assert gzip.decompress(storage_client.get(("bucket", config.file_path))) == expected
+    properties = storage_client.properties[("bucket", config.file_path)]
+    assert (properties["content_type"], properties["content_encoding"]) == ("text/csv", "gzip")
+
+
+def test_config_rejects_unknown_compression():
+    with pytest.raises(BadRequest):
+        ExportConfig.from_payload("dataset_id", "table_id", {"compression": "zip"})
+
+
+def test_run_export_ndjson_has_no_header():
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "format": "ndjson"})
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 3) and MagicMock()
+    bigquery_client.get_table.return_value = fake_table("header1")
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client)
+
+    assert result["path"].endswith(".json")
+    # for the plan only, there is no header
+    bigquery_client.get_table.assert_called_once()
+    job_config = bigquery_client.extract_table.call_args.kwargs["job_config"]
+    assert job_config.destination_format == "NEWLINE_DELIMITED_JSON"
+    assert storage_client.get(("bucket", config.file_path)) == b"0\n1\n2\n"
+    assert storage_client.properties[("bucket", config.file_path)]["content_type"] == "application/x-ndjson"
+
+
+def test_run_export_avro_writes_manifest():
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "format": "avro",
+                                                                  "file_name": "export", "compression": "snappy"})
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 2) and MagicMock()
+    bigquery_client.get_table.return_value = fake_table()
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client)
+
+    assert config.temp_destination_uri == "gs://bucket/dataset_id/export/{}/part-*.avro".format(config.run_id)
+    assert result["path"] == "gs://bucket/dataset_id/export.manifest.json"
+    job_config = bigquery_client.extract_table.call_args.kwargs["job_config"]
+    assert job_config.destination_format == "AVRO"
+    assert job_config.compression == "SNAPPY"
+    manifest = json.loads(storage_client.get(("bucket", "dataset_id/export.manifest.json")))
+    assert manifest["format"] == "avro"
+    assert manifest["files"] == ["gs://bucket/dataset_id/export/{}/part-{:012d}.csv".format(config.run_id, i)
+                                 for i in range(2)]
+    # the exported files are kept
+    assert len(storage_client.objects) == 3
+
+
+def test_run_export_manifest_lists_only_its_run():
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = fake_table()
+    payload = {"bucket": "bucket", "format": "avro", "file_name": "export"}
+
+    with patch_storage(storage_client):
+        for shards in [5, 2]:
+            config = ExportConfig.from_payload("dataset_id", "table_id", payload)
+            bigquery_client.extract_table.side_effect = \
+                lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, shards) \
+                and MagicMock()
+            run_export(config, storage_client, bigquery_client)
+
+    manifest = json.loads(storage_client.get(("bucket", "dataset_id/export.manifest.json")))
+    assert manifest["files"] == ["gs://bucket/dataset_id/export/{}/part-{:012d}.csv".format(config.run_id, i)
+                                 for i in range(2)]
+    # the files of the first export are deleted in the background
+    for _ in range(100):
+        if len(storage_client.objects) == 3:
+            break
+        sleep(.05)
+    assert sorted(name for _, name in storage_client.objects) == \
+        ["dataset_id/export.manifest.json"] + [uri[len("gs://bucket/"):] for uri in manifest["files"]]
+
+
+def test_config_rejects_unsupported_compression_of_format():
+    with pytest.raises(BadRequest):
+        ExportConfig.from_payload("dataset_id", "table_id", {"format": "avro", "compression": "gzip"})
+
+
+def test_config_query_sql():
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"project": "project_id", "columns": ["a", "b.c"],
+                                                                  "filter": "day >= '2022-01-01'"})
+    assert config.query_sql == "SELECT a, b.c FROM `project_id.dataset_id.table_id` WHERE day >= '2022-01-01'"
+    assert ExportConfig.from_payload("dataset_id", "table_id", {}).query_sql is None
+    assert ExportConfig.from_payload("dataset_id", "table_id", {"query": "SELECT 1"}).query_sql == "SELECT 1"
+
+
+@pytest.mark.parametrize("payload", [{"columns": "a"}, {"columns": []}, {"columns": ["a; DROP"]},
+                                     {"query": "SELECT 1", "filter": "a = 1"},
+                                     {"incremental": True, "columns": ["a"]}])
+def test_config_rejects_bad_query(payload):
+    with pytest.raises(BadRequest):
+        ExportConfig.from_payload("dataset_id", "table_id", payload)
+
+
+@patch("utils.export.bq_delete_table")
+@patch("utils.export.bq_query_to_table")
+def test_run_export_query(bq_query_to_table, bq_delete_table):
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"project": "project_id", "bucket": "bucket",
+                                                                  "columns": ["header1"]})
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 2) and MagicMock()
+    bigquery_client.get_table.return_value = fake_table("header1")
+    bq_query_to_table.return_value = "_export_tmp_table"
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client)
+
+    bq_query_to_table.assert_called_once_with("project_id", "dataset_id", config.query_sql, config.location,
+                                              bigquery_client)
+    assert bigquery_client.extract_table.call_args.args[0].table_id == "_export_tmp_table"
+    assert bigquery_client.get_table.call_args.args[0].table_id == "_export_tmp_table"
+    assert "query" in result["timings"]
+    assert storage_client.get(("bucket", config.file_path)) == b"header1 \n0\n1\n"
+    # the temporary table is dropped in the background
+    for _ in range(100):
+        if bq_delete_table.called:
+            break
+        sleep(.05)
+    bq_delete_table.assert_called_once_with("project_id", "dataset_id", "_export_tmp_table", bigquery_client)
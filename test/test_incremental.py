@@ -0,0 +1,122 @@
+from time import monotonic, sleep
+from unittest.mock import MagicMock, patch
+
+import pytest
+from google.api_core.exceptions import BadRequest
+from google.cloud import bigquery
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.export import ExportConfig, run_export
+from utils.incremental import changed_partitions, schema_fingerprint
+
+
+def Field(name, field_type="STRING"):
+    return bigquery.SchemaField(name, field_type)
+
+
+def fake_bigquery(storage_client, table_content):
+    """extract_table writes one shard with the current content of the partition"""
+    def extract_table(table_ref, destination_uri, **kwargs):
+        partition_id = table_ref.table_id.split("$")[1]
+        name = destination_uri[len("gs://bucket/"):].replace("*", "000000000000")
+        storage_client.put(("bucket", name), table_content[partition_id].encode())
+        return MagicMock()
+
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = extract_table
+    bigquery_client.get_table.return_value.schema = [Field("header1")]
+    return bigquery_client
+
+
+def final_content(storage_client, config):
+    return storage_client.get(("bucket", config.file_path)).decode()
+
+
+@patch("utils.incremental.delete_objects_concurrent")
+@patch("utils.incremental.bq_partitions")
+def test_incremental_export_extracts_changed_partitions(bq_partitions, delete_objects_concurrent):
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "file_name": "export",
+                                                                  "incremental": True})
+    storage_client = FakeStorageClient()
+    table_content = {"20220101": "a\n", "20220102": "b\n"}
+    bigquery_client = fake_bigquery(storage_client, table_content)
+
+    with patch_storage(storage_client):
+        bq_partitions.return_value = {"20220101": 1, "20220102": 1}
+        result = run_export(config, storage_client, bigquery_client)
+        assert result["partitions"] == {"partitions": 2, "extracted": 2}
+        assert final_content(storage_client, config) == "header1 \na\nb\n"
+
+        # a new partition and a modified one
+        table_content.update({"20220102": "b2\n", "20220103": "c\n"})
+        bq_partitions.return_value = {"20220101": 1, "20220102": 2, "20220103": 1}
+        result = run_export(config, storage_client, bigquery_client)
+        assert result["partitions"] == {"partitions": 3, "extracted": 2}
+        assert final_content(storage_client, config) == "header1 \na\nb2\nc\n"
+
+    extracted = [call.args[0].table_id for call in bigquery_client.extract_table.call_args_list]
+    assert sorted(extracted[2:]) == ["table_id$20220102", "table_id$20220103"]
+
+
+@pytest.mark.parametrize("partitions", [{}, None])
+@patch("utils.incremental.bq_partitions")
+def test_incremental_export_of_unpartitioned_table(bq_partitions, partitions):
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "incremental": True})
+    storage_client = FakeStorageClient()
+    bigquery_client = MagicMock()
+    bigquery_client.extract_table.side_effect = \
+        lambda *args, **kwargs: storage_client.add_shards("bucket", config.temp_file_prefix, 2) and MagicMock()
+    bigquery_client.get_table.return_value = MagicMock(schema=[Field("header1")], num_bytes=None, num_rows=None)
+    # not partitioned, or with rows out of any partition
+    bq_partitions.return_value = partitions
+
+    with patch_storage(storage_client):
+        result = run_export(config, storage_client, bigquery_client)
+
+    assert "partitions" not in result
+    assert bigquery_client.extract_table.call_args.args[1] == [config.temp_destination_uri]
+
+
+@patch("utils.incremental.bq_partitions")
+def test_failed_incremental_export_deletes_its_temporary_files(bq_partitions):
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "file_name": "export",
+                                                                  "incremental": True})
+    storage_client = FakeStorageClient()
+    bigquery_client = fake_bigquery(storage_client, {"20220101": "a\n", "20220102": "b\n"})
+    bq_partitions.return_value = {"20220101": 1, "20220102": 1}
+
+    # the final compose fails once the partitions are composed
+    with patch_storage(storage_client), patch("utils.formats.compose_tree", side_effect=ValueError("boom")), \
+            pytest.raises(ValueError):
+        run_export(config, storage_client, bigquery_client)
+
+    def temporaries():
+        return [name for _, name in storage_client.objects if "/tmp/" in name or ".compose/" in name]
+
+    deadline = monotonic() + 5
+    while temporaries() and monotonic() < deadline:
+        sleep(.01)
+    assert temporaries() == []
+
+
+def test_changed_partitions():
+    manifest = {"schema": "schema", "partitions": {"1": {"last_modified": 1, "path": "1.csv"},
+                                                   "2": {"last_modified": 1, "path": "2.csv"}}}
+    partitions = {"1": 1, "2": 2, "3": 1}
+    assert changed_partitions(partitions, manifest, "schema") == ["2", "3"]
+    assert changed_partitions(partitions, manifest, "other schema") == ["1", "2", "3"]
+
+
+def test_schema_fingerprint_covers_types_and_modes():
+    schema = [Field("id", "INTEGER"), bigquery.SchemaField("tags", "RECORD", fields=[Field("name")])]
+    assert schema_fingerprint(schema) == schema_fingerprint(list(schema))
+    assert schema_fingerprint(schema) != schema_fingerprint([Field("id", "STRING"), schema[1]])
+    assert schema_fingerprint(schema) != schema_fingerprint([bigquery.SchemaField("id", "INTEGER", "REQUIRED"),
+                                                             schema[1]])
+    assert schema_fingerprint(schema) != schema_fingerprint(
+        [schema[0], bigquery.SchemaField("tags", "RECORD", fields=[Field("name", "BYTES")])])
+
+
+def test_incremental_export_requires_compose_format():
+    with pytest.raises(BadRequest):
+        ExportConfig.from_payload("dataset_id", "table_id", {"format": "parquet", "incremental": True})
@@ -0,0 +1,131 @@
+import asyncio
+import json
+from time import sleep
+
+import pytest
+
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.jobs import Job, JobStore
+
+
+@pytest.fixture
+def store() -> JobStore:
+    store = JobStore(max_workers=2)
+    yield store
+    store.shutdown()
+
+
+def test_job_succeeds(store):
+    def pipeline(job):
+        job.progress("extract", "running")
+        job.progress("extract", "done")
+        return {"path": "gs://bucket/file.csv"}
+
+    job = store.submit(pipeline, ["extract", "compose"])
+    store.shutdown()
+
+    result = store.get(job.id).to_dict()
+    assert result["status"] == "succeeded"
+    assert result["result"] == {"path": "gs://bucket/file.csv"}
+    assert result["stages"]["extract"]["status"] == "done"
+    assert "started" in result["stages"]["extract"]
+    assert result["stages"]["compose"] == {"status": "pending"}
+
+
+def test_job_fails(store):
+    def pipeline(job):
+        raise ValueError("file not found")
+
+    job = store.submit(pipeline, ["extract"])
+    store.shutdown()
+
+    result = job.to_dict()
+    assert result["status"] == "failed"
+    assert result["error"] == "file not found"
+
+
+def test_finished_jobs_expire():
+    store = JobStore(max_workers=1, retention=0)
+    job = store.submit(lambda job: {}, [])
+    while job.finished_at is None:
+        sleep(.01)
+    store.submit(lambda job: {}, [])
+    store.shutdown()
+    assert store.get(job.id) is None
+
+
+def test_cancelled_job_fails(store):
+    async def pipeline(job):
+        await asyncio.sleep(5)
+
+    async def submit():
+        job = store.submit_async(pipeline, [])
+        await asyncio.sleep(0)
+        for task in store._tasks:
+            task.cancel()
+        await asyncio.gather(*store._tasks, return_exceptions=True)
+        return job
+
+    result = asyncio.run(submit()).to_dict()
+    assert result["status"] == "failed"
+    assert result["error"] == "cancelled"
+
+
+def test_async_job_runs_on_the_event_loop(store):
+    async def pipeline(job):
+        job.progress("extract", "running")
+        await asyncio.sleep(0)
+        job.progress("extract", "done")
+        return {"path": "gs://bucket/file.csv"}
+
+    async def submit():
+        job = store.submit_async(pipeline, ["extract"])
+        assert job.status == "pending"
+        await asyncio.gather(*store._tasks)
+        return job
+
+    result = asyncio.run(submit()).to_dict()
+    assert result["status"] == "succeeded"
+    assert result["stages"]["extract"]["status"] == "done"
+
+
+def test_job_status_is_shared_through_the_bucket():
+    fake = FakeStorageClient()
+    with patch_storage(fake):
+        store = JobStore(max_workers=1, status_uri="gs://bucket/jobs/", storage_client=fake)
+        job = store.submit(lambda job: {"path": "gs://bucket/file.csv"}, ["extract"])
+        store.shutdown()
+
+        status = json.loads(fake.objects[("bucket", "jobs/{}.json".format(job.id))])
+        assert status["status"] == "succeeded"
+        assert status["result"] == {"path": "gs://bucket/file.csv"}
+
+        # another instance reads the job from its status object
+        other = JobStore(max_workers=1, status_uri="gs://bucket/jobs", storage_client=fake)
+        assert other.get(job.id).to_dict() == job.to_dict()
+        assert other.get("0" * 32) is None
+        assert other.get("../checkpoint") is None
+        other.shutdown()
+
+
+def test_status_objects_of_expired_jobs_are_deleted():
+    fake = FakeStorageClient()
+    with patch_storage(fake):
+        store = JobStore(max_workers=1, retention=0, status_uri="gs://bucket/jobs", storage_client=fake)
+        job = store.submit(lambda job: {}, [])
+        while job.finished_at is None:
+            sleep(.01)
+        # the next job expires the first one
+        store.submit(lambda job: {}, [])
+        store.shutdown()
+        assert ("bucket", "jobs/{}.json".format(job.id)) not in fake.objects
+
+        # the status object of a process which stopped before the job expired
+        left = Job([])
+        left.update("failed", error="boom")
+        fake.put(("bucket", "jobs/{}.json".format(left.id)), json.dumps(left.to_dict()).encode())
+        other = JobStore(max_workers=1, retention=0, status_uri="gs://bucket/jobs", storage_client=fake)
+        sleep(.01)
+        assert other.get(left.id) is None
+        other.shutdown()
+        assert ("bucket", "jobs/{}.json".format(left.id)) not in fake.objects
@@ -0,0 +1,26 @@
+import sys
+from unittest.mock import patch
+
+from utils import lazy
+
+
+def test_module_is_imported_on_first_use():
+    sys.modules.pop("colorsys", None)
+    seconds = {}
+    lazy.observe(lambda name, elapsed: seconds.setdefault(name, elapsed))
+    colorsys = lazy.lazy_import("colorsys")
+    assert not colorsys.loaded and "colorsys" not in sys.modules
+    assert colorsys.rgb_to_hsv(1, 0, 0) == (0, 1, 1)
+    assert colorsys.loaded and "colorsys" in seconds
+    assert lazy.lazy_import("colorsys") is colorsys
+
+
+def test_patch_through_the_proxy():
+    json = lazy.lazy_import("json")
+    with patch.object(json, "dumps", return_value="patched"):
+        assert sys.modules["json"].dumps({}) == "patched"
+    assert json.dumps({}) == "{}"
+
+
+def test_optional_module_not_installed():
+    assert lazy.lazy_import("not_installed_module", optional=True) is None
@@ -0,0 +1,60 @@
+from time import monotonic, sleep
+
+import pytest
+
+from benchmarks.emulator import Emulator, endpoint, expected_csv, serve
+from benchmarks.loadtest import gunicorn_command, percentile
+from utils.clients import ClientRegistry
+from utils.coalesce import export_once
+from utils.export import ExportConfig
+
+
+@pytest.fixture
+def emulator(monkeypatch):
+    emulator = Emulator(shards=40, rows=3)
+    server = serve(emulator)
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", endpoint(server))
+    monkeypatch.setenv("BIGQUERY_EMULATOR_HOST", endpoint(server))
+    monkeypatch.setenv("GOOGLE_CLOUD_PROJECT", "project")
+    yield emulator
+    server.shutdown()
+
+
+def test_export_against_the_emulator(emulator):
+    registry = ClientRegistry()
+    config = ExportConfig.from_payload("dataset", "table", {"project": "project", "bucket": "bucket",
+                                                            "with_header": True})
+
+    result = export_once(config, registry.gcs_client(), registry.bigquery_client())
+    assert emulator.get("bucket", config.file_path) == expected_csv(40, 3)
+    # 41 sources, composed in two rounds
+    assert emulator.calls["POST /storage/v1/b/bucket/o/*/compose"] == 3
+
+    cached = export_once(config, registry.gcs_client(), registry.bigquery_client())
+    assert cached["cached"] and cached["path"] == result["path"]
+    assert emulator.calls["POST /bigquery/v2/projects/project/jobs"] == 1
+
+    # the temporary files are deleted in the background
+    deadline = monotonic() + 10
+    while emulator.temporaries() and monotonic() < deadline:
+        sleep(.05)
+    assert emulator.temporaries() == []
+
+
+def test_gunicorn_command_follows_the_procfile():
+    command = gunicorn_command(8081, None, 16)
+    assert command[2:] == ["gunicorn", "--bind", "127.0.0.1:8081", "--workers", "1", "--threads", "16",
+                           "--timeout", "0", "app:app"]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([3.0], 95) == 3.0
+
+
+def test_gunicorn_command_of_the_asgi_process():
+    command = gunicorn_command(8081, 2, None, "asgi")
+    assert command[2:] == ["gunicorn", "--bind", "127.0.0.1:8081", "--workers", "2", "--worker-class",
+                           "uvicorn.workers.UvicornWorker", "--timeout", "0", "asgi_app:app"]
@@ -0,0 +1,61 @@
+import io
+import json
+import threading
+
+from utils.logging import LogWriter, QueueLogger
+
+
+def test_writer_renders_queued_events():
+    stream = io.StringIO()
+    writer = LogWriter(stream=stream)
+    logger = QueueLogger(writer)
+    for i in range(10):
+        logger.info(severity="info", message="line {}".format(i))
+    assert writer.flush(timeout=5)
+    lines = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert [line["message"] for line in lines] == ["line {}".format(i) for i in range(10)]
+
+
+def test_writer_renders_unserializable_values():
+    stream = io.StringIO()
+    writer = LogWriter(stream=stream)
+    writer.put({"message": ValueError("boom")})
+    assert writer.flush(timeout=5)
+    assert "boom" in json.loads(stream.getvalue())["message"]
+
+
+def test_flush_deadline():
+    release = threading.Event()
+
+    class BlockedStream(io.StringIO):
+        def write(self, s):
+            release.wait(5)
+            return super().write(s)
+
+    writer = LogWriter(stream=BlockedStream())
+    writer.put({"message": "blocked"})
+    assert not writer.flush(timeout=.05)
+    release.set()
+    assert writer.flush(timeout=5)
+
+
+def test_writer_survives_a_failed_write(capsys):
+    class FailingStream(io.StringIO):
+        def __init__(self):
+            super().__init__()
+            self.failures = 1
+
+        def write(self, s):
+            if self.failures:
+                self.failures -= 1
+                raise OSError("disk full")
+            return super().write(s)
+
+    stream = FailingStream()
+    writer = LogWriter(stream=stream)
+    writer.put({"message": "lost"})
+    assert writer.flush(timeout=5)
+    writer.put({"message": "written"})
+    assert writer.flush(timeout=5)
+    assert json.loads(stream.getvalue())["message"] == "written"
+    assert "disk full" in capsys.readouterr().err
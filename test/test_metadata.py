@@ -0,0 +1,54 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from utils.metadata import CachedValue
+
+
+def test_cached_value_is_loaded_once():
+    loader = MagicMock(return_value="project_id")
+    value = CachedValue(loader, ttl=60)
+    assert value.get() == "project_id"
+    assert value.get() == "project_id"
+    loader.assert_called_once_with()
+
+
+@patch("utils.metadata.monotonic")
+def test_cached_value_refreshes_after_ttl(monotonic):
+    monotonic.return_value = 0
+    loader = MagicMock(side_effect=["first", "second"])
+    value = CachedValue(loader, ttl=60)
+    assert value.get() == "first"
+    monotonic.return_value = 61
+    assert value.get() == "second"
+
+
+@patch("utils.metadata.monotonic")
+def test_cached_value_keeps_stale_value_on_failure(monotonic):
+    monotonic.return_value = 0
+    loader = MagicMock(side_effect=["first", Exception("metadata server down")])
+    value = CachedValue(loader, ttl=60)
+    assert value.get() == "first"
+    monotonic.return_value = 61
+    assert value.get() == "first"
+
+
+def test_cached_value_raises_without_value():
+    value = CachedValue(MagicMock(side_effect=Exception("no credentials")))
+    with pytest.raises(Exception):
+        value.get()
+
+
+@patch("utils.metadata.google.auth.default")
+def test_trace_modifier_uses_cached_project(auth_default, app):
+    from utils import metadata
+    from utils.logging import trace_modifier
+
+    auth_default.return_value = (None, "project_id")
+    metadata.project_id.invalidate()
+    with app.test_request_context(headers={"X-Cloud-Trace-Context": "trace_id/1;o=1"}):
+        for _ in range(3):
+            event_dict = trace_modifier(None, "info", {})
+    auth_default.assert_called_once()
+    assert event_dict["logging.googleapis.com/trace"] == "projects/project_id/traces/trace_id"
+    metadata.project_id.invalidate()
@@ -0,0 +1,49 @@
+import concurrent.futures
+
+import pytest
+from flask.testing import FlaskClient
+
+from benchmarks.fake_storage import FakeStorageClient
+from utils import metrics
+from utils.compose import compose_tree, delete_objects_concurrent
+from utils.pipeline import Pipeline
+
+
+def sample(name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+
+def test_pipeline_stage_metrics():
+    ok, error = sample("export_stage_duration_seconds_count", stage="ok_stage", status="ok"), \
+        sample("export_errors_total", stage="failing_stage", error="KeyError")
+    pipeline = Pipeline("test")
+    pipeline.add("ok_stage", lambda: 1)
+    pipeline.add("failing_stage", lambda ok_stage: {}["missing"], deps=["ok_stage"])
+    with pytest.raises(KeyError):
+        pipeline.run()
+    assert sample("export_stage_duration_seconds_count", stage="ok_stage", status="ok") == ok + 1
+    assert sample("export_errors_total", stage="failing_stage", error="KeyError") == error + 1
+
+
+def test_compose_and_delete_metrics():
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "tmp/partition", 100)
+    composes, deleted = sample("gcs_compose_requests_total"), sample("gcs_deletes_total", result="deleted")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    intermediates = compose_tree(client.bucket("bucket").blob("final.csv"), blobs, client, executor)
+    delete_objects_concurrent(blobs + intermediates, executor, client)
+    executor.shutdown()
+    # 4 intermediate composites and the final one
+    assert sample("gcs_compose_requests_total") == composes + 5
+    assert sample("gcs_compose_round_duration_seconds_count", round="final") >= 1
+    assert sample("gcs_deletes_total", result="deleted") == deleted + 104
+
+
+def test_get_metrics(client: FlaskClient):
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    body = response.data.decode()
+    assert 'http_request_duration_seconds_count{method="GET",route="/",status="200"}' in body
+    assert "http_requests_in_flight 1.0" in body
@@ -0,0 +1,156 @@
+import asyncio
+import threading
+from time import perf_counter, sleep
+
+import pytest
+
+from utils.pipeline import AsyncPipeline, Cancelled, Pipeline, _background_tasks
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline("test")
+    pipeline.add("a", lambda: (barrier.wait(), 1)[1])
+    pipeline.add("b", lambda: (barrier.wait(), 2)[1])
+    pipeline.add("c", lambda a, b: a + b, deps=["a", "b"])
+    results = pipeline.run()
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert set(pipeline.timings) == {"a", "b", "c"}
+
+
+def test_detached_stage_does_not_hold_the_run():
+    release = threading.Event()
+    done = threading.Event()
+    pipeline = Pipeline("test")
+    pipeline.add("a", lambda: 1)
+    pipeline.add("cleanup", lambda a: release.wait(5) and done.set(), deps=["a"], detached=True)
+    results = pipeline.run()
+    assert results == {"a": 1}
+    assert not done.is_set()
+    release.set()
+    assert done.wait(5)
+
+
+def test_failure_skips_dependent_stages():
+    called = []
+
+    def fail():
+        sleep(.01)
+        raise ValueError("boom")
+
+    pipeline = Pipeline("test")
+    pipeline.add("a", fail)
+    pipeline.add("b", lambda a: called.append("b"), deps=["a"])
+    with pytest.raises(ValueError) as raised:
+        pipeline.run()
+    assert called == []
+    # the always stages running after the failure tell it from a shutdown
+    assert pipeline.error is raised.value
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        Pipeline("test").add("a", lambda b: None, deps=["b"])
+
+
+def test_async_stages_run_concurrently():
+    async def stage(value):
+        await asyncio.sleep(.05)
+        return value
+
+    pipeline = AsyncPipeline("test")
+    pipeline.add("a", lambda: stage(1))
+    pipeline.add("b", lambda: stage(2))
+    pipeline.add("c", lambda a, b: stage(a + b), deps=["a", "b"])
+    start = perf_counter()
+    results = asyncio.run(pipeline.run())
+    assert results == {"a": 1, "b": 2, "c": 3}
+    assert perf_counter() - start < .14
+
+
+def test_failure_does_not_wait_and_runs_the_cleanup_once_the_running_stages_stopped():
+    release = threading.Event()
+    cleaned = []
+    done = threading.Event()
+
+    def fail(a):
+        raise ValueError("boom")
+
+    pipeline = Pipeline("test")
+    pipeline.add("a", lambda: 1)
+    pipeline.add("slow", lambda a: release.wait(5), deps=["a"])
+    pipeline.add("b", fail, deps=["a"])
+    pipeline.add("c", lambda b: 2, deps=["b"])
+    pipeline.add("cleanup", lambda a, slow=None, c=None: (cleaned.append((a, slow, c)), done.set()),
+                 deps=["a", "slow", "c"], detached=True, always=True)
+    start = perf_counter()
+    with pytest.raises(ValueError):
+        pipeline.run()
+    # the slow stage is still running, the cleanup waits for it and gets its result
+    assert perf_counter() - start < 1
+    assert pipeline.failed.is_set()
+    assert not done.wait(.1)
+    release.set()
+    assert done.wait(5)
+    assert cleaned == [(1, True, None)]
+
+
+def test_running_stage_stops_at_its_check():
+    started = threading.Event()
+    stopped = []
+
+    def extract():
+        started.wait(5)
+        while True:
+            try:
+                pipeline.check()
+            except Cancelled:
+                stopped.append(True)
+                raise
+            sleep(.01)
+
+    def fail():
+        started.set()
+        raise ValueError("boom")
+
+    pipeline = Pipeline("test")
+    pipeline.add("extract", extract)
+    pipeline.add("header", fail)
+    with pytest.raises(ValueError):
+        pipeline.run()
+    deadline = perf_counter() + 5
+    while not stopped and perf_counter() < deadline:
+        sleep(.01)
+    assert stopped == [True]
+
+
+def test_async_failure_runs_the_cleanup():
+    cleaned = []
+
+    async def fail(a):
+        raise ValueError("boom")
+
+    async def slow(a):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            await asyncio.sleep(.01)
+            cleaned.append("slow stopped")
+            raise
+
+    async def cleanup(a, b=None, slow=None):
+        cleaned.append((a, b, slow))
+
+    async def run():
+        pipeline = AsyncPipeline("test")
+        pipeline.add("a", lambda: asyncio.sleep(0, 1))
+        pipeline.add("slow", slow, deps=["a"])
+        pipeline.add("b", fail, deps=["a"])
+        pipeline.add("cleanup", cleanup, deps=["a", "b", "slow"], detached=True, always=True)
+        with pytest.raises(ValueError):
+            await pipeline.run()
+        await asyncio.gather(*_background_tasks)
+
+    asyncio.run(run())
+    # the cleanup runs once the cancelled stage stopped
+    assert cleaned == ["slow stopped", (1, None, None)]
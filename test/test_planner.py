@@ -0,0 +1,37 @@
+from unittest.mock import MagicMock
+
+import pytest
+
+from utils.export import ExportConfig
+from utils.planner import HUGE_BYTES, MAX_WRITERS, TINY_BYTES, ExportPlan, plan_export
+
+
+def table(num_bytes):
+    return MagicMock(num_bytes=num_bytes, num_rows=10, time_partitioning=None, range_partitioning=None)
+
+
+@pytest.fixture
+def config() -> ExportConfig:
+    return ExportConfig.from_payload("dataset_id", "table_id", {"bucket": "bucket", "format": "ndjson"})
+
+
+def test_plan_by_size(config):
+    prefix = "gs://bucket/{}".format(config.temp_file_prefix)
+
+    tiny = plan_export(config, table(5 << 10))
+    assert (tiny.strategy, tiny.single_file) == ("tiny", True)
+    assert tiny.destination_uris == [prefix + "000000000000.json"]
+
+    for num_bytes in [None, TINY_BYTES + 1]:
+        mid = plan_export(config, table(num_bytes))
+        assert (mid.strategy, mid.destination_uris) == ("mid", [config.temp_destination_uri])
+
+    huge = plan_export(config, table(3 * HUGE_BYTES))
+    assert huge.destination_uris == [prefix + "{:03d}-*.json".format(i) for i in range(3)]
+    assert len(plan_export(config, table(100 * HUGE_BYTES)).destination_uris) == MAX_WRITERS
+
+
+def test_plan_round_trips_through_the_checkpoint(config):
+    plan = plan_export(config, MagicMock(num_bytes=1, num_rows=1, range_partitioning=None))
+    assert plan.partitioned
+    assert ExportPlan.from_dict(plan.to_dict()) == plan
@@ -0,0 +1,66 @@
+from unittest.mock import patch
+
+import pytest
+from google.api_core.exceptions import ServiceUnavailable, TooManyRequests
+
+from utils.ratelimit import MutationScheduler, TokenBucket
+
+
+@patch("utils.ratelimit.monotonic", return_value=100.0)
+def test_token_bucket(monotonic):
+    bucket = TokenBucket(rate=2, burst=2)
+    assert bucket.reserve() == 0 and bucket.reserve() == 0
+    # overdrawn, the third caller waits for its token
+    assert bucket.reserve() == .5
+    assert bucket.reserve() == 1
+    monotonic.return_value = 102.0
+    assert bucket.reserve() == 0
+    bucket.pause(3)
+    assert bucket.reserve() == 3
+    # unlimited, until paused
+    bucket = TokenBucket(rate=0, burst=0)
+    assert bucket.reserve(1000) == 0
+    bucket.pause(1)
+    assert bucket.reserve() == 1
+
+
+@patch("utils.ratelimit.sleep")
+def test_object_writes_are_paced(sleep):
+    scheduler = MutationScheduler(object_rate=1, object_burst=1)
+    assert scheduler.wait("bucket", ["a"]) == 0
+    assert scheduler.wait("bucket", ["b"]) == 0
+    assert scheduler.wait("bucket", ["a"]) == pytest.approx(1, abs=.01)
+    sleep.assert_called_once()
+
+
+@patch("utils.ratelimit.sleep")
+def test_throttled_mutation_is_retried(sleep):
+    scheduler = MutationScheduler()
+    answers = [TooManyRequests("slow down"), ServiceUnavailable("scaling"), "composed"]
+
+    def mutation():
+        answer = answers.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+    assert scheduler.call(mutation, "bucket", ["final.csv"]) == "composed"
+    # the pauses after the 429 and the 503 are waited by the retries
+    assert sleep.call_count == 2
+
+
+@patch("utils.ratelimit.sleep")
+def test_retries_are_bounded(sleep):
+    def unavailable():
+        raise ServiceUnavailable("scaling")
+
+    def throttled():
+        raise TooManyRequests("slow down")
+
+    # a 503 may come after an append was applied
+    with pytest.raises(ServiceUnavailable):
+        MutationScheduler().call(unavailable, "bucket", ["final.csv"], idempotent=False)
+    assert sleep.call_count == 0
+    with pytest.raises(TooManyRequests):
+        MutationScheduler(retries=2).call(throttled, "bucket", ["final.csv"])
+    assert sleep.call_count == 2
@@ -0,0 +1,37 @@
+import importlib
+import sys
+
+from utils.startup import ImportTimer, StartupProfile, _group
+
+
+def test_group():
+    assert _group("google.cloud.bigquery.client") == "google.cloud.bigquery"
+    assert _group("google.auth.transport") == "google.auth"
+    assert _group("flask.app") == "flask"
+
+
+def test_import_timer():
+    sys.modules.pop("xml.dom.minidom", None)
+    timer = ImportTimer()
+    timer.install()
+    try:
+        importlib.import_module("xml.dom.minidom")
+    finally:
+        timer.uninstall()
+    assert timer not in sys.meta_path
+    assert dict(timer.top())["xml"] > 0
+
+
+def test_first_response_is_logged_once():
+    profile = StartupProfile()
+    profile.first_response()
+    assert not profile._first_response.is_set()
+    profile.start()
+    profile.imports.uninstall()
+    profile.begin("app_import")
+    profile.end("app_import")
+    profile.first_response()
+    profile.first_response()
+    assert profile._first_response.is_set()
+    report = profile.report()
+    assert report["phases"]["app_import"] >= 0 and report["seconds_since_start"] > 0
@@ -0,0 +1,112 @@
+import gzip
+from datetime import date, datetime, timezone
+from decimal import Decimal
+from unittest.mock import MagicMock
+
+import pytest
+from google.api_core.exceptions import BadRequest
+
+from benchmarks.fake_read import FakeReadClient
+from benchmarks.fake_storage import FakeStorageClient, patch_storage
+from utils.export import ExportConfig, run_export
+from utils.storage_read import encode_csv, encode_ndjson, run_storage_read_export
+
+TABLE = "projects/project_id/datasets/dataset_id/tables/table_id"
+ROWS = [{"id": i, "name": "name,{}".format(i), "flag": i % 2 == 0, "record": {"key": i}} for i in range(250)]
+
+
+def export(payload, read_client, storage_client):
+    config = ExportConfig.from_payload("dataset_id", "table_id", dict(payload, project="project_id",
+                                                                      bucket="bucket", engine="storage_read"))
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value.schema = [MagicMock(), MagicMock()]
+    bigquery_client.get_table.return_value.schema[0].name = "id"
+    bigquery_client.get_table.return_value.schema[1].name = "name"
+    with patch_storage(storage_client):
+        result = run_storage_read_export(config, storage_client, bigquery_client, read_client=read_client)
+    return config, result
+
+
+def test_encode_csv():
+    rows = [{"a": None, "b": True, "c": "x,y", "d": {"e": 1}}]
+    assert encode_csv(rows, ["a", "b", "c", "d.e", "d"]) == b',true,"x,y",1,"{""e"":""1""}"\n'
+
+
+def test_values_are_encoded_like_an_extract():
+    row = {"bytes": b"\x00\xff", "timestamp": datetime(2022, 1, 1, 12, 0, 0, 500000, tzinfo=timezone.utc),
+           "datetime": datetime(2022, 1, 1, 12, 0), "date": date(2022, 1, 1), "numeric": Decimal("1.500000000"),
+           "int": 1, "float": 1.5, "repeated": [1, 2]}
+    assert encode_ndjson([row]) == (b'{"bytes":"AP8=","timestamp":"2022-01-01 12:00:00.5 UTC",'
+                                    b'"datetime":"2022-01-01T12:00:00","date":"2022-01-01","numeric":"1.5",'
+                                    b'"int":"1","float":1.5,"repeated":["1","2"]}\n')
+    assert encode_csv([row], ["bytes", "timestamp", "numeric"]) == b"AP8=,2022-01-01 12:00:00.5 UTC,1.5\n"
+
+
+def test_storage_read_export_csv():
+    read_client = FakeReadClient({TABLE: ROWS}, page_size=10)
+    storage_client = FakeStorageClient()
+
+    config, result = export({"columns": ["id", "name"], "filter": "id < 1000"}, read_client, storage_client)
+
+    session = read_client.sessions[0]
+    assert len(session.streams) == 8
+    assert session.read_options == {"selected_fields": ["id", "name"], "row_restriction": "id < 1000"}
+    assert result["rows"] == 250
+    lines = storage_client.get(("bucket", config.file_path)).decode().splitlines()
+    assert lines[0] == "id,name "
+    assert sorted(lines[1:]) == sorted('{},"name,{}"'.format(i, i) for i in range(250))
+    # no temporary object
+    assert list(storage_client.objects) == [("bucket", config.file_path)]
+    assert "compose" not in storage_client.calls
+
+
+def test_storage_read_export_ndjson_gzip():
+    read_client = FakeReadClient({TABLE: ROWS}, page_size=7)
+    storage_client = FakeStorageClient()
+
+    config, result = export({"format": "ndjson", "compression": "gzip"}, read_client, storage_client)
+
+    assert config.file_path.endswith(".json.gz")
+    lines = gzip.decompress(storage_client.get(("bucket", config.file_path))).decode().splitlines()
+    assert len(lines) == 250
+    assert '{"id":"0","name":"name,0","flag":true,"record":{"key":"0"}}' in lines
+    assert storage_client.properties[("bucket", config.file_path)]["content_encoding"] == "gzip"
+
+
+def test_storage_read_export_failure_writes_nothing():
+    read_client = FakeReadClient({TABLE: ROWS}, page_size=10)
+    storage_client = FakeStorageClient()
+    read_client.failing.append("projects/project_id/locations/us/sessions/0/streams/3")
+
+    with pytest.raises(RuntimeError):
+        export({}, read_client, storage_client)
+    assert storage_client.objects == {}
+
+
+def test_storage_read_stops_reading_when_the_upload_fails(monkeypatch):
+    read_client = FakeReadClient({TABLE: ROWS}, page_size=1)
+    storage_client = FakeStorageClient()
+    encoded = []
+    monkeypatch.setattr("utils.storage_read.encode_csv", lambda page, header: encoded.append(page) or b"row\n")
+    # the header is written, the first page is not
+    monkeypatch.setattr("utils.storage_read._Unclosed.write", MagicMock(side_effect=[3, OSError("upload failed")]))
+
+    with pytest.raises(OSError):
+        export({}, read_client, storage_client)
+    # the streams stopped at their next page, instead of reading the table to the end
+    assert len(encoded) < len(ROWS) / 2
+
+
+def test_storage_read_rejects_unsupported_exports():
+    for payload in ({"format": "avro"}, {"incremental": True}, {"query": "SELECT 1"}):
+        with pytest.raises(BadRequest):
+            ExportConfig.from_payload("dataset_id", "table_id", dict(payload, engine="storage_read"))
+
+
+def test_run_export_dispatches_to_storage_read(monkeypatch):
+    run_storage_read_export = MagicMock()
+    monkeypatch.setattr("utils.storage_read.run_storage_read_export", run_storage_read_export)
+    config = ExportConfig.from_payload("dataset_id", "table_id", {"engine": "storage_read"})
+    storage_client, bigquery_client = MagicMock(), MagicMock()
+    assert run_export(config, storage_client, bigquery_client) == run_storage_read_export.return_value
+    bigquery_client.extract_table.assert_not_called()
@@ -0,0 +1,80 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+from google.cloud import bigquery
+
+from benchmarks.emulator import Emulator, endpoint, serve
+from utils import metrics
+from utils.aio import AsyncClient
+from utils.table_cache import TableCache
+
+
+def sample(name, **labels):
+    return metrics.registry.get_sample_value(name, labels) or 0
+
+
+def table(table_id, etag="etag-1", num_bytes=10):
+    return bigquery.Table.from_api_repr({
+        "tableReference": {"projectId": "project", "datasetId": "dataset", "tableId": table_id},
+        "etag": etag, "numBytes": str(num_bytes)})
+
+
+@patch("utils.table_cache.monotonic")
+def test_old_tables_are_revalidated_by_etag(monotonic):
+    cache = TableCache(ttl=60)
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.return_value = table("table")
+    hits, revalidated = sample("bigquery_table_cache_lookups_total", result="hit"), \
+        sample("bigquery_table_cache_lookups_total", result="revalidated")
+
+    monotonic.return_value = 0.0
+    first = cache.get(bigquery_client, "project", "dataset", "table")
+    assert cache.get(bigquery_client, "project", "dataset", "table") is first
+    bigquery_client.get_table.assert_called_once()
+    assert sample("bigquery_table_cache_lookups_total", result="hit") == hits + 1
+
+    # read again, the same etag keeps the cached table
+    monotonic.return_value = 61.0
+    assert cache.get(bigquery_client, "project", "dataset", "table") is first
+    assert bigquery_client.get_table.call_count == 2
+    assert sample("bigquery_table_cache_lookups_total", result="revalidated") == revalidated + 1
+
+    # changed since, read again by a caller which needs the current table
+    bigquery_client.get_table.return_value = table("table", "etag-2", 20)
+    assert cache.get(bigquery_client, "project", "dataset", "table", max_age=0).num_bytes == 20
+    assert cache.get(bigquery_client, "project", "dataset", "table").etag == "etag-2"
+
+
+def test_least_recently_used_tables_are_evicted():
+    cache = TableCache(max_tables=2)
+    bigquery_client = MagicMock()
+    bigquery_client.get_table.side_effect = lambda table_ref: table(table_ref.table_id)
+    evictions = sample("bigquery_table_cache_evictions_total")
+
+    for table_id in ["a", "b", "a", "c", "a"]:
+        cache.get(bigquery_client, "project", "dataset", table_id)
+    assert [call.args[0].table_id for call in bigquery_client.get_table.call_args_list] == ["a", "b", "c"]
+    assert sample("bigquery_table_cache_evictions_total") == evictions + 1
+
+
+def test_async_revalidation(monkeypatch):
+    emulator = Emulator()
+    server = serve(emulator)
+    monkeypatch.setenv("STORAGE_EMULATOR_HOST", endpoint(server))
+    monkeypatch.setenv("BIGQUERY_EMULATOR_HOST", endpoint(server))
+    cache = TableCache()
+
+    async def read():
+        client = AsyncClient()
+        first = await cache.aget(client, "project", "dataset", "table")
+        again = await cache.aget(client, "project", "dataset", "table", max_age=0)
+        await client.aclose()
+        return first, again
+
+    try:
+        first, again = asyncio.run(read())
+    finally:
+        server.shutdown()
+    # the second read had the same etag, the cached table is kept
+    assert again is first
+    assert emulator.calls["GET /bigquery/v2/projects/project/datasets/dataset/tables/*"] == 2
@@ -0,0 +1,86 @@
+import concurrent.futures
+import json
+
+import pytest
+from flask.testing import FlaskClient
+
+from benchmarks.fake_storage import FakeStorageClient
+from utils import tracing
+from utils.compose import compose_tree
+from utils.pipeline import Pipeline
+
+TRACE_ID = "105445aa7843bc8bf206b12000100000"
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemoryExporter()
+    tracing.set_exporter(exporter)
+    yield exporter
+    tracing.set_exporter(None)
+
+
+def test_unsampled_trace_records_nothing(exporter):
+    span, token = tracing.start_trace("request", f"{TRACE_ID}/1;o=0")
+    with tracing.span("child") as child:
+        child.set_attribute("key", "value")
+    tracing.end_trace(span, token)
+    assert span is tracing.NOOP_SPAN
+    assert child is tracing.NOOP_SPAN
+    assert exporter.spans == []
+
+
+def test_spans_are_parented_across_threads(exporter):
+    client = FakeStorageClient()
+    blobs = client.add_shards("bucket", "tmp/partition", 64)
+    root, token = tracing.start_trace("request", f"{TRACE_ID}/255;o=1")
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    pipeline = Pipeline("test")
+    pipeline.add("compose", lambda: compose_tree(client.bucket("bucket").blob("final.csv"), blobs, client,
+                                                 executor))
+    pipeline.run()
+    executor.shutdown()
+    tracing.end_trace(root, token)
+
+    spans = {span.name: span for span in exporter.spans}
+    assert root.trace_id == TRACE_ID
+    assert root.parent_span_id == "00000000000000ff"
+    assert spans["stage compose"].parent_span_id == root.span_id
+    assert spans["compose round"].parent_span_id == spans["stage compose"].span_id
+    chunks = [span for span in exporter.spans
+              if span.name == "compose" and span.parent_span_id == spans["compose round"].span_id]
+    assert len(chunks) == 2
+    assert {span.trace_id for span in exporter.spans} == {TRACE_ID}
+
+
+def test_span_records_errors(exporter):
+    root, token = tracing.start_trace("request", f"{TRACE_ID};o=1")
+    with pytest.raises(ValueError), tracing.span("failing"):
+        raise ValueError("failed")
+    tracing.end_trace(root, token)
+    assert exporter.spans[0].status == "error"
+    assert exporter.spans[0].attributes["error"] == "ValueError"
+
+
+def test_file_exporter(tmp_path):
+    path = tmp_path / "spans.jsonl"
+    tracing.set_exporter(tracing.FileExporter(str(path)))
+    try:
+        root, token = tracing.start_trace("request", f"{TRACE_ID};o=1")
+        with tracing.span("child", key="value"):
+            pass
+        tracing.end_trace(root, token)
+    finally:
+        tracing.set_exporter(None)
+    spans = [json.loads(line) for line in path.read_text().splitlines()]
+    assert [span["name"] for span in spans] == ["child", "request"]
+    assert spans[0]["attributes"] == {"key": "value"}
+
+
+def test_request_span(exporter, client: FlaskClient, monkeypatch):
+    monkeypatch.setattr("utils.metadata.project_id.get", lambda: "project_id")
+    client.get("/", headers={"X-Cloud-Trace-Context": f"{TRACE_ID}/1;o=1"})
+    client.get("/", headers={"X-Cloud-Trace-Context": f"{TRACE_ID}/1;o=0"})
+    assert len(exporter.spans) == 1
+    assert exporter.spans[0].name == "GET /"
+    assert exporter.spans[0].attributes["http.status_code"] == 200
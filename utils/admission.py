@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import hashlib
+import math
+import os
+import threading
+from time import monotonic
+from typing import Dict, List, Optional
+
+from utils import metrics
+from utils.bigquery import bq_table
+from utils.coalesce import export_key
+from utils.export import ExportConfig
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.table_cache import table_cache
+
+bigquery = lazy_import("google.cloud.bigquery")
+
+# Synchronous exports admitted at once, each holds a request thread: below the 8 threads of the gunicorn worker
+# so that some threads are left to answer the rejected requests, /jobs and /metrics. The background jobs and
+# the exports of the asynchronous service hold no request thread, only the shards bound them
+MAX_EXPORTS = int(os.environ.get("EXPORT_MAX_IN_FLIGHT", 6))
+# Estimated shards of every admitted export, the compose and delete calls of an export grow with its shards
+MAX_SHARDS = int(os.environ.get("EXPORT_MAX_SHARDS_IN_FLIGHT", 2000))
+# https://cloud.google.com/bigquery/docs/exporting-data#exporting_data_into_one_or_more_files
+SHARD_BYTES = 1 << 30
+# Seconds before the retry of a rejected export, until the duration of the exports is known
+RETRY_AFTER = 5
+MAX_RETRY_AFTER = 60
+# Weight of the last export in the average seconds per shard
+SMOOTHING = 0.2
+
+
+def estimate_shards(num_bytes: Optional[int]) -> int:
+    """
+    :param num_bytes: the size of the exported table, None if unknown
+    :return: the estimated number of files written by its extract, at least one
+    """
+    return max(1, math.ceil((num_bytes or 0) / SHARD_BYTES))
+
+
+def table_bytes(config: ExportConfig, bigquery_client: bigquery.Client) -> Optional[int]:
+    """
+    :return: the size of the exported table, an upper bound with columns or a filter, None for a query
+    """
+    if config.query:
+        return None
+    return bq_table(config.project, config.dataset_id, config.table_id, bigquery_client).num_bytes
+
+
+def cached_table_bytes(config: ExportConfig) -> Optional[int]:
+    """
+    The size of a table of a batch, without calling BigQuery for every table before the admission: the tables
+    not cached yet are looked up by their export, and estimated to a shard
+    :return: the size of the exported table if it is cached, None otherwise or for a query
+    """
+    if config.query:
+        return None
+    table = table_cache.peek(config.project, config.dataset_id, config.table_id)
+    return table.num_bytes if table is not None else None
+
+
+class Overloaded(Exception):
+    """The instance is over capacity, the request should be retried after ``retry_after`` seconds, on this
+    instance or on another one"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """The admission of an export, released when the export is done. The identical exports share it,
+    as they share the run of the export."""
+
+    def __init__(self, controller: "AdmissionController", key: str, shards: int, threaded: bool):
+        self.controller = controller
+        self.key = key
+        self.shards = shards
+        self.threaded = threaded
+        self.started = monotonic()
+        self.holders = 1
+
+    def __enter__(self) -> "Ticket":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """Bounds the exports running in the worker, by their estimated shards, and the synchronous exports of
+    the threaded service by their number, as each one holds a request thread.
+
+    An export over capacity is rejected at once rather than queued behind the busy threads, so that
+    the client retries after the ``Retry-After`` delay and Cloud Run routes it to, or starts, another
+    instance. An export larger than the whole budget is admitted when no other export runs.
+    """
+
+    def __init__(self, max_exports: int = MAX_EXPORTS, max_shards: int = MAX_SHARDS):
+        self.max_exports = max_exports
+        self.max_shards = max_shards
+        self._tickets: Dict[str, Ticket] = {}
+        # the tickets holding a request thread
+        self._threaded = 0
+        self._shards = 0
+        self._seconds_per_shard: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def admit(self, key: str, shards: int, threaded: bool = True) -> Ticket:
+        """
+        :param key: identifies the identical exports, which share the admission of the first one
+        :param shards: the estimated shards of the export
+        :param threaded: the export holds a request thread until it is done, bounded by ``max_exports``
+        :return: the admission, to release with ``with ticket:`` around the export
+        :raise Overloaded: the worker is over capacity
+        """
+        with self._lock:
+            ticket = self._tickets.get(key)
+            if ticket is not None:
+                ticket.holders += 1
+                metrics.ADMISSIONS.labels(result="shared").inc()
+                return ticket
+            if (threaded and self._threaded >= self.max_exports) or \
+                    (self._tickets and self._shards + shards > self.max_shards):
+                retry_after = self._retry_after()
+                metrics.ADMISSIONS.labels(result="rejected").inc()
+                message = "{} exports of {} estimated shards in flight, retry in {}s".format(
+                    len(self._tickets), self._shards, retry_after)
+                logger.warning("Rejected an export of {} estimated shards: {}".format(shards, message))
+                raise Overloaded(message, retry_after)
+            ticket = self._tickets[key] = Ticket(self, key, shards, threaded)
+            self._threaded += threaded
+            self._shards += shards
+            metrics.ADMISSIONS.labels(result="admitted").inc()
+            metrics.ADMITTED_SHARDS.set(self._shards)
+            return ticket
+
+    def release(self, ticket: Ticket) -> None:
+        with self._lock:
+            ticket.holders -= 1
+            if ticket.holders:
+                return
+            del self._tickets[ticket.key]
+            self._threaded -= ticket.threaded
+            self._shards -= ticket.shards
+            metrics.ADMITTED_SHARDS.set(self._shards)
+            seconds = (monotonic() - ticket.started) / ticket.shards
+            self._seconds_per_shard = seconds if self._seconds_per_shard is None \
+                else SMOOTHING * seconds + (1 - SMOOTHING) * self._seconds_per_shard
+
+    def _retry_after(self) -> int:
+        """
+        :return: the seconds until the first admitted export is expected to be done
+        """
+        if self._seconds_per_shard is None or not self._tickets:
+            return RETRY_AFTER
+        now = monotonic()
+        remaining = min(ticket.started + ticket.shards * self._seconds_per_shard - now
+                        for ticket in self._tickets.values())
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(remaining)))
+
+    def admit_export(self, config: ExportConfig, num_bytes: Optional[int], threaded: bool = True) -> Ticket:
+        """
+        :param config: the export configuration
+        :param num_bytes: the size of the exported table, see ``table_bytes``
+        :param threaded: the export holds a request thread, see ``admit``
+        :return: the admission of the export
+        :raise Overloaded: the worker is over capacity
+        """
+        return self.admit(export_key(config), estimate_shards(num_bytes), threaded)
+
+    def admit_batch(self, configs: List[ExportConfig], num_bytes: List[Optional[int]],
+                    threaded: bool = True) -> Ticket:
+        """
+        Admit a batch as a whole, as one export of the estimated shards of all its tables. The tables of a
+        batch share the threads of the batch, bounded by its stage limits.
+        :param configs: the export configurations of the batch
+        :param num_bytes: the size of each exported table, see ``cached_table_bytes``
+        :param threaded: the batch holds a request thread, see ``admit``
+        :return: the admission of the batch
+        :raise Overloaded: the worker is over capacity
+        """
+        key = "batch-" + hashlib.sha256("".join(sorted(export_key(config) for config in configs))
+                                        .encode("utf-8")).hexdigest()
+        return self.admit(key, sum(estimate_shards(size) for size in num_bytes), threaded)
+
+
+admission = AdmissionController()
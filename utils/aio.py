@@ -0,0 +1,267 @@
+import asyncio
+import json
+import os
+import random
+import re
+import uuid
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+import google.auth
+import httpx
+from google.api_core import exceptions
+from google.auth.credentials import AnonymousCredentials
+from google.auth.transport.requests import Request
+
+from utils.clients import SCOPES, emulator_hosts
+from utils.logging import logger
+
+STORAGE_API = "https://storage.googleapis.com"
+BIGQUERY_API = "https://bigquery.googleapis.com"
+
+# Connections to the APIs, shared by every export of the process
+MAX_CONNECTIONS = int(os.environ.get("ASYNC_HTTP_MAX_CONNECTIONS", 100))
+HTTP_TIMEOUT = 60.0
+# Transient errors are retried with a jittered exponential backoff, the mutations of the exports are
+# retried by the ``utils.ratelimit.scheduler`` instead
+RETRIES = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+JOB_POLL = 0.5
+JOB_MAX_POLL = 5.0
+# https://cloud.google.com/bigquery/docs/error-messages
+JOB_ERRORS = {"notFound": 404, "accessDenied": 403, "duplicate": 409, "rateLimitExceeded": 429,
+              "backendError": 500, "internalError": 500}
+
+
+def _message(response: httpx.Response) -> str:
+    try:
+        return response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        return response.text
+
+
+class AsyncClient:
+    """The calls of the export to the GCS JSON API and the BigQuery REST API, awaited instead of
+    holding a thread. One client, and its connection pool, is shared by the exports of the process.
+
+    The errors are raised as the ``google.api_core.exceptions`` of the synchronous clients.
+    """
+
+    def __init__(self, max_connections: int = MAX_CONNECTIONS):
+        self.max_connections = max_connections
+        storage_host, bigquery_host = emulator_hosts()
+        self.storage_api = storage_host or STORAGE_API
+        self.bigquery_api = bigquery_host or BIGQUERY_API
+        self.project: Optional[str] = None
+        self._credentials = None
+        self._http: Optional[httpx.AsyncClient] = None
+        self._lock = asyncio.Lock()
+
+    async def _headers(self) -> Dict[str, str]:
+        if self._credentials is None or not self._credentials.valid:
+            async with self._lock:
+                if self._credentials is None:
+                    if any(emulator_hosts()):
+                        self._credentials = AnonymousCredentials()
+                        self.project = os.environ.get("GOOGLE_CLOUD_PROJECT")
+                    else:
+                        self._credentials, self.project = await asyncio.to_thread(google.auth.default,
+                                                                                  scopes=SCOPES)
+                if not self._credentials.valid:
+                    await asyncio.to_thread(self._credentials.refresh, Request())
+        headers: Dict[str, str] = {}
+        self._credentials.apply(headers)
+        return headers
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=HTTP_TIMEOUT, limits=httpx.Limits(
+                max_connections=self.max_connections, max_keepalive_connections=self.max_connections))
+        return self._http
+
+    async def request(self, method: str, url: str, headers: Dict[str, str] = None, retries: int = RETRIES,
+                      **kwargs) -> httpx.Response:
+        """
+        :param method: the HTTP method
+        :param url: the url of the call
+        :param retries: the retries of the transient errors
+        :param kwargs: forwarded to httpx (params, json, content)
+        :return: the response, the errors are raised
+        """
+        for attempt in range(retries + 1):
+            response = await self.http.request(method, url, headers={**await self._headers(), **(headers or {})},
+                                               **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                break
+            delay = min(2 ** attempt * .5, 8) * random.uniform(.5, 1)
+            logger.warning("{} {} answered {}, retrying in {:.1f}s".format(method, url, response.status_code, delay))
+            await asyncio.sleep(delay)
+        if response.status_code >= 400:
+            raise exceptions.from_http_status(response.status_code, _message(response), response=response)
+        return response
+
+    # ------------------------------------------------------------------------------------------------------- storage
+
+    def _object_url(self, bucket: str, name: str) -> str:
+        return "{}/storage/v1/b/{}/o/{}".format(self.storage_api, bucket, quote(name, safe=""))
+
+    async def get_object(self, bucket: str, name: str) -> Dict:
+        return (await self.request("GET", self._object_url(bucket, name))).json()
+
+    async def download(self, bucket: str, name: str) -> bytes:
+        return (await self.request("GET", self._object_url(bucket, name), params={"alt": "media"})).content
+
+    async def list_objects(self, bucket: str, prefix: str) -> List[Dict]:
+        """
+        :return: the objects whose name starts with ``prefix``, in lexicographic order
+        """
+        objects, params = [], {"prefix": prefix}
+        while True:
+            page = (await self.request("GET", "{}/storage/v1/b/{}/o".format(self.storage_api, bucket),
+                                       params=params)).json()
+            objects.extend(page.get("items", []))
+            if "nextPageToken" not in page:
+                return objects
+            params["pageToken"] = page["nextPageToken"]
+
+    async def upload(self, bucket: str, name: str, data: bytes, resource: Dict = None,
+                     if_generation_match: int = None, retries: int = RETRIES) -> Dict:
+        """
+        Upload in a single multipart request
+        :param resource: the properties of the object (contentType, contentEncoding, metadata)
+        :param if_generation_match: the expected generation, 0 if the object must not exist
+        :param retries: the retries of the transient errors
+        :return: the object
+        """
+        boundary = "==={}===".format(uuid.uuid4().hex)
+        content_type = (resource or {}).get("contentType") or "application/octet-stream"
+        body = b"".join([
+            "--{}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n".format(boundary).encode("utf-8"),
+            json.dumps(dict(resource or {}, name=name)).encode("utf-8"),
+            "\r\n--{}\r\nContent-Type: {}\r\n\r\n".format(boundary, content_type).encode("utf-8"),
+            data,
+            "\r\n--{}--\r\n".format(boundary).encode("utf-8"),
+        ])
+        params = {"uploadType": "multipart"}
+        if if_generation_match is not None:
+            params["ifGenerationMatch"] = if_generation_match
+        response = await self.request("POST", "{}/upload/storage/v1/b/{}/o".format(self.storage_api, bucket),
+                                      params=params, content=body, retries=retries,
+                                      headers={"Content-Type": 'multipart/related; boundary="{}"'.format(boundary)})
+        return response.json()
+
+    async def compose(self, bucket: str, name: str, sources: Iterable[str], resource: Dict = None,
+                      retries: int = RETRIES) -> Dict:
+        """
+        :param sources: the names of up to 32 objects of the bucket, in order
+        :param resource: the properties of the composite
+        :param retries: the retries of the transient errors
+        :return: the composite
+        """
+        body = {"sourceObjects": [{"name": source} for source in sources], "destination": resource or {}}
+        return (await self.request("POST", self._object_url(bucket, name) + "/compose", json=body,
+                                   retries=retries)).json()
+
+    async def delete(self, bucket: str, name: str, if_generation_match: int = None) -> None:
+        params = {} if if_generation_match is None else {"ifGenerationMatch": if_generation_match}
+        await self.request("DELETE", self._object_url(bucket, name), params=params)
+
+    async def delete_batch(self, bucket: str, names: List[str], retries: int = RETRIES) -> List[Tuple[str, int]]:
+        """
+        Delete objects with a single batch request
+        :param names: up to 100 objects of the bucket
+        :param retries: the retries of the transient errors of the batch request
+        :return: the HTTP status of the delete of every object
+        """
+        boundary = "batch_{}".format(uuid.uuid4().hex)
+        body = "".join("--{}\r\nContent-Type: application/http\r\nContent-ID: <{}>\r\n\r\n"
+                       "DELETE /storage/v1/b/{}/o/{} HTTP/1.1\r\n\r\n\r\n".format(boundary, i, bucket,
+                                                                                  quote(name, safe=""))
+                       for i, name in enumerate(names)) + "--{}--\r\n".format(boundary)
+        response = await self.request("POST", "{}/batch/storage/v1".format(self.storage_api),
+                                      content=body.encode("utf-8"), retries=retries,
+                                      headers={"Content-Type": 'multipart/mixed; boundary="{}"'.format(boundary)})
+        statuses = [int(status) for status in re.findall(r"HTTP/1\.1 (\d{3})", response.text)]
+        if len(statuses) != len(names):
+            raise ValueError("Expected {} responses in the batch, got {}".format(len(names), len(statuses)))
+        return list(zip(names, statuses))
+
+    # ------------------------------------------------------------------------------------------------------ bigquery
+
+    def _table_url(self, project: str, dataset_id: str, table_id: str) -> str:
+        return "{}/bigquery/v2/projects/{}/datasets/{}/tables/{}".format(self.bigquery_api, project, dataset_id,
+                                                                         table_id)
+
+    async def get_table(self, project: str, dataset_id: str, table_id: str) -> Dict:
+        return (await self.request("GET", self._table_url(project, dataset_id, table_id))).json()
+
+    async def insert_table(self, project: str, dataset_id: str, table_id: str, body: Dict = None) -> Dict:
+        """
+        :param body: the properties of the table, e.g. its expirationTime
+        :return: the table, the existing one if a retried insert was already applied
+        """
+        url = "{}/bigquery/v2/projects/{}/datasets/{}/tables".format(self.bigquery_api, project, dataset_id)
+        reference = {"projectId": project, "datasetId": dataset_id, "tableId": table_id}
+        try:
+            return (await self.request("POST", url, json=dict(body or {}, tableReference=reference))).json()
+        except exceptions.Conflict:
+            return await self.get_table(project, dataset_id, table_id)
+
+    async def delete_table(self, project: str, dataset_id: str, table_id: str) -> None:
+        try:
+            await self.request("DELETE", self._table_url(project, dataset_id, table_id))
+        except exceptions.NotFound:
+            pass
+
+    async def cancel_job(self, project: str, location: str, job_id: str) -> None:
+        logger.info("Cancelling the job {}".format(job_id))
+        try:
+            await self.request("POST", "{}/bigquery/v2/projects/{}/jobs/{}/cancel".format(self.bigquery_api, project,
+                                                                                         job_id),
+                               params={"location": location}, retries=0)
+        except Exception as e:
+            logger.warning("Could not cancel the job {}: {}".format(job_id, e))
+
+    async def run_job(self, project: str, location: str, configuration: Dict, job_id: str = None,
+                      poll: Callable[[], None] = None) -> Dict:
+        """
+        Insert a job and poll it with an exponential backoff until it is done
+        :param configuration: the configuration of the job (extract, query)
+        :param job_id: the id of the job, an existing job of this id is waited for instead, a new id by default
+        :param poll: called while the job runs, raises to stop waiting for it
+        :return: the done job
+        """
+        reference = {"projectId": project, "jobId": job_id or "export_{}".format(uuid.uuid4().hex),
+                     "location": location}
+        url = "{}/bigquery/v2/projects/{}/jobs".format(self.bigquery_api, project)
+        try:
+            job = (await self.request("POST", url, json={"jobReference": reference,
+                                                         "configuration": configuration})).json()
+        except exceptions.Conflict:
+            # the id is generated once, a retried insert whose first attempt was applied, or the retry of an
+            # interrupted export, finds its job
+            logger.info("Job {} already inserted, attaching to it".format(reference["jobId"]))
+            job = {}
+        delay = JOB_POLL
+        try:
+            while job.get("status", {}).get("state") != "DONE":
+                if poll:
+                    poll()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, JOB_MAX_POLL)
+                job = (await self.request("GET", "{}/{}".format(url, reference["jobId"]),
+                                          params={"location": location})).json()
+        except asyncio.CancelledError:
+            # the pipeline failed, the job is not needed anymore
+            await self.cancel_job(project, location, reference["jobId"])
+            raise
+        error = job["status"].get("errorResult")
+        if error:
+            raise exceptions.from_http_status(JOB_ERRORS.get(error.get("reason"), 400), error.get("message", ""))
+        return job
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
@@ -0,0 +1,436 @@
+from __future__ import annotations
+
+import asyncio
+import gzip
+import json
+import uuid
+from dataclasses import replace
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from google.api_core.exceptions import NotFound, PreconditionFailed
+
+from utils import metrics, tracing
+from utils.aio import AsyncClient
+from utils.bigquery import TEMP_TABLE_EXPIRATION, TEMP_TABLE_PREFIX
+from utils.coalesce import (LOCK_TTL, LOCK_WAIT, current_result, export_key, fingerprint, flights, lock_delays,
+                            lock_expired, lock_metadata, lock_owner, lock_uri, recorded)
+from utils.checkpoint import AsyncCheckpoint, Terminated, checkpoint_uri, terminating
+from utils.compose import (MAX_BATCH_SIZE, MAX_COMPOSE_SOURCES, compose_prefix, compose_progress, composite_names,
+                           delete_summary, failed_deletes, generate_chunks)
+from utils.export import ExportConfig
+from utils.formats import compose_merge, manifest
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import AsyncPipeline, Progress
+from utils.ratelimit import scheduler
+from utils.table_cache import table_cache
+
+bigquery = lazy_import("google.cloud.bigquery")
+
+
+def is_native(config: ExportConfig) -> bool:
+    """
+    :return: whether the export runs on the event loop, the other exports run in a thread on the synchronous clients
+    """
+    return config.engine == "extract" and not config.incremental
+
+
+def _split(uri: str) -> Tuple[str, str]:
+    bucket, _, name = uri[len("gs://"):].partition("/")
+    return bucket, name
+
+
+def _header_file(header: List[str], compression: Optional[str]) -> Tuple[bytes, str]:
+    """
+    :return: the content of the header file and its content type, as written by the synchronous export
+    """
+    if not header:
+        return b"", "application/octet-stream"
+    line = f"{','.join(header)} \n".encode("utf-8")
+    if compression == "gzip":
+        return gzip.compress(line), "application/gzip"
+    return line, "text/csv"
+
+
+async def compose_tree(client: AsyncClient, bucket: str, destination: str, sources: List[Dict],
+                       resource: Dict = None, fan_in: int = MAX_COMPOSE_SOURCES, resume: Dict = None,
+                       on_round: Callable[[Dict], Awaitable[None]] = None, prefix: str = None) -> List[str]:
+    """
+    ``utils.compose.compose_tree`` on the event loop, the composes are paced by the mutation scheduler
+    :param sources: ordered list of the objects of the bucket to compose
+    :param resource: the properties of the destination
+    :param resume: the progress passed to ``on_round`` by an interrupted compose, continued after its last round
+    :param on_round: awaited with the progress of the compose once a round is done
+    :param prefix: the prefix of the intermediate composites, a new one by default
+    :return: the names of the intermediate composites, to be deleted by the caller
+    """
+
+    async def compose(composite: str, names: List[str], properties: Dict = None) -> None:
+        # retried by the scheduler only, which paces the retries of every export
+        await scheduler.acall(lambda: client.compose(bucket, composite, names, properties, retries=0),
+                              bucket, [composite])
+
+    if resume:
+        names, intermediates = list(resume["sources"]), list(resume["intermediates"])
+        round_index, prefix = resume["round"], resume["prefix"]
+        logger.info("Resuming compose of {} at round {}".format(destination, round_index))
+    else:
+        metrics.COMPOSED_BYTES.inc(sum(int(source.get("size", 0)) for source in sources))
+        names = [source["name"] for source in sources]
+        intermediates = []
+        round_index = 0
+        prefix = prefix or compose_prefix(destination)
+    metrics.COMPOSE_SOURCES.observe(len(names))
+    while len(names) > fan_in:
+        chunks = generate_chunks(names, fan_in)
+        composites = composite_names(prefix, round_index, len(chunks))
+        logger.info("Compose round {}: {} blobs into {} composites.".format(round_index, len(names), len(chunks)))
+        with metrics.timed(metrics.COMPOSE_ROUND_SECONDS, round=str(round_index)), \
+                tracing.span("compose round", round=round_index, composites=len(chunks)):
+            await asyncio.gather(*[compose(composite, chunk) for composite, chunk in zip(composites, chunks)])
+        metrics.COMPOSES.inc(len(chunks))
+        intermediates.extend(composites)
+        names = composites
+        round_index += 1
+        if on_round:
+            await on_round(compose_progress(prefix, round_index, names, list(intermediates)))
+
+    logger.info("Composing {} blobs to {}...".format(len(names), destination))
+    with metrics.timed(metrics.COMPOSE_ROUND_SECONDS, round="final"), \
+            tracing.span("compose", destination=destination, sources=len(names)):
+        await compose(destination, names, resource)
+    metrics.COMPOSES.inc()
+    return intermediates
+
+
+async def delete_objects(client: AsyncClient, bucket: str, names: List[str], retries: int = 3) -> Dict:
+    """
+    ``utils.compose.delete_objects_concurrent`` on the event loop, paced by the mutation scheduler
+    :return: summary of the deleted and failed objects
+    """
+
+    async def delete_batch(batch: List[str], attempt: int) -> List[str]:
+        await scheduler.await_tokens(bucket, batch)
+        try:
+            with tracing.span("delete batch", blobs=len(batch)):
+                statuses = await client.delete_batch(bucket, batch, retries=0)
+        except Exception as e:
+            logger.warning("Batch delete of {} blobs failed: {}".format(len(batch), e))
+            scheduler.pause_after(bucket, batch, int(getattr(e, "code", None) or 500), attempt)
+            return batch
+        return failed_deletes(bucket, statuses, attempt)
+
+    pending = list(names)
+    with metrics.timed(metrics.DELETE_SECONDS):
+        for attempt in range(retries + 1):
+            if attempt:
+                # after the pause of the failed deletes, waited by the next batches
+                logger.info("Retrying delete of {} blobs, attempt {}".format(len(pending), attempt))
+            failed = await asyncio.gather(*[delete_batch(batch, attempt + 1)
+                                            for batch in generate_chunks(pending, MAX_BATCH_SIZE)])
+            pending = [name for batch in failed for name in batch]
+            if not pending:
+                break
+    return delete_summary(len(names), pending)
+
+
+async def run_export(config: ExportConfig, client: AsyncClient, progress: Progress = None,
+                     metadata: Dict[str, str] = None, table: bigquery.Table = None,
+                     checkpoint: AsyncCheckpoint = None) -> Dict:
+    """
+    The extract export of ``utils.export.run_export``, with the same stages and checkpoint, awaiting the calls
+    :param config: the export configuration, see ``is_native``
+    :param client: the asynchronous client of the APIs
+    :param progress: callback notified when a stage starts and ends
+    :param metadata: custom metadata set on the final file
+    :param table: the exported table if already fetched, with its schema and statistics
+    :param checkpoint: the progress of the export, saved after every stage
+    :return: the result of the export, with its plan
+    """
+    from utils.planner import ExportPlan, plan_export
+
+    export_format = config.export_format
+    bucket = config.bucket
+    logger.info("Filename : {}{}, format {}".format(config.file_name, config.extension, export_format.name))
+    logger.info("With Header : {}".format(config.with_header))
+    if checkpoint is not None:
+        # the temporary files of the resumed run
+        config = replace(config, run_id=await checkpoint.aresume(config.run_id))
+
+    def saved(stage: str, default=None):
+        return checkpoint.get(stage, default) if checkpoint is not None else default
+
+    async def save(stage: str, result) -> None:
+        if checkpoint is not None:
+            await checkpoint.asave(stage, result)
+
+    async def query() -> str:
+        if saved("query"):
+            return saved("query")
+        table_id = "{}{}".format(TEMP_TABLE_PREFIX, uuid.uuid4().hex)
+        destination = {"projectId": config.project, "datasetId": config.dataset_id, "tableId": table_id}
+        # created with its expiration before the query writes it, the table is never left without one
+        expires = datetime.now(timezone.utc) + TEMP_TABLE_EXPIRATION
+        await client.insert_table(config.project, config.dataset_id, table_id,
+                                  {"expirationTime": str(int(expires.timestamp() * 1000))})
+        logger.info("Querying {} into {}:{}.{}".format(config.query_sql, config.project, config.dataset_id, table_id))
+        await client.run_job(config.project, config.location, {"query": {
+            "query": config.query_sql, "useLegacySql": False, "destinationTable": destination,
+            "writeDisposition": "WRITE_TRUNCATE"}})
+        await save("query", table_id)
+        return table_id
+
+    async def source_table(query: str = None) -> bigquery.Table:
+        if table is not None and not query:
+            return table
+        return await table_cache.aget(client, config.project, config.dataset_id, query or config.table_id)
+
+    async def plan(query: str = None) -> ExportPlan:
+        if saved("plan"):
+            # the files of the resumed run
+            return ExportPlan.from_dict(saved("plan"))
+        export_plan = plan_export(config, await source_table(query))
+        await save("plan", export_plan.to_dict())
+        return export_plan
+
+    async def extract(plan: ExportPlan, query: str = None) -> None:
+        if saved("extract"):
+            logger.info("Shards of run {} already extracted".format(config.run_id))
+            return
+        # the job of an interrupted attempt is reattached
+        job_id = "export_{}".format(config.run_id) if checkpoint is not None else None
+        source = {"projectId": config.project, "datasetId": config.dataset_id, "tableId": query or config.table_id}
+        extract_config = {"sourceTable": source, "destinationUris": plan.destination_uris,
+                          "printHeader": False, "destinationFormat": export_format.destination_format}
+        if config.compression:
+            extract_config["compression"] = config.compression.upper()
+        logger.info("Extracting {}:{}.{} to {}".format(config.project, config.dataset_id, source["tableId"],
+                                                      plan.destination_uris))
+        with metrics.timed(metrics.EXTRACT_SECONDS, format=export_format.destination_format), \
+                tracing.span("bigquery extract", table="{}.{}.{}".format(config.project, config.dataset_id,
+                                                                        source["tableId"])):
+            await client.run_job(config.project, config.location, {"extract": extract_config}, job_id=job_id,
+                                 poll=checkpoint.check if checkpoint is not None else None)
+        await save("extract", job_id or True)
+
+    async def list_shards(extract: None, plan: ExportPlan) -> List[Dict]:
+        if plan.single_file:
+            return [{"name": _split(uri)[1]} for uri in plan.destination_uris]
+        if saved("list_shards"):
+            return [{"name": name} for name in saved("list_shards")]
+        shards = await client.list_objects(bucket, config.temp_file_prefix)
+        if shards:
+            await save("list_shards", [shard["name"] for shard in shards])
+        return shards
+
+    async def header(query: str = None) -> List[str]:
+        if table is not None and not query:
+            return [field.name for field in table.schema]
+        source = await table_cache.aget(client, config.project, config.dataset_id, query or config.table_id)
+        return [field.name for field in source.schema]
+
+    async def upload(name: str, data: bytes, resource: Dict) -> Dict:
+        return await scheduler.acall(lambda: client.upload(bucket, name, data, resource, retries=0), bucket, [name])
+
+    async def header_file(header: List[str]) -> Dict:
+        data, content_type = _header_file(header, config.compression)
+        return await upload(_split(config.temp_header_uri)[1], data, {"contentType": content_type})
+
+    async def write_manifest(list_shards: List[Dict]) -> List[str]:
+        try:
+            previous = json.loads(await client.download(bucket, config.file_path)).get("files", [])
+        except NotFound:
+            previous = []
+        files = ["gs://{}/{}".format(bucket, shard["name"]) for shard in list_shards]
+        logger.info("Writing manifest of {} files to {}".format(len(files), config.file_uri))
+        await upload(config.file_path, manifest(export_format, config.compression, files),
+                     {"contentType": "application/json", "metadata": metadata})
+        # the files of the previous export, see ``utils.formats.manifest_merge``
+        return [_split(uri)[1] for uri in previous if uri not in files]
+
+    async def compose(list_shards: List[Dict], header_file: Dict = None) -> List[str]:
+        if not list_shards:
+            raise ValueError('file not found')
+        if export_format.merge is compose_merge:
+            resource = {"contentType": export_format.content_type, "metadata": metadata,
+                        "contentEncoding": export_format.content_encoding(config.compression)}
+            sources = ([header_file] if header_file else []) + list_shards
+            temporaries = await compose_tree(client, bucket, config.file_path, sources,
+                                             {key: value for key, value in resource.items() if value},
+                                             resume=saved("compose"), on_round=lambda round: save("compose", round),
+                                             prefix=config.temp_compose_prefix)
+        else:
+            temporaries = await write_manifest(list_shards)
+        if checkpoint is not None:
+            # the final file is there, a retry exports again
+            await checkpoint.adelete()
+        return temporaries
+
+    async def cleanup(list_shards: List[Dict] = None, compose: List[str] = None, header_file: Dict = None,
+                      query: str = None) -> None:
+        if terminating.is_set() or isinstance(pipeline.error, Terminated):
+            # stopped by the shutdown, the retry resumes from the temporary files
+            return
+        if query:
+            logger.info("Deleting {}:{}.{}".format(config.project, config.dataset_id, query))
+            await client.delete_table(config.project, config.dataset_id, query)
+        if compose is None:
+            # the export failed, its shards and the composites of an interrupted compose are not part of any
+            # final file
+            if list_shards is None:
+                list_shards = await client.list_objects(bucket, config.temp_file_prefix)
+            intermediates = await client.list_objects(bucket, config.temp_compose_prefix)
+            temporaries = [blob["name"] for blob in ([header_file] if header_file else []) + list_shards
+                           + intermediates]
+        elif export_format.merge is compose_merge:
+            temporaries = [blob["name"] for blob in ([header_file] if header_file else []) + list_shards] + compose
+        else:
+            # the exported files of a manifest are the result, only those of the replaced manifest are deleted
+            temporaries = compose
+        if temporaries:
+            await delete_objects(client, bucket, temporaries)
+
+    pipeline = AsyncPipeline("export {}.{}".format(config.dataset_id, config.table_id), progress)
+    source_deps = []
+    if config.query_sql:
+        pipeline.add("query", query)
+        source_deps.append("query")
+    pipeline.add("plan", plan, deps=source_deps)
+    pipeline.add("extract", extract, deps=["plan"] + source_deps)
+    pipeline.add("list_shards", list_shards, deps=["extract", "plan"])
+    merge_deps = ["list_shards"]
+    if export_format.header:
+        pipeline.add("header", header, deps=source_deps)
+        pipeline.add("header_file", header_file, deps=["header"])
+        merge_deps.append("header_file")
+    pipeline.add("compose", compose, deps=merge_deps)
+    pipeline.add("cleanup", cleanup, deps=merge_deps + source_deps + ["compose"], detached=True, always=True)
+    try:
+        results = await pipeline.run()
+    except Terminated:
+        raise
+    except Exception:
+        if checkpoint is not None:
+            # the temporary files it lists are deleted by the cleanup
+            await checkpoint.adelete()
+        raise
+
+    logger.info("final result : {}".format(config.file_uri))
+    return {"path": config.file_uri, "format": export_format.name, "timings": pipeline.timings,
+            "plan": results["plan"].to_dict()}
+
+
+class GcsLock:
+    """The lease of ``utils.coalesce.GcsLock`` on the event loop, both exclude each other"""
+
+    def __init__(self, uri: str, client: AsyncClient, ttl: int = LOCK_TTL):
+        self.bucket, self.name = _split(uri)
+        self.client = client
+        self.ttl = ttl
+        self.owner = lock_owner()
+        self.generation: Optional[int] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    async def _write(self, if_generation_match: int) -> None:
+        blob = await self.client.upload(self.bucket, self.name, self.owner.encode("utf-8"), {
+            "contentType": "text/plain", "metadata": lock_metadata(self.owner, self.ttl)},
+            if_generation_match=if_generation_match)
+        self.generation = int(blob["generation"])
+
+    async def _break_expired(self) -> None:
+        try:
+            blob = await self.client.get_object(self.bucket, self.name)
+            if not lock_expired(blob.get("metadata")):
+                return
+            logger.warning("Breaking the expired lock gs://{}/{} of {}".format(
+                self.bucket, self.name, (blob.get("metadata") or {}).get("owner")))
+            await self.client.delete(self.bucket, self.name, if_generation_match=int(blob["generation"]))
+        except (NotFound, PreconditionFailed):
+            # released or renewed meanwhile
+            pass
+
+    async def try_acquire(self) -> bool:
+        try:
+            await self._write(if_generation_match=0)
+        except PreconditionFailed:
+            await self._break_expired()
+            return False
+        self._heartbeat = asyncio.create_task(self._renew())
+        return True
+
+    async def acquire(self, timeout: float = LOCK_WAIT) -> None:
+        delays = lock_delays("gs://{}/{}".format(self.bucket, self.name), timeout)
+        while not await self.try_acquire():
+            await asyncio.sleep(next(delays))
+        logger.info("Acquired lock gs://{}/{}".format(self.bucket, self.name))
+
+    async def _renew(self) -> None:
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self._write(if_generation_match=self.generation)
+            except Exception as err:
+                logger.error("Lost lock gs://{}/{}: {}".format(self.bucket, self.name, err))
+                return
+
+    async def release(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.cancel()
+        try:
+            await self.client.delete(self.bucket, self.name, if_generation_match=self.generation)
+        except (NotFound, PreconditionFailed) as err:
+            logger.warning("Lock gs://{}/{} was not held anymore: {}".format(self.bucket, self.name, err))
+
+    async def __aenter__(self) -> "GcsLock":
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.release()
+
+
+async def cached_result(config: ExportConfig, metadata: Dict[str, str], client: AsyncClient) -> Optional[Dict]:
+    """
+    :return: the result of the previous export if its final file was produced from the same table and options
+    """
+    try:
+        blob = await client.get_object(config.bucket, config.file_path)
+    except NotFound:
+        return None
+    return current_result(config, metadata, blob.get("metadata"))
+
+
+async def export_once(config: ExportConfig, client: AsyncClient, progress: Progress = None) -> Dict:
+    """
+    ``utils.coalesce.export_once`` on the event loop: the result cache, the coalescing of identical
+    exports, the lock of the final file and the checkpoint are the same, and shared with the synchronous
+    service. An export stopped by the shutdown of the instance is resumed by its retry, on any instance.
+    :param config: the export configuration, see ``is_native``
+    :param client: the asynchronous client of the APIs
+    :param progress: callback notified when a stage starts and ends
+    :return: the result of the export, "cached" if the previous file was returned
+    """
+
+    async def export() -> Dict:
+        table = None
+        if not config.query:
+            table = await table_cache.aget(client, config.project, config.dataset_id, config.table_id, max_age=0)
+        metadata, cacheable = fingerprint(config, table)
+        result = cacheable and await cached_result(config, metadata, client)
+        if result:
+            return result
+
+        async with GcsLock(lock_uri(config), client):
+            result = cacheable and await cached_result(config, metadata, client)
+            if result:
+                return result
+            checkpoint = AsyncCheckpoint(checkpoint_uri(config.bucket, config.folder, config.table_id, key), client,
+                                         fingerprint=metadata)
+            with checkpoint:
+                return await run_export(config, client, progress, metadata=metadata, table=table,
+                                        checkpoint=checkpoint)
+
+    key = export_key(config)
+    with recorded(config) as done:
+        return done(*await flights.ado(key, export))
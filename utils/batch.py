@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import concurrent.futures
+import os
+import threading
+import traceback
+from typing import Dict, List
+
+from google.api_core.exceptions import BadRequest
+
+from utils.bigquery import TEMP_TABLE_PREFIX
+from utils.coalesce import export_once
+from utils.export import DEFAULT_PROJECT, ExportConfig
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import Progress
+
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+
+# Concurrent runs of a stage across the tables of a batch, extract jobs count against the BigQuery quota
+STAGE_LIMITS = {
+    "extract": int(os.environ.get("BATCH_EXTRACT_CONCURRENCY", 8)),
+    "compose": int(os.environ.get("BATCH_COMPOSE_CONCURRENCY", 4)),
+    "cleanup": int(os.environ.get("BATCH_CLEANUP_CONCURRENCY", 4)),
+}
+MAX_TABLES = int(os.environ.get("BATCH_MAX_TABLES", 1000))
+
+
+def batch_configs(payload: Dict, bigquery_client: bigquery.Client) -> List[ExportConfig]:
+    """
+    :param payload: the json body of the batch request, with either "tables" or "dataset".
+        "tables" items are "dataset.table" strings or objects with "dataset", "table" and per-table options,
+        the other keys are the options shared by every table.
+    :param bigquery_client: BigQuery Client, to list the tables of a dataset
+    :return: the export configuration of each table
+    """
+    options = {key: value for key, value in payload.items()
+               if key not in ("tables", "dataset", "file_name", "async")}
+    tables = payload.get("tables")
+    if tables is None and payload.get("dataset"):
+        dataset_id = payload["dataset"]
+        project = options.get("project", DEFAULT_PROJECT)
+        tables = [{"dataset": dataset_id, "table": table.table_id}
+                  for table in bigquery_client.list_tables(f"{project}.{dataset_id}")
+                  # the temporary query results of the running exports
+                  if table.table_type == "TABLE" and not table.table_id.startswith(TEMP_TABLE_PREFIX)]
+    if not tables:
+        raise BadRequest("tables or dataset must be specified")
+    if len(tables) > MAX_TABLES:
+        raise BadRequest("at most {} tables can be exported in a batch".format(MAX_TABLES))
+
+    configs = []
+    for table in tables:
+        if isinstance(table, str):
+            dataset_id, _, table_id = table.partition(".")
+            table = {"dataset": dataset_id, "table": table_id}
+        if not table.get("dataset") or not table.get("table"):
+            raise BadRequest("table {} must be named dataset.table".format(table))
+        table_options = dict(options, **{key: value for key, value in table.items()
+                                         if key not in ("dataset", "table")})
+        configs.append(ExportConfig.from_payload(table["dataset"], table["table"], table_options))
+    return configs
+
+
+def export_batch(configs: List[ExportConfig], storage_client: storage.Client, bigquery_client: bigquery.Client,
+                 progress: Progress = None, stage_limits: Dict[str, int] = None) -> Dict:
+    """
+    Export every table concurrently, the stages are bounded across tables by ``stage_limits``
+    :param configs: the export configuration of each table
+    :param storage_client: Google Cloud Storage Client
+    :param bigquery_client: BigQuery Client
+    :param progress: callback notified when the export of a table starts and ends
+    :param stage_limits: the maximum number of concurrent runs of each stage
+    :return: the aggregated result, a failed table does not fail the batch
+    """
+    progress = progress or (lambda stage, status: None)
+    stage_limits = stage_limits or STAGE_LIMITS
+    limits = {stage: threading.BoundedSemaphore(limit) for stage, limit in stage_limits.items()}
+    logger.info("Starting batch export of {} tables with limits {}".format(len(configs), stage_limits))
+
+    def export_table(config: ExportConfig) -> Dict:
+        name = "{}.{}".format(config.dataset_id, config.table_id)
+        progress(name, "running")
+        try:
+            result = export_once(config, storage_client, bigquery_client, limits=limits)
+            return {"table": name, "status": "succeeded", "path": result["path"],
+                    "cached": result.get("cached", False)}
+        except Exception as err:
+            logger.error("Export of {} failed: {}".format(name, err))
+            logger.debug(''.join(traceback.format_exception(type(err), value=err, tb=err.__traceback__)))
+            return {"table": name, "status": "failed", "error": str(err)}
+        finally:
+            progress(name, "done")
+
+    # the tables mostly wait on the stage limits, one thread each is cheap
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(min(len(configs), 64), 1),
+                                               thread_name_prefix="batch-export") as executor:
+        results = list(executor.map(export_table, configs))
+
+    failed = sum(1 for result in results if result["status"] == "failed")
+    logger.info("Batch export done, {} succeeded, {} failed".format(len(results) - failed, failed))
+    return {"tables": len(results), "succeeded": len(results) - failed, "failed": failed, "results": results}
@@ -1,28 +1,57 @@
-from typing import List
+from __future__ import annotations
 
-from google.api_core.exceptions import BadRequest
-from google.cloud import bigquery
+import concurrent.futures
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Union
+
+from google.api_core.exceptions import BadRequest, Conflict
 from google.cloud.exceptions import NotFound
 
+from utils import metrics, tracing
+from utils.lazy import lazy_import
 from utils.logging import logger
+from utils.pipeline import Cancelled
+from utils.table_cache import table_cache
+
+bigquery = lazy_import("google.cloud.bigquery")
 
+# Temporary query results are dropped by BigQuery after this delay if the export did not delete them
+TEMP_TABLE_EXPIRATION = timedelta(days=1)
+# The rows of the streaming buffer, and those whose partitioning column is NULL, no partition decorator reads them
+PSEUDO_PARTITIONS = ("__UNPARTITIONED__", "__NULL__")
+# Prefix of the temporary query result tables, created in the dataset of the query
+TEMP_TABLE_PREFIX = "_export_tmp_"
+# Seconds between the calls of the ``poll`` callback of a running extract job
+JOB_POLL = 5.0
 
-def get_bigquery_client() -> bigquery.Client:
+
+def get_bigquery_client(**kwargs) -> bigquery.Client:
+    """
+    :param kwargs: forwarded to bigquery.Client (project, credentials, _http)
+    :return: BigQuery Client
+    """
     try:
-        return bigquery.Client()
+        return bigquery.Client(**kwargs)
     except Exception as e:
         logger.error("Error creating client: \n\t{}".format(e))
         raise
 
 
-def bq_export(project: str, dataset_id: str, table_id: str, location: str, destination_uri: str,
-              bq_client: bigquery.Client) -> None:
+def bq_export(project: str, dataset_id: str, table_id: str, location: str, destination_uri: Union[str, List[str]],
+              bq_client: bigquery.Client, compression: str = None, destination_format: str = None,
+              job_id: str = None, poll: Callable[[], None] = None) -> None:
     """
     :param project: The id of the project
     :param dataset_id: the dataset id in bigquery
     :param table_id: the table id in the dataset
     :param location: the location of the dataset
-    :param destination_uri: the uri of the bucket
+    :param destination_uri: the uri of the files, or the uris of parallel writers
+    :param compression: the compression of the files (gzip, deflate, snappy), None to leave them uncompressed
+    :param destination_format: the format of the files (CSV, NEWLINE_DELIMITED_JSON, AVRO, PARQUET), default CSV
+    :param job_id: the id of the extract job, an existing job with this id is waited for instead of starting another
+    :param poll: called every ``JOB_POLL`` seconds while the job runs, it may raise to stop waiting for the job,
+        ``utils.pipeline.Cancelled`` also cancels the job
     :return: None
     """
     logger.info("Start BQ table export...")
@@ -32,16 +61,42 @@ def bq_export(project: str, dataset_id: str, table_id: str, location: str, desti
 
     job_config = bigquery.job.ExtractJobConfig()
     job_config.print_header = False
+    if compression:
+        job_config.compression = compression.upper()
+    if destination_format:
+        job_config.destination_format = destination_format
 
     logger.info("Extracting {}:{}.{} to {}".format(project, dataset_id, table_id, destination_uri))
+    kwargs = {"job_id": job_id} if job_id else {}
     try:
-        extract_job = bq_client.extract_table(
-            table_ref,
-            destination_uri,
-            location=location,
-            job_config=job_config
-        )
-        extract_job.result()
+        try:
+            extract_job = bq_client.extract_table(
+                table_ref,
+                destination_uri,
+                location=location,
+                job_config=job_config,
+                **kwargs
+            )
+        except Conflict:
+            if not job_id:
+                raise
+            # started by a previous attempt of the export, which may still be running
+            logger.info("Reattaching to the extract job {}".format(job_id))
+            extract_job = bq_client.get_job(job_id, location=location)
+        with metrics.timed(metrics.EXTRACT_SECONDS, format=destination_format or "CSV"), \
+                tracing.span("bigquery extract", table="{}.{}.{}".format(project, dataset_id, table_id),
+                             job_id=getattr(extract_job, "job_id", None)):
+            while True:
+                try:
+                    extract_job.result(timeout=JOB_POLL if poll else None)
+                    break
+                except concurrent.futures.TimeoutError:
+                    try:
+                        poll()
+                    except Cancelled:
+                        logger.info("Cancelling the extract job {}".format(extract_job.job_id))
+                        extract_job.cancel()
+                        raise
         logger.info("End BQ table export.")
     except NotFound as e:
         logger.exception(e, exc_info=True)
@@ -52,6 +107,18 @@ def bq_export(project: str, dataset_id: str, table_id: str, location: str, desti
         raise
 
 
+def bq_table(project: str, dataset_id: str, table_id: str, bq_client: bigquery.Client,
+             max_age: float = None) -> bigquery.Table:
+    """
+    :param project: The id of the project
+    :param dataset_id: the dataset id in bigquery
+    :param table_id: the table id in the dataset
+    :param max_age: seconds a cached table is used without revalidation, see ``utils.table_cache``
+    :return: the table, with its schema and statistics, shared with the other readers
+    """
+    return table_cache.get(bq_client, project, dataset_id, table_id, max_age=max_age)
+
+
 def bq_header(project: str, dataset_id: str, table_id: str, bq_client: bigquery.Client) -> List[str]:
     """
     :param project: The id of the project
@@ -62,11 +129,76 @@ def bq_header(project: str, dataset_id: str, table_id: str, bq_client: bigquery.
 
     logger.info("Start BQ get schema header...")
 
-    dataset_ref = bigquery.DatasetReference(project, dataset_id)
-    table_ref = dataset_ref.table(table_id)
-
-    table = bq_client.get_table(table_ref)
+    table = table_cache.get(bq_client, project, dataset_id, table_id)
     header = ["{}".format(schema.name) for schema in table.schema]
 
     logger.info("Schema header {}".format(header))
     return header
+
+
+def bq_partitions(project: str, dataset_id: str, table_id: str, location: str,
+                  bq_client: bigquery.Client) -> Optional[Dict[str, int]]:
+    """
+    :param project: The id of the project
+    :param dataset_id: the dataset id in bigquery
+    :param table_id: the table id in the dataset
+    :param location: the location of the dataset
+    :return: the last modified time, in milliseconds since epoch, of each partition of the table,
+        empty if the table is not partitioned, None if rows are in one of the ``PSEUDO_PARTITIONS``:
+        they cannot be extracted partition by partition, the table is exported fully
+    """
+    logger.info("Start BQ get partitions...")
+
+    query = ("SELECT partition_id, UNIX_MILLIS(last_modified_time) AS last_modified, total_rows "
+             "FROM `{}.{}.INFORMATION_SCHEMA.PARTITIONS` "
+             "WHERE table_name = @table_name AND partition_id IS NOT NULL").format(project, dataset_id)
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[bigquery.ScalarQueryParameter("table_name", "STRING", table_id)]
+    )
+    rows = list(bq_client.query(query, job_config=job_config, location=location).result())
+    # the row count of the streaming buffer may be unknown
+    pseudo = [row["partition_id"] for row in rows
+              if row["partition_id"] in PSEUDO_PARTITIONS and row.get("total_rows") != 0]
+    if pseudo:
+        logger.info("Rows out of any partition in {}".format(pseudo))
+        return None
+    partitions = {row["partition_id"]: row["last_modified"] for row in rows
+                  if row["partition_id"] not in PSEUDO_PARTITIONS}
+
+    logger.info("Found {} partitions".format(len(partitions)))
+    return partitions
+
+
+def bq_query_to_table(project: str, dataset_id: str, query: str, location: str,
+                      bq_client: bigquery.Client, expiration: timedelta = TEMP_TABLE_EXPIRATION) -> str:
+    """
+    :param project: The id of the project
+    :param dataset_id: the dataset id in bigquery, the temporary table is created in it
+    :param query: the standard SQL query
+    :param location: the location of the dataset
+    :param expiration: the delay after which BigQuery drops the temporary table
+    :return: the id of the temporary table holding the result of the query
+    """
+    table_id = "{}{}".format(TEMP_TABLE_PREFIX, uuid.uuid4().hex)
+    table_ref = bigquery.DatasetReference(project, dataset_id).table(table_id)
+    # created with its expiration before the query writes it, the table is never left without one
+    table = bigquery.Table(table_ref)
+    table.expires = datetime.now(timezone.utc) + expiration
+    bq_client.create_table(table, exists_ok=True)
+    job_config = bigquery.QueryJobConfig(destination=table_ref,
+                                         write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+
+    logger.info("Querying {} into {}:{}.{}".format(query, project, dataset_id, table_id))
+    rows = bq_client.query(query, job_config=job_config, location=location).result()
+    logger.info("Query result of {} rows in {}".format(rows.total_rows, table_id))
+    return table_id
+
+
+def bq_delete_table(project: str, dataset_id: str, table_id: str, bq_client: bigquery.Client) -> None:
+    """
+    :param project: The id of the project
+    :param dataset_id: the dataset id in bigquery
+    :param table_id: the table id in the dataset
+    """
+    logger.info("Deleting {}:{}.{}".format(project, dataset_id, table_id))
+    bq_client.delete_table(bigquery.DatasetReference(project, dataset_id).table(table_id), not_found_ok=True)
@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import asyncio
+import io
+import json
+import os
+import threading
+from datetime import timedelta
+from time import monotonic, time
+from typing import Any, Dict, Optional
+
+from google.cloud.exceptions import NotFound
+
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.ratelimit import scheduler
+
+storage = lazy_import("google.cloud.storage")
+
+# A checkpoint older than this is dropped, well within the expiration of the temporary query tables
+CHECKPOINT_TTL = timedelta(hours=12)
+# Seconds the SIGTERM handler waits for the running exports to save their checkpoint,
+# out of the 10 seconds Cloud Run leaves before SIGKILL
+DRAIN_TIMEOUT = float(os.environ.get("EXPORT_DRAIN_TIMEOUT", 6))
+
+# Set on SIGTERM, the running exports stop at their next checkpoint
+terminating = threading.Event()
+_running = set()
+_running_changed = threading.Condition()
+
+
+class Terminated(Exception):
+    """The instance is shutting down, the export stopped after saving its checkpoint"""
+
+
+def checkpoint_uri(bucket: str, folder: str, table_id: str, key: str) -> str:
+    """
+    :param key: identifies the identical exports, see ``utils.coalesce.export_key``
+    """
+    return f'gs://{bucket}/{folder}/tmp/{table_id}/checkpoint-{key[:32]}.json'
+
+
+class Checkpoint:
+    """The progress of an export, kept in an object of the bucket so that a retry of the same export, on
+    any instance, resumes it instead of starting over.
+
+    The progress is a dictionary of the stages done and their JSON result: the run whose temporary files
+    are reused, the id of the extract job, the names of the shards and the rounds of the compose. It is
+    written after every stage, and dropped once the final file is composed. The retries are serialized
+    by the lock of the export, so the object has a single writer.
+    """
+
+    def __init__(self, uri: str, storage_client: storage.Client, fingerprint: Dict[str, str] = None,
+                 ttl: timedelta = CHECKPOINT_TTL):
+        """
+        :param uri: the uri of the checkpoint object
+        :param storage_client: Google Cloud Storage Client
+        :param fingerprint: identifies the content of the table, a checkpoint of other content is dropped
+        :param ttl: the age after which a checkpoint is dropped
+        """
+        self.uri = uri
+        self.storage_client = storage_client
+        self.fingerprint = fingerprint
+        self.ttl = ttl
+        self.state: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _read(self) -> Optional[Dict]:
+        try:
+            return json.loads(storage.Blob.from_string(self.uri).download_as_bytes(client=self.storage_client))
+        except NotFound:
+            return None
+
+    def _encode(self) -> bytes:
+        return json.dumps(self.state, indent=2, sort_keys=True).encode("utf-8")
+
+    def _write(self) -> None:
+        blob = storage.Blob.from_string(self.uri)
+        data = self._encode()
+        scheduler.call(lambda: blob.upload_from_file(io.BytesIO(data), content_type="application/json",
+                                                     client=self.storage_client),
+                       blob.bucket.name, [blob.name])
+
+    def resume(self, run_id: str) -> str:
+        """
+        Load the checkpoint of a previous attempt of the export
+        :param run_id: the run of this attempt
+        :return: the run whose temporary files are reused, ``run_id`` if there is nothing to resume
+        """
+        return self._restore(self._read(), run_id)
+
+    def _restore(self, state: Optional[Dict], run_id: str) -> str:
+        """
+        :param state: the checkpoint read from the bucket, None if there is none
+        :return: the run whose temporary files are reused
+        """
+        fresh = state and time() - state["created"] < self.ttl.total_seconds()
+        if fresh and state.get("fingerprint") == self.fingerprint:
+            self.state = state
+            logger.info("Resuming export run {} from {}, done: {}".format(state["run_id"], self.uri,
+                                                                         sorted(state["stages"])))
+            return state["run_id"]
+        if state:
+            logger.info("Dropping the outdated checkpoint {}".format(self.uri))
+        self.state = {"run_id": run_id, "created": time(), "fingerprint": self.fingerprint, "stages": {}}
+        return run_id
+
+    def get(self, stage: str, default: Any = None) -> Any:
+        """
+        :return: the result of ``stage`` saved by a previous attempt, ``default`` if it was not done
+        """
+        return self.state["stages"].get(stage, default)
+
+    def save(self, stage: str, result: Any) -> None:
+        """
+        Save the result of a stage, then stop the export if the instance is shutting down
+        :param result: a JSON value
+        """
+        with self._lock:
+            self.state["stages"][stage] = result
+            self._write()
+        self.check()
+
+    def check(self) -> None:
+        """
+        :raise Terminated: the instance is shutting down
+        """
+        if terminating.is_set():
+            raise Terminated("export stopped by the shutdown of the instance, resumable from {}".format(self.uri))
+
+    def delete(self) -> None:
+        try:
+            storage.Blob.from_string(self.uri).delete(client=self.storage_client)
+        except NotFound:
+            pass
+
+    def __enter__(self) -> "Checkpoint":
+        with _running_changed:
+            _running.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        with _running_changed:
+            _running.discard(self)
+            _running_changed.notify_all()
+
+
+class AsyncCheckpoint(Checkpoint):
+    """The checkpoint of an export running on the event loop, read and written by the asynchronous client.
+    Both kinds of checkpoint are the same object, an export resumes the one of the other service.
+    """
+
+    def __init__(self, uri: str, client, fingerprint: Dict[str, str] = None, ttl: timedelta = CHECKPOINT_TTL):
+        """
+        :param client: the ``utils.aio.AsyncClient`` of the process
+        """
+        super().__init__(uri, None, fingerprint, ttl)
+        self.client = client
+        self.bucket, _, self.name = uri[len("gs://"):].partition("/")
+        self._write_lock = asyncio.Lock()
+
+    async def aresume(self, run_id: str) -> str:
+        """
+        ``resume`` on the event loop
+        """
+        try:
+            state = json.loads(await self.client.download(self.bucket, self.name))
+        except NotFound:
+            state = None
+        return self._restore(state, run_id)
+
+    async def asave(self, stage: str, result: Any) -> None:
+        """
+        ``save`` on the event loop
+        """
+        # the concurrent stages write in turn, the last write has every stage
+        async with self._write_lock:
+            self.state["stages"][stage] = result
+            data = self._encode()
+            await scheduler.acall(lambda: self.client.upload(self.bucket, self.name, data,
+                                                             {"contentType": "application/json"}, retries=0),
+                                  self.bucket, [self.name])
+        self.check()
+
+    async def adelete(self) -> None:
+        try:
+            await self.client.delete(self.bucket, self.name)
+        except NotFound:
+            pass
+
+
+def terminate(timeout: float = DRAIN_TIMEOUT) -> bool:
+    """
+    Stop the running exports at their next checkpoint, called when the instance receives SIGTERM
+    :param timeout: seconds to wait for the exports to stop
+    :return: whether every export stopped in time
+    """
+    terminating.set()
+    deadline = monotonic() + timeout
+    with _running_changed:
+        if _running:
+            logger.info("Waiting for {} exports to save their checkpoint".format(len(_running)))
+        while _running:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                logger.warning("{} exports did not stop in {}s".format(len(_running), timeout))
+                return False
+            _running_changed.wait(remaining)
+    return True
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import os
+import threading
+
+import google.auth
+from google.auth.credentials import AnonymousCredentials
+
+from utils.bigquery import get_bigquery_client
+from utils.compose import COMPOSE_WORKERS, get_gcs_client
+from utils.lazy import lazy_import
+from utils.logging import logger
+
+transport = lazy_import("google.auth.transport.requests")
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+adapters = lazy_import("requests.adapters")
+
+SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+
+# Matches the gunicorn "--threads 8" of the Dockerfile and Procfile
+REQUEST_THREADS = 8
+
+
+def pool_size(threads: int) -> int:
+    """
+    :param threads: the number of request threads sharing the clients
+    :return: the HTTP connections per host, each request fans out to COMPOSE_WORKERS compose and delete calls
+    """
+    return int(os.environ.get("HTTP_POOL_SIZE", threads * COMPOSE_WORKERS))
+
+
+DEFAULT_POOL_SIZE = pool_size(REQUEST_THREADS)
+
+
+def emulator_hosts():
+    """
+    :return: the endpoints of local stand-ins of the APIs, the GCS one is also read by the storage library
+    """
+    return os.environ.get("STORAGE_EMULATOR_HOST"), os.environ.get("BIGQUERY_EMULATOR_HOST")
+
+
+class ClientRegistry:
+    """Process-wide Google Cloud clients, created once per gunicorn worker.
+
+    Both clients share the credentials and an authorized HTTP session whose
+    connection pool is sized to the compose and delete calls of all the
+    request threads.
+    """
+
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._project = None
+        self._session = None
+        self._gcs_client = None
+        self._bigquery_client = None
+        self._read_client = None
+
+    def configure(self, pool_size: int) -> None:
+        """
+        Resize the HTTP pool, must be called before the first client is built
+        :param pool_size: the maximum number of connections per host
+        """
+        with self._lock:
+            if self._session is not None and pool_size != self.pool_size:
+                logger.warning("HTTP pool already created with size {}".format(self.pool_size))
+                return
+            self.pool_size = pool_size
+
+    def session(self) -> transport.AuthorizedSession:
+        with self._lock:
+            if self._session is None:
+                if any(emulator_hosts()):
+                    # the stand-ins do not check the credentials
+                    self._credentials = AnonymousCredentials()
+                    self._project = os.environ.get("GOOGLE_CLOUD_PROJECT")
+                else:
+                    self._credentials, self._project = google.auth.default(scopes=SCOPES)
+                session = transport.AuthorizedSession(self._credentials)
+                adapter = adapters.HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._session = session
+            return self._session
+
+    def gcs_client(self) -> storage.Client:
+        session = self.session()
+        with self._lock:
+            if self._gcs_client is None:
+                self._gcs_client = get_gcs_client(project=self._project, credentials=self._credentials,
+                                                  _http=session)
+            return self._gcs_client
+
+    def bigquery_client(self) -> bigquery.Client:
+        session = self.session()
+        with self._lock:
+            if self._bigquery_client is None:
+                _, bigquery_host = emulator_hosts()
+                options = {"client_options": {"api_endpoint": bigquery_host}} if bigquery_host else {}
+                self._bigquery_client = get_bigquery_client(project=self._project, credentials=self._credentials,
+                                                            _http=session, **options)
+            return self._bigquery_client
+
+    def bigquery_read_client(self):
+        """The Storage Read API client is gRPC, it shares the credentials only"""
+        from utils.storage_read import get_read_client
+
+        self.session()
+        with self._lock:
+            if self._read_client is None:
+                self._read_client = get_read_client(credentials=self._credentials)
+            return self._read_client
+
+    def warm_up(self) -> None:
+        """Resolve credentials, fetch a token and open TLS connections to the APIs.
+        Failures are logged only, the clients are built again on first use."""
+        try:
+            session = self.session()
+            if not isinstance(self._credentials, AnonymousCredentials):
+                self._credentials.refresh(transport.Request())
+            for client in (self.gcs_client(), self.bigquery_client()):
+                session.head(client._connection.API_BASE_URL, timeout=5)
+            logger.info("Clients warmed up, HTTP pool size {}".format(self.pool_size))
+        except Exception as e:
+            logger.warning("Failed to warm up clients: {}".format(e))
+
+    def reset(self) -> None:
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+            self._credentials = self._project = self._session = None
+            self._gcs_client = self._bigquery_client = self._read_client = None
+
+
+registry = ClientRegistry()
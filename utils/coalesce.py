@@ -0,0 +1,363 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import uuid
+from contextlib import contextmanager
+from time import monotonic, sleep, time
+from typing import Any, Awaitable, Callable, Dict, Iterator, Optional, Tuple
+
+from google.api_core.exceptions import PreconditionFailed
+from google.cloud.exceptions import NotFound
+
+from utils import metrics
+from utils.bigquery import bq_table
+from utils.checkpoint import Checkpoint, checkpoint_uri
+from utils.export import ExportConfig, run_export
+from utils.incremental import cache_prefix
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import Progress
+
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+
+# Seconds a lock is held without renewal, the holder renews it every third of it
+LOCK_TTL = int(os.environ.get("EXPORT_LOCK_TTL", 120))
+# Seconds to wait for an export of the same file running on another instance
+LOCK_WAIT = int(os.environ.get("EXPORT_LOCK_WAIT", 3600))
+LOCK_POLL = 0.5
+LOCK_MAX_POLL = 10.0
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the run of the first one, from threads or from the event loop"""
+
+    def __init__(self):
+        self._calls: Dict[str, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: str) -> Tuple[concurrent.futures.Future, bool]:
+        """
+        :return: the future of the call, and whether the caller leads it
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                return future, False
+            future = self._calls[key] = concurrent.futures.Future()
+            return future, True
+
+    def _done(self, key: str, future: concurrent.futures.Future, result: Any = None,
+              err: BaseException = None) -> None:
+        with self._lock:
+            del self._calls[key]
+        if err is not None:
+            future.set_exception(err)
+        else:
+            future.set_result(result)
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        :param key: identifies identical calls
+        :param fn: the call, run once for all the concurrent callers
+        :return: the result of the call, and whether it was shared with another caller
+        """
+        future, leader = self._join(key)
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn()
+        except BaseException as err:
+            self._done(key, future, err=err)
+            raise
+        self._done(key, future, result)
+        return result, False
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        ``do`` on the event loop
+        :param fn: the coroutine function, run once for all the concurrent callers
+        """
+        future, leader = self._join(key)
+        if not leader:
+            # a caller cancelled by its client does not cancel the shared run
+            return await asyncio.shield(asyncio.wrap_future(future)), True
+        try:
+            result = await fn()
+        except BaseException as err:
+            self._done(key, future, err=err)
+            raise
+        self._done(key, future, result)
+        return result, False
+
+
+def lock_owner() -> str:
+    """
+    :return: identifies the holder of a lock, the instance, the process and the lock
+    """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def lock_metadata(owner: str, ttl: float) -> Dict[str, str]:
+    """
+    :return: the custom metadata of a lock object leased for ``ttl`` seconds
+    """
+    return {"owner": owner, "expires": str(time() + ttl)}
+
+
+def lock_expired(metadata: Optional[Dict[str, str]]) -> bool:
+    """
+    :param metadata: the custom metadata of a lock object
+    """
+    return float((metadata or {}).get("expires", 0)) <= time()
+
+
+def lock_delays(uri: str, timeout: float) -> Iterator[float]:
+    """
+    :return: the jittered exponential delays between the attempts to take a lock
+    :raise TimeoutError: past ``timeout`` seconds
+    """
+    deadline = monotonic() + timeout
+    delay = LOCK_POLL
+    while True:
+        if monotonic() > deadline:
+            raise TimeoutError("lock {} not acquired in {}s".format(uri, timeout))
+        yield delay * random.uniform(.5, 1)
+        delay = min(delay * 2, LOCK_MAX_POLL)
+
+
+class GcsLock:
+    """A lease on an object of the bucket, shared by every instance of the service.
+
+    The lock object is created only if it does not exist (``if_generation_match=0``)
+    and every later write or delete is conditioned on the generation we wrote, so
+    a lease is never renewed or released by an instance which lost it. The expiry
+    is kept in the custom metadata of the object, an expired lease of a crashed
+    instance is deleted by the next instance waiting for it.
+    """
+
+    def __init__(self, uri: str, storage_client: storage.Client, ttl: int = LOCK_TTL):
+        self.uri = uri
+        self.storage_client = storage_client
+        self.ttl = ttl
+        self.owner = lock_owner()
+        self.generation: Optional[int] = None
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    def _write(self, if_generation_match: int) -> None:
+        blob = storage.Blob.from_string(self.uri)
+        blob.metadata = lock_metadata(self.owner, self.ttl)
+        blob.upload_from_string(self.owner, content_type="text/plain", client=self.storage_client,
+                                if_generation_match=if_generation_match)
+        self.generation = blob.generation
+
+    def _break_expired(self) -> None:
+        blob = storage.Blob.from_string(self.uri)
+        try:
+            blob.reload(client=self.storage_client)
+            if not lock_expired(blob.metadata):
+                return
+            logger.warning("Breaking the expired lock {} of {}".format(self.uri, (blob.metadata or {}).get("owner")))
+            blob.delete(client=self.storage_client, if_generation_match=blob.generation)
+        except (NotFound, PreconditionFailed):
+            # released or renewed meanwhile
+            pass
+
+    def try_acquire(self) -> bool:
+        try:
+            self._write(if_generation_match=0)
+        except PreconditionFailed:
+            self._break_expired()
+            return False
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew, name="lock-heartbeat", daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def acquire(self, timeout: float = LOCK_WAIT) -> None:
+        """
+        Wait for the lock, polling with a jittered exponential backoff
+        :param timeout: seconds to wait before giving up
+        """
+        delays = lock_delays(self.uri, timeout)
+        while not self.try_acquire():
+            sleep(next(delays))
+        logger.info("Acquired lock {}".format(self.uri))
+
+    def _renew(self) -> None:
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                self._write(if_generation_match=self.generation)
+            except Exception as err:
+                logger.error("Lost lock {}: {}".format(self.uri, err))
+                return
+
+    def release(self) -> None:
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        try:
+            storage.Blob.from_string(self.uri).delete(client=self.storage_client,
+                                                      if_generation_match=self.generation)
+        except (NotFound, PreconditionFailed) as err:
+            logger.warning("Lock {} was not held anymore: {}".format(self.uri, err))
+
+    def __enter__(self) -> "GcsLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.release()
+
+
+def _sha256(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def export_key(config: ExportConfig) -> str:
+    """
+    :return: identifies the identical exports, whatever their run
+    """
+    return _sha256({name: value for name, value in vars(config).items() if name != "run_id"})
+
+
+def lock_uri(config: ExportConfig) -> str:
+    if config.incremental:
+        # the partition cache of the table is shared by all its incremental exports
+        return f'gs://{config.bucket}/{cache_prefix(config)}export.lock'
+    return f'{config.file_uri}.lock'
+
+
+def source_metadata(config: ExportConfig, table: bigquery.Table) -> Dict[str, str]:
+    """
+    :param config: the export configuration
+    :param table: the exported table
+    :return: the fingerprint of the table and of the export options, kept in the metadata of the final file
+    """
+    return {
+        "source_table": table.full_table_id or "",
+        "source_last_modified": table.modified.isoformat() if table.modified else "",
+        "source_schema": _sha256([[field.name, field.field_type, field.mode] for field in table.schema]),
+        "export_options": _sha256({"format": config.format, "compression": config.compression,
+                                   "with_header": config.with_header, "query": config.query_sql,
+                                   "engine": config.engine}),
+    }
+
+
+def fingerprint(config: ExportConfig, table: Optional[bigquery.Table]) -> Tuple[Optional[Dict[str, str]], bool]:
+    """
+    :param table: the exported table, None for a raw query whose tables are unknown
+    :return: the fingerprint of the export, see ``source_metadata``, and whether a previous result may be reused
+    """
+    if table is None:
+        return None, False
+    # the last modified time does not cover the rows still in the streaming buffer
+    return source_metadata(config, table), not config.force and table.streaming_buffer is None
+
+
+def current_result(config: ExportConfig, metadata: Dict[str, str],
+                   file_metadata: Optional[Dict[str, str]]) -> Optional[Dict]:
+    """
+    :param metadata: the fingerprint of the export
+    :param file_metadata: the custom metadata of the final file of the previous export
+    :return: the result of the previous export if its final file was produced from the same table and options
+    """
+    if any((file_metadata or {}).get(key) != value for key, value in metadata.items()):
+        return None
+    logger.info("{} is up to date with the table".format(config.file_uri))
+    return {"path": config.file_uri, "format": config.format, "timings": {}, "cached": True}
+
+
+def cached_result(config: ExportConfig, metadata: Dict[str, str], storage_client: storage.Client) -> Optional[Dict]:
+    """
+    :return: the result of the previous export if its final file was produced from the same table and options
+    """
+    blob = storage.Blob.from_string(config.file_uri)
+    try:
+        blob.reload(client=storage_client)
+    except NotFound:
+        return None
+    return current_result(config, metadata, blob.metadata)
+
+
+@contextmanager
+def recorded(config: ExportConfig) -> Iterator[Callable[[Dict, bool], Dict]]:
+    """
+    Record an export in the metrics, whether it runs in a thread or on the event loop
+    :return: called with the result of the export and whether it was shared, returns the result to answer
+    """
+    labels = {"engine": config.engine, "format": config.format}
+
+    def done(result: Dict, shared: bool) -> Dict:
+        if shared:
+            logger.info("Attached to the running export of {}".format(config.file_uri))
+            metrics.EXPORTS.labels(result="coalesced", **labels).inc()
+            return dict(result, coalesced=True)
+        metrics.EXPORTS.labels(result="cached" if result.get("cached") else "exported", **labels).inc()
+        return result
+
+    metrics.EXPORTS_IN_FLIGHT.inc()
+    try:
+        with metrics.timed(metrics.EXPORT_SECONDS, **labels):
+            yield done
+    except Exception:
+        metrics.EXPORTS.labels(result="failed", **labels).inc()
+        raise
+    finally:
+        metrics.EXPORTS_IN_FLIGHT.dec()
+
+
+# Shared by the synchronous and the asynchronous exports of the process
+flights = SingleFlight()
+
+
+def export_once(config: ExportConfig, storage_client: storage.Client, bigquery_client: bigquery.Client,
+                progress: Progress = None, limits: Dict[str, threading.Semaphore] = None) -> Dict:
+    """
+    Export a table unless its final file is already up to date, identical concurrent requests
+    share one export in the instance and exports of the same file are serialized across instances.
+    An extract export resumes the checkpoint left by an interrupted attempt of the same export.
+    :param config: the export configuration, ``force`` skips the result cache
+    :param storage_client: Google Cloud Storage Client
+    :param bigquery_client: BigQuery Client
+    :param progress: callback notified when a stage starts and ends
+    :param limits: semaphores bounding the concurrent runs of a stage, shared by the exports of a batch
+    :return: the result of the export, "cached" if the previous file was returned
+    """
+
+    def export() -> Dict:
+        table = None
+        # the tables read by a raw query are unknown
+        if not config.query:
+            # revalidated, the later reads of the table by the export use the cached one
+            table = bq_table(config.project, config.dataset_id, config.table_id, bigquery_client, max_age=0)
+        metadata, cacheable = fingerprint(config, table)
+        result = cacheable and cached_result(config, metadata, storage_client)
+        if result:
+            return result
+
+        with GcsLock(lock_uri(config), storage_client):
+            # the export we waited for may have produced the file
+            result = cacheable and cached_result(config, metadata, storage_client)
+            if result:
+                return result
+            if config.engine != "extract" or config.incremental:
+                return run_export(config, storage_client, bigquery_client, progress, limits, metadata=metadata,
+                                  table=table)
+            checkpoint = Checkpoint(checkpoint_uri(config.bucket, config.folder, config.table_id, key),
+                                    storage_client, fingerprint=metadata)
+            with checkpoint:
+                return run_export(config, storage_client, bigquery_client, progress, limits, metadata=metadata,
+                                  checkpoint=checkpoint, table=table)
+
+    key = export_key(config)
+    with recorded(config) as done:
+        return done(*flights.do(key, export))
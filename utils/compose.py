@@ -1,16 +1,34 @@
+from __future__ import annotations
+
 import concurrent.futures
+import gzip
 import io
-from time import sleep
-from typing import List
-
-from google.cloud import storage
+import os
+from typing import Callable, Dict, List, Tuple
+from uuid import uuid4
 
+from utils import metrics, tracing
+from utils.lazy import lazy_import
 from utils.logging import logger
+from utils.ratelimit import scheduler
+
+storage = lazy_import("google.cloud.storage")
+
+# https://cloud.google.com/storage/docs/composite-objects
+MAX_COMPOSE_SOURCES = 32
+# https://cloud.google.com/storage/docs/batch
+MAX_BATCH_SIZE = 100
+# Concurrent compose and delete calls of one export, each holds an HTTP connection
+COMPOSE_WORKERS = int(os.environ.get("COMPOSE_WORKERS", 10))
 
 
-def get_gcs_client() -> storage.Client:
+def get_gcs_client(**kwargs) -> storage.Client:
+    """
+    :param kwargs: forwarded to storage.Client (project, credentials, _http)
+    :return: Google Cloud Storage Client
+    """
     try:
-        client = storage.Client()
+        client = storage.Client(**kwargs)
         return client
     except Exception as e:
         logger.error("Error creating client: \n\t{}".format(e))
@@ -42,34 +60,148 @@ def generate_chunks(list_object: List, max_partitions: int = 31) -> List:
     return [list_object[i:i + max_partitions] for i in range(0, len(list_object), max_partitions)]
 
 
-def write_initial_file_with_header(file_uri: str, header: List, gcs_client: storage.Client) -> storage.Blob:
+def compose_prefix(destination: str) -> str:
+    """
+    :param destination: the name of the composed object
+    :return: the prefix of the intermediate composites of a compose, unique per call as the intermediates of
+        a previous compose may still be deleted in the background
+    """
+    return "{}.compose/{}/".format(destination, uuid4().hex[:12])
+
+
+def composite_names(prefix: str, round_index: int, count: int) -> List[str]:
+    """
+    :return: the names of the ``count`` intermediate composites of a compose round
+    """
+    return ["{}{}/{:06d}".format(prefix, round_index, i) for i in range(count)]
+
+
+def compose_progress(prefix: str, round_index: int, sources: List[str], intermediates: List[str]) -> Dict:
+    """
+    :param round_index: the index of the next round
+    :param sources: the names of the sources of the next round
+    :param intermediates: the names of the composites created so far
+    :return: the progress of a compose, the ``resume`` of ``compose_tree``, also read by the asynchronous export
+    """
+    return {"prefix": prefix, "round": round_index, "sources": sources, "intermediates": intermediates}
+
+
+def write_initial_file_with_header(file_uri: str, header: List, gcs_client: storage.Client,
+                                   compression: str = None) -> storage.Blob:
     """
     :param file_uri: the uri of the file
     :param header: headers of the bigquery table if any else empty list
     :param gcs_client: google cloud storage client
+    :param compression: "gzip" to write the header as a gzip member of its own
     :return: blob file
     """
     try:
         final_blob = storage.Blob.from_string(file_uri)
         if not header:
-            final_blob.upload_from_file(io.BytesIO(b''), client=gcs_client)
+            data, kwargs = b'', {}
+        elif compression == "gzip":
+            data, kwargs = gzip.compress(f"{','.join(header)} \n".encode("utf-8")), {"content_type": 'application/gzip'}
         else:
-            header_string = f"{','.join(header)} \n"
-            header_string_io = io.StringIO(header_string)
-            final_blob.upload_from_file(header_string_io, content_type='text/csv', client=gcs_client)
+            # bytes, the uploads of google-cloud-storage 3 are checksummed
+            data, kwargs = f"{','.join(header)} \n".encode("utf-8"), {"content_type": 'text/csv'}
+        # a new stream for every attempt
+        scheduler.call(lambda: final_blob.upload_from_file(io.BytesIO(data), client=gcs_client, **kwargs),
+                       final_blob.bucket.name, [final_blob.name])
         return final_blob
     except Exception as e:
         logger.error("Failed to upload blob : {}".format(e))
         raise
 
 
+def _compose(destination: storage.Blob, sources: List[storage.Blob], gcs_client: storage.Client) -> None:
+    with tracing.span("compose", destination=destination.name, sources=len(sources)):
+        # appending to the destination twice would duplicate the sources
+        scheduler.call(lambda: destination.compose(sources, client=gcs_client), destination.bucket.name,
+                       [destination.name], idempotent=all(source is not destination for source in sources))
+
+
+def compose_round(blobs: List[storage.Blob], destination: storage.Blob, round_index: int,
+                  gcs_client: storage.Client, executor: concurrent.futures.ThreadPoolExecutor,
+                  fan_in: int = MAX_COMPOSE_SOURCES, prefix: str = None) -> List[storage.Blob]:
+    """
+    Compose every chunk of ``fan_in`` blobs into an intermediate composite, in parallel
+    :param blobs: ordered list of blobs to merge
+    :param destination: the final blob, intermediate composites are written next to it
+    :param round_index: the index of the round, used to name the intermediate composites
+    :param gcs_client: Google Cloud Storage Client
+    :param executor: Multithread Pool Executor
+    :param fan_in: the number of blobs merged into one composite (max 32)
+    :param prefix: the prefix of the intermediate composites, next to the destination by default
+    :return: ordered list of intermediate composites
+    """
+    chunks = generate_chunks(list_object=blobs, max_partitions=fan_in)
+    prefix = prefix or "{}.compose/".format(destination.name)
+    composites = [destination.bucket.blob(name) for name in composite_names(prefix, round_index, len(chunks))]
+    logger.info("Compose round {}: {} blobs into {} composites.".format(round_index, len(blobs), len(chunks)))
+    with metrics.timed(metrics.COMPOSE_ROUND_SECONDS, round=str(round_index)), \
+            tracing.span("compose round", round=round_index, composites=len(chunks)):
+        futures = [executor.submit(tracing.propagate(_compose), composite, chunk, gcs_client)
+                   for composite, chunk in zip(composites, chunks)]
+        for future in futures:
+            future.result()
+    metrics.COMPOSES.inc(len(chunks))
+    return composites
+
+
+def compose_tree(destination: storage.Blob, list_object: List[storage.Blob], gcs_client: storage.Client,
+                 executor: concurrent.futures.ThreadPoolExecutor, fan_in: int = MAX_COMPOSE_SOURCES,
+                 resume: Dict = None, on_round: Callable[[Dict], None] = None,
+                 prefix: str = None) -> List[storage.Blob]:
+    """
+    Compose ``list_object`` into ``destination`` by merging them in rounds of parallel composes,
+    about log32(N) rounds are needed. The order of the blobs is kept.
+    :param destination: the destination blob, it may be one of the sources
+    :param list_object: ordered list of blobs to compose
+    :param gcs_client: Google Cloud Storage Client
+    :param executor: Multithread Pool Executor
+    :param fan_in: the number of blobs merged into one composite (max 32)
+    :param resume: the progress passed to ``on_round`` by an interrupted compose, continued after its last round
+    :param on_round: called with the progress of the compose once a round is done
+    :param prefix: the prefix of the intermediate composites, a new one by default, see ``compose_prefix``
+    :return: list of the intermediate composites created, to be deleted by the caller
+    """
+    if resume:
+        # the composites of the rounds done, the sources are not composed again
+        sources = [destination.bucket.blob(name) for name in resume["sources"]]
+        intermediates = [destination.bucket.blob(name) for name in resume["intermediates"]]
+        round_index, prefix = resume["round"], resume["prefix"]
+        logger.info("Resuming compose of {} at round {}".format(destination.name, round_index))
+    else:
+        sources = list(list_object)
+        intermediates = []
+        round_index = 0
+        prefix = prefix or compose_prefix(destination.name)
+    metrics.COMPOSE_SOURCES.observe(len(sources))
+    # the size of the listed blobs, the destination appended to is not counted
+    metrics.COMPOSED_BYTES.inc(sum(blob.size for blob in sources if isinstance(getattr(blob, "size", None), int)))
+    while len(sources) > fan_in:
+        sources = compose_round(sources, destination, round_index, gcs_client, executor, fan_in, prefix)
+        intermediates.extend(sources)
+        round_index += 1
+        if on_round:
+            on_round(compose_progress(prefix, round_index, [blob.name for blob in sources],
+                                      [blob.name for blob in intermediates]))
+
+    logger.info("Composing {} blobs to {}...".format(len(sources), destination.name))
+    with metrics.timed(metrics.COMPOSE_ROUND_SECONDS, round="final"):
+        _compose(destination, sources, gcs_client)
+    metrics.COMPOSES.inc()
+    return intermediates
+
+
 def compose_file(file_uri: str, list_object: List[storage.Blob], gcs_client: storage.Client,
-                 header: List[str] = None) -> storage.Blob:
+                 header: List[str] = None, max_workers: int = COMPOSE_WORKERS) -> storage.Blob:
     """
     :param file_uri: the path of file
     :param list_object: list containing chunks of files
     :param header: the header of the dataset
     :param gcs_client: Google Cloud Storage Client
+    :param max_workers: the number of concurrent compose and delete calls
     :return: the composed csv file with the header
     """
     logger.info("Start composing files...")
@@ -77,35 +209,99 @@ def compose_file(file_uri: str, list_object: List[storage.Blob], gcs_client: sto
     if not list_object:
         raise ValueError('file not found')
 
-    chunks = generate_chunks(list_object=list_object)
-    logger.info("Partitioned list of files into {} slices.".format(len(chunks)))
     final_blob = write_initial_file_with_header(file_uri, header, gcs_client)
     logger.info("Destination file {}.".format(final_blob.name))
-    executor = concurrent.futures.ThreadPoolExecutor(max_workers=10)
-
-    for i, chunk in enumerate(chunks):
-        chunk.insert(0, final_blob)
-        logger.info("chunk {} size : {}".format(i, len(chunk)))
-        logger.info("Composing csv(s) to one csv...")
-        final_blob.compose(chunk, client=gcs_client)
-        delete_objects_concurrent(chunk[1:], executor, storage_client=gcs_client)
-        sleep(1)
-    logger.info("End composing files.")
-    # cleanup and exit
-    executor.shutdown(True)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    try:
+        intermediates = compose_tree(final_blob, [final_blob] + list(list_object), gcs_client, executor)
+        logger.info("End composing files.")
+        # cleanup and exit
+        delete_objects_concurrent(list(list_object) + intermediates, executor, storage_client=gcs_client)
+    finally:
+        executor.shutdown(True)
     return final_blob
 
 
+def delete_batch(blobs: List[storage.Blob], storage_client: storage.Client, attempt: int = 1) -> List[storage.Blob]:
+    """
+    Delete blobs with a single GCS batch request, paced by the mutation scheduler
+    :param blobs: up to 100 blobs of a bucket to delete
+    :param storage_client: Google Cloud Storage Client
+    :param attempt: the attempt of the deletes, from 1, the failed ones pause the next deletes
+    :return: the blobs which could not be deleted
+    """
+    bucket = blobs[0].bucket.name
+    scheduler.wait(bucket, [blob.name for blob in blobs])
+    try:
+        with tracing.span("delete batch", blobs=len(blobs)):
+            # deferred on the batch itself rather than on the client, whose current batch would discard
+            # the response of every delete
+            batch = storage_client.batch(raise_exception=False)
+            for blob in blobs:
+                logger.debug("Deleting slice {}".format(blob.name))
+                batch.api_request(method="DELETE", path=blob.path)
+            responses = batch.finish(raise_exception=False)
+    except Exception as e:
+        logger.warning("Batch delete of {} blobs failed: {}".format(len(blobs), e))
+        scheduler.pause_after(bucket, [blob.name for blob in blobs], int(getattr(e, "code", None) or 500), attempt)
+        return list(blobs)
+
+    failed = set(failed_deletes(bucket, [(blob.name, response.status_code)
+                                         for blob, response in zip(blobs, responses)], attempt))
+    return [blob for blob in blobs if blob.name in failed]
+
+
+def failed_deletes(bucket: str, statuses: List[Tuple[str, int]], attempt: int) -> List[str]:
+    """
+    Pause the mutations of ``bucket`` after the failed deletes of a batch, by the synchronous and the
+    asynchronous exports
+    :param statuses: the name and the HTTP status of every delete of the batch
+    :param attempt: the attempt of the deletes, from 1
+    :return: the names of the objects which could not be deleted, a missing object is already deleted
+    """
+    failed = [(name, status) for name, status in statuses if not (200 <= status < 300 or status == 404)]
+    for status in {status for _, status in failed}:
+        scheduler.pause_after(bucket, [name for name, code in failed if code == status], status, attempt)
+    return [name for name, _ in failed]
+
+
 def delete_objects_concurrent(blobs: List[storage.Blob], executor: concurrent.futures.ThreadPoolExecutor,
-                              storage_client: storage.Client) -> None:
+                              storage_client: storage.Client, retries: int = 3) -> Dict:
     """
-    Delete chunks of files asynchronously
+    Delete files with concurrent batch requests of up to 100 deletes, retrying only the failed ones
     :param blobs:  List of csv files to delete
     :param executor: Multithread Pool Executor
     :param storage_client: Google Cloud Storage Client
-    :return: None
+    :param retries: the number of retries of the failed deletes
+    :return: summary of the deleted and failed files
+    """
+    pending = list(blobs)
+    with metrics.timed(metrics.DELETE_SECONDS):
+        for attempt in range(retries + 1):
+            if attempt:
+                # after the pause of the failed deletes, waited by the next batches
+                logger.info("Retrying delete of {} blobs, attempt {}".format(len(pending), attempt))
+            futures = [executor.submit(tracing.propagate(delete_batch), batch, storage_client, attempt + 1)
+                       for batch in generate_chunks(pending, MAX_BATCH_SIZE)]
+            pending = [blob for future in futures for blob in future.result()]
+            if not pending:
+                break
+    return delete_summary(len(blobs), [blob.name for blob in pending])
+
+
+def delete_summary(total: int, failed: List[str]) -> Dict:
+    """
+    Record the deletes of temporary files, by the synchronous and the asynchronous exports
+    :param total: the number of files to delete
+    :param failed: the names of the files which could not be deleted
+    :return: summary of the deleted and failed files
     """
-    for blob in blobs:
-        logger.debug("Deleting slice {}".format(blob.name))
-        executor.submit(blob.delete, client=storage_client)
-        sleep(.005)
+    metrics.DELETES.labels(result="deleted").inc(total - len(failed))
+    metrics.DELETES.labels(result="failed").inc(len(failed))
+    summary = {"deleted": total - len(failed), "failed": failed}
+    if failed:
+        logger.error("Deleted {} blobs, failed to delete {}: {}".format(summary["deleted"], len(failed), failed))
+    else:
+        logger.info("Deleted {} blobs".format(summary["deleted"]))
+    return summary
@@ -0,0 +1,345 @@
+from __future__ import annotations
+
+import concurrent.futures
+import re
+import threading
+from dataclasses import dataclass, field, replace
+from datetime import date
+from typing import Dict, List, Optional
+from uuid import uuid4
+
+from google.api_core.exceptions import BadRequest
+
+from utils.bigquery import bq_delete_table, bq_export, bq_header, bq_query_to_table, bq_table
+from utils.checkpoint import Checkpoint, Terminated, terminating
+from utils.compose import COMPOSE_WORKERS, delete_objects_concurrent, list_file, write_initial_file_with_header
+from utils.formats import FORMATS, ExportFormat, compose_merge, manifest_merge
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import Pipeline, Progress
+
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+
+DEFAULT_PROJECT = "cel-em-prj-dpf-shr-01-dev"
+DEFAULT_BUCKET = "cel-em-gcs-dpf-shr-01-dev"
+DEFAULT_LOCATION = "europe-west1"
+
+STAGES = ["plan", "extract", "header", "header_file", "list_shards", "compose", "cleanup"]
+
+# "extract" runs an extract job and composes the shards, "storage_read" streams the rows through the Storage Read API
+ENGINES = ["extract", "storage_read"]
+
+# a column, or a field of a record column
+COLUMN = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*(\.[A-Za-z_][A-Za-z0-9_]*)*$")
+
+
+@dataclass
+class ExportConfig:
+    project: str
+    dataset_id: str
+    table_id: str
+    bucket: str
+    location: str
+    folder: str
+    file_name: str
+    with_header: bool = False
+    compression: Optional[str] = None
+    format: str = "csv"
+    incremental: bool = False
+    force: bool = False
+    columns: Optional[List[str]] = None
+    filter: Optional[str] = None
+    query: Optional[str] = None
+    engine: str = "extract"
+    # names the temporary files of this run, so that concurrent runs never share them
+    run_id: str = field(default_factory=lambda: uuid4().hex[:12], compare=False)
+
+    @classmethod
+    def from_payload(cls, dataset_id: str, table_id: str, payload: Dict) -> "ExportConfig":
+        """
+        :param dataset_id: the dataset id in bigquery
+        :param table_id: the table id in the dataset
+        :param payload: the json body of the export request
+        :return: the export configuration, with the defaults of the service
+        """
+        export_format = payload.get("format", "csv")
+        if export_format not in FORMATS:
+            raise BadRequest("format must be one of {}".format(list(FORMATS)))
+        compression = payload.get("compression")
+        if compression not in FORMATS[export_format].compressions:
+            raise BadRequest("compression of {} must be one of {}".format(
+                export_format, [c for c in FORMATS[export_format].compressions if c]))
+        incremental = payload.get("incremental", False)
+        if incremental and FORMATS[export_format].merge is not compose_merge:
+            raise BadRequest("incremental exports support the formats merged by compose only")
+        columns, row_filter, query = payload.get("columns"), payload.get("filter"), payload.get("query")
+        if query and (columns or row_filter):
+            raise BadRequest("query cannot be combined with columns or filter")
+        if columns is not None and (not isinstance(columns, list) or not columns
+                                    or not all(isinstance(column, str) and COLUMN.match(column)
+                                               for column in columns)):
+            raise BadRequest("columns must be a non empty list of column names")
+        if incremental and (columns or row_filter or query):
+            raise BadRequest("incremental exports cannot be combined with columns, filter or query")
+        engine = payload.get("engine", "extract")
+        if engine not in ENGINES:
+            raise BadRequest("engine must be one of {}".format(ENGINES))
+        if engine == "storage_read" and (FORMATS[export_format].merge is not compose_merge or incremental or query):
+            raise BadRequest("the storage_read engine supports csv and ndjson exports of a table, "
+                             "with columns and filter")
+
+        return cls(
+            project=payload.get("project", DEFAULT_PROJECT),
+            dataset_id=dataset_id,
+            table_id=table_id,
+            bucket=payload.get("bucket", DEFAULT_BUCKET),
+            location=payload.get("location", DEFAULT_LOCATION),
+            folder=payload.get("output", dataset_id),
+            file_name=payload.get("file_name", "export-{}-{}".format(table_id, date.today().isoformat())),
+            with_header=payload.get("with_header", False),
+            compression=compression,
+            format=export_format,
+            incremental=incremental,
+            force=payload.get("force", False),
+            columns=columns,
+            filter=row_filter,
+            query=query,
+            engine=engine,
+        )
+
+    @property
+    def query_sql(self) -> Optional[str]:
+        """
+        :return: the query selecting the exported rows and columns, None to extract the whole table
+        """
+        if self.query:
+            return self.query
+        if not self.columns and not self.filter:
+            return None
+        sql = "SELECT {} FROM `{}.{}.{}`".format(", ".join(self.columns or ["*"]), self.project, self.dataset_id,
+                                                 self.table_id)
+        if self.filter:
+            sql += " WHERE {}".format(self.filter)
+        return sql
+
+    @property
+    def export_format(self) -> ExportFormat:
+        return FORMATS[self.format]
+
+    @property
+    def extension(self) -> str:
+        return self.export_format.suffix(self.compression)
+
+    @property
+    def temp_file_prefix(self) -> str:
+        if self.export_format.merge is manifest_merge:
+            # the files are the result of the export, listed by the manifest, the files of a run
+            # are never listed by the manifest of another run
+            return f'{self.folder}/{self.file_name}/{self.run_id}/part-'
+        return f'{self.temp_folder}/partition'
+
+    @property
+    def temp_folder(self) -> str:
+        return f'{self.folder}/tmp/{self.table_id}/{self.run_id}'
+
+    @property
+    def temp_destination_uri(self) -> str:
+        return f'gs://{self.bucket}/{self.temp_file_prefix}*{self.extension}'
+
+    @property
+    def temp_header_uri(self) -> str:
+        return f'gs://{self.bucket}/{self.temp_folder}/header{self.extension}'
+
+    @property
+    def file_path(self) -> str:
+        if self.export_format.merge is manifest_merge:
+            return f'{self.folder}/{self.file_name}.manifest.json'
+        return f'{self.folder}/{self.file_name}{self.extension}'
+
+    @property
+    def temp_compose_prefix(self) -> str:
+        """The intermediate composites of the compose of this run"""
+        return f'{self.file_path}.compose/{self.run_id}/'
+
+    @property
+    def file_uri(self) -> str:
+        return "gs://{}/{}".format(self.bucket, self.file_path)
+
+
+def run_export(config: ExportConfig, storage_client: storage.Client, bigquery_client: bigquery.Client,
+               progress: Progress = None, limits: Dict[str, threading.Semaphore] = None,
+               metadata: Dict[str, str] = None, checkpoint: Checkpoint = None,
+               table: bigquery.Table = None) -> Dict:
+    """
+    Extract a BigQuery table into sharded files and merge them with the strategy of the format.
+
+    The header is fetched and written to a temporary blob while the extract job
+    runs, and the temporary files are deleted in the background once the final
+    file is composed. A projection, a filter or a query is first run into an
+    expiring temporary table, which is extracted instead of the table. With a
+    checkpoint, the stages and compose rounds done by a previous attempt stopped
+    by a shutdown are skipped and its extract job is waited for instead of
+    starting another. A failed export deletes its temporary files and its
+    checkpoint, its retry starts over.
+    The extract follows the plan picked for the size of the table, see ``utils.planner``.
+    :param config: the export configuration
+    :param storage_client: Google Cloud Storage Client
+    :param bigquery_client: BigQuery Client
+    :param progress: callback notified when a stage starts and ends
+    :param limits: semaphores bounding the concurrent runs of a stage, shared by the exports of a batch
+    :param metadata: custom metadata set on the final file
+    :param checkpoint: the progress of the export, saved after every stage, for the extract engine only
+    :param table: the exported table if already fetched, with its schema and statistics
+    :return: the result of the export, with its plan
+    """
+    if config.incremental:
+        from utils.incremental import run_incremental_export
+
+        return run_incremental_export(config, storage_client, bigquery_client, progress, limits, metadata)
+    if config.engine == "storage_read":
+        from utils.storage_read import run_storage_read_export
+
+        return run_storage_read_export(config, storage_client, bigquery_client, progress, limits, metadata)
+
+    from utils.planner import ExportPlan, plan_export
+
+    export_format = config.export_format
+    logger.info("Filename : {}{}, format {}".format(config.file_name, config.extension, export_format.name))
+    logger.info("With Header : {}".format(config.with_header))
+    if checkpoint is not None:
+        # the temporary files of the resumed run
+        config = replace(config, run_id=checkpoint.resume(config.run_id))
+
+    def saved(stage: str, default=None):
+        return checkpoint.get(stage, default) if checkpoint is not None else default
+
+    def save(stage: str, result) -> None:
+        if checkpoint is not None:
+            checkpoint.save(stage, result)
+
+    def query() -> str:
+        table_id = saved("query")
+        if table_id is None:
+            table_id = bq_query_to_table(config.project, config.dataset_id, config.query_sql, config.location,
+                                         bigquery_client)
+            save("query", table_id)
+        return table_id
+
+    def source_table(query: str = None) -> bigquery.Table:
+        if table is not None and not query:
+            return table
+        return bq_table(config.project, config.dataset_id, query or config.table_id, bigquery_client)
+
+    def plan(query: str = None) -> ExportPlan:
+        if saved("plan"):
+            # the files of the resumed run
+            return ExportPlan.from_dict(saved("plan"))
+        export_plan = plan_export(config, source_table(query))
+        save("plan", export_plan.to_dict())
+        return export_plan
+
+    def extract(plan: ExportPlan, query: str = None) -> None:
+        if saved("extract"):
+            logger.info("Shards of run {} already extracted".format(config.run_id))
+            return
+        # the job of an interrupted attempt is reattached
+        job_id = "export_{}".format(config.run_id) if checkpoint is not None else None
+        bq_export(config.project, config.dataset_id, query or config.table_id, config.location,
+                  plan.destination_uris, bigquery_client, compression=config.compression,
+                  destination_format=export_format.destination_format, job_id=job_id, poll=poll)
+        save("extract", job_id or True)
+
+    def poll() -> None:
+        # a failure of the export cancels the job, a shutdown leaves it running for the retry
+        if checkpoint is not None:
+            checkpoint.check()
+        pipeline.check()
+
+    def list_shards(extract: None, plan: ExportPlan) -> List[storage.Blob]:
+        names = saved("list_shards")
+        if plan.single_file:
+            names = [uri[len("gs://{}/".format(config.bucket)):] for uri in plan.destination_uris]
+        if names:
+            bucket = storage_client.bucket(config.bucket)
+            return [bucket.blob(name) for name in names]
+        shards = list_file(config.bucket, config.temp_file_prefix, storage_client)
+        if shards:
+            save("list_shards", [blob.name for blob in shards])
+        return shards
+
+    def header(query: str = None) -> List[str]:
+        if table is not None and not query:
+            return [field.name for field in table.schema]
+        return bq_header(config.project, config.dataset_id, query or config.table_id, bigquery_client)
+
+    def header_file(header: List[str]) -> storage.Blob:
+        return write_initial_file_with_header(config.temp_header_uri, header, storage_client,
+                                              compression=config.compression)
+
+    def compose(list_shards: List[storage.Blob], header_file: storage.Blob = None) -> List[storage.Blob]:
+        if not list_shards:
+            raise ValueError('file not found')
+        sources = ([header_file] if header_file else []) + list_shards
+        intermediates = export_format.merge(config.file_uri, sources, storage_client, export_format,
+                                            config.compression, metadata=metadata, resume=saved("compose"),
+                                            on_round=lambda progress: save("compose", progress),
+                                            prefix=config.temp_compose_prefix)
+        if checkpoint is not None:
+            # the final file is there, a retry exports again
+            checkpoint.delete()
+        return intermediates
+
+    def cleanup(list_shards: List[storage.Blob] = None, compose: List[storage.Blob] = None,
+                header_file: storage.Blob = None, query: str = None) -> None:
+        if terminating.is_set() or isinstance(pipeline.error, Terminated):
+            # stopped by the shutdown, the retry resumes from the temporary files
+            return
+        if query:
+            bq_delete_table(config.project, config.dataset_id, query, bigquery_client)
+        if compose is None:
+            # the export failed, its shards and the composites of an interrupted compose are not part of any
+            # final file
+            shards = list_shards if list_shards is not None else list_file(config.bucket, config.temp_file_prefix,
+                                                                           storage_client)
+            intermediates = list_file(config.bucket, config.temp_compose_prefix, storage_client)
+            temporaries = ([header_file] if header_file else []) + shards + intermediates
+        elif export_format.merge is compose_merge:
+            temporaries = ([header_file] if header_file else []) + list_shards + compose
+        else:
+            # the exported files of a manifest are the result, only those of the replaced manifest are deleted
+            temporaries = compose
+        if not temporaries:
+            return
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=COMPOSE_WORKERS)
+        delete_objects_concurrent(temporaries, executor, storage_client=storage_client)
+        executor.shutdown(True)
+
+    pipeline = Pipeline("export {}.{}".format(config.dataset_id, config.table_id), progress, limits)
+    source_deps = []
+    if config.query_sql:
+        pipeline.add("query", query)
+        source_deps.append("query")
+    pipeline.add("plan", plan, deps=source_deps)
+    pipeline.add("extract", extract, deps=["plan"] + source_deps)
+    pipeline.add("list_shards", list_shards, deps=["extract", "plan"])
+    merge_deps = ["list_shards"]
+    if export_format.header:
+        pipeline.add("header", header, deps=source_deps)
+        pipeline.add("header_file", header_file, deps=["header"])
+        merge_deps.append("header_file")
+    pipeline.add("compose", compose, deps=merge_deps)
+    pipeline.add("cleanup", cleanup, deps=merge_deps + source_deps + ["compose"], detached=True, always=True)
+    try:
+        results = pipeline.run()
+    except Terminated:
+        raise
+    except Exception:
+        if checkpoint is not None:
+            # the temporary files it lists are deleted by the cleanup
+            checkpoint.delete()
+        raise
+
+    logger.info("final result : {}".format(config.file_uri))
+    return {"path": config.file_uri, "format": export_format.name, "timings": pipeline.timings,
+            "plan": results["plan"].to_dict()}
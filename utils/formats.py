@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+import concurrent.futures
+import io
+import json
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from google.cloud.exceptions import NotFound
+
+from utils.compose import COMPOSE_WORKERS, compose_tree
+from utils.lazy import lazy_import
+from utils.logging import logger
+
+storage = lazy_import("google.cloud.storage")
+
+# merge(file_uri, sources, gcs_client, export_format, compression, metadata=None, resume=None, on_round=None,
+#       prefix=None)
+# -> temporary blobs to delete
+Merge = Callable[..., List["storage.Blob"]]
+
+
+def compose_merge(file_uri: str, sources: List[storage.Blob], gcs_client: storage.Client,
+                  export_format: "ExportFormat", compression: Optional[str],
+                  metadata: Dict[str, str] = None, resume: Dict = None,
+                  on_round: Callable[[Dict], None] = None, prefix: str = None) -> List[storage.Blob]:
+    """
+    Merge formats whose files can be concatenated byte by byte, with server-side composes
+    :param file_uri: the uri of the final file
+    :param sources: ordered list of blobs, the header first if any
+    :param gcs_client: Google Cloud Storage Client
+    :param export_format: the format of the files
+    :param compression: the compression of the files
+    :param metadata: custom metadata set on the final file
+    :param resume: the progress of an interrupted merge of the same sources, see ``compose_tree``
+    :param on_round: called with the progress of the merge once a compose round is done
+    :param prefix: the prefix of the intermediate composites, see ``compose_tree``
+    :return: the intermediate composites
+    """
+    final_blob = storage.Blob.from_string(file_uri)
+    final_blob.metadata = metadata
+    final_blob.content_type = export_format.content_type
+    # concatenated gzip members are a valid gzip stream
+    final_blob.content_encoding = export_format.content_encoding(compression)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=COMPOSE_WORKERS)
+    try:
+        return compose_tree(final_blob, sources, gcs_client, executor, resume=resume, on_round=on_round,
+                            prefix=prefix)
+    finally:
+        executor.shutdown(True)
+
+
+def manifest_merge(file_uri: str, sources: List[storage.Blob], gcs_client: storage.Client,
+                   export_format: "ExportFormat", compression: Optional[str],
+                   metadata: Dict[str, str] = None, resume: Dict = None,
+                   on_round: Callable[[Dict], None] = None, prefix: str = None) -> List[storage.Blob]:
+    """
+    Container formats (Avro, Parquet) cannot be concatenated: keep the files and write a manifest listing them
+    :param file_uri: the uri of the manifest
+    :param sources: ordered list of the exported files
+    :param gcs_client: Google Cloud Storage Client
+    :param export_format: the format of the files
+    :param compression: the compression of the files
+    :param metadata: custom metadata set on the manifest
+    :param resume: unused, the manifest is written at once
+    :param on_round: unused
+    :param prefix: unused
+    :return: the files of the previous export listed by the replaced manifest, to be deleted by the caller
+    """
+    logger.info("Writing manifest of {} files to {}".format(len(sources), file_uri))
+    manifest_blob = storage.Blob.from_string(file_uri)
+    try:
+        previous = json.loads(manifest_blob.download_as_bytes(client=gcs_client)).get("files", [])
+    except NotFound:
+        previous = []
+    manifest_blob.metadata = metadata
+    files = ["gs://{}/{}".format(blob.bucket.name, blob.name) for blob in sources]
+    manifest_blob.upload_from_file(io.BytesIO(manifest(export_format, compression, files)),
+                                   content_type="application/json", client=gcs_client)
+    return [storage.Blob.from_string(uri) for uri in previous if uri not in files]
+
+
+def manifest(export_format: "ExportFormat", compression: Optional[str], files: List[str]) -> bytes:
+    """
+    :param files: the uris of the exported files, in order
+    :return: the json manifest listing the files of a container format
+    """
+    return json.dumps({
+        "format": export_format.name,
+        "compression": compression,
+        "created": datetime.now(timezone.utc).isoformat(),
+        "files": files,
+    }, indent=2).encode("utf-8")
+
+
+class ExportFormat:
+    def __init__(self, name: str, destination_format: str, extension: str, content_type: str,
+                 compressions: Dict[Optional[str], Tuple[str, Optional[str]]], merge: Merge, header: bool = False):
+        """
+        :param name: the name of the format in the export payload
+        :param destination_format: the BigQuery destination format
+        :param extension: the extension of the files
+        :param content_type: the content type of the final file
+        :param compressions: the supported compressions, with their file suffix and content encoding
+        :param merge: the strategy merging the exported files
+        :param header: whether the format has a header line written by the service
+        """
+        self.name = name
+        self.destination_format = destination_format
+        self.extension = extension
+        self.content_type = content_type
+        self.compressions = compressions
+        self.merge = merge
+        self.header = header
+
+    def suffix(self, compression: Optional[str]) -> str:
+        return self.extension + self.compressions[compression][0]
+
+    def content_encoding(self, compression: Optional[str]) -> Optional[str]:
+        return self.compressions[compression][1]
+
+
+FORMATS = {
+    "csv": ExportFormat("csv", "CSV", ".csv", "text/csv",
+                        {None: ("", None), "gzip": (".gz", "gzip")}, compose_merge, header=True),
+    "ndjson": ExportFormat("ndjson", "NEWLINE_DELIMITED_JSON", ".json", "application/x-ndjson",
+                           {None: ("", None), "gzip": (".gz", "gzip")}, compose_merge),
+    "avro": ExportFormat("avro", "AVRO", ".avro", "application/avro",
+                         {None: ("", None), "deflate": ("", None), "snappy": ("", None)}, manifest_merge),
+    "parquet": ExportFormat("parquet", "PARQUET", ".parquet", "application/vnd.apache.parquet",
+                            {None: ("", None), "snappy": ("", None), "gzip": ("", None)}, manifest_merge),
+}
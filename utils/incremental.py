@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import concurrent.futures
+import hashlib
+import io
+import json
+import threading
+from dataclasses import replace
+from typing import Dict, List
+
+from google.cloud.exceptions import NotFound
+
+from utils.bigquery import bq_export, bq_header, bq_partitions, bq_table
+from utils.compose import COMPOSE_WORKERS, compose_tree, delete_objects_concurrent, list_file, write_initial_file_with_header
+from utils.export import ExportConfig
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import Pipeline, Progress
+
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+
+# Changed partitions extracted and composed at the same time
+PARTITION_CONCURRENCY = 4
+
+
+def cache_prefix(config: ExportConfig) -> str:
+    """The per-partition composites of the table are kept under this prefix, reused by the next exports"""
+    return f'{config.folder}/partitions/{config.table_id}/'
+
+
+def manifest_uri(config: ExportConfig) -> str:
+    return f'gs://{config.bucket}/{cache_prefix(config)}manifest{config.extension}.json'
+
+
+def read_manifest(config: ExportConfig, storage_client: storage.Client) -> Dict:
+    """
+    :return: the manifest of the cached partitions, empty if there is none yet
+    """
+    try:
+        data = storage.Blob.from_string(manifest_uri(config)).download_as_bytes(client=storage_client)
+        return json.loads(data)
+    except NotFound:
+        return {"schema": None, "partitions": {}}
+
+
+def write_manifest(config: ExportConfig, manifest: Dict, storage_client: storage.Client) -> None:
+    blob = storage.Blob.from_string(manifest_uri(config))
+    blob.upload_from_file(io.BytesIO(json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8")),
+                          content_type="application/json", client=storage_client)
+
+
+def schema_fingerprint(schema: List[bigquery.SchemaField]) -> str:
+    """
+    :param schema: the schema of the table
+    :return: the digest of the names, types and modes of the fields, nested ones included
+    """
+    def fields(schema: List[bigquery.SchemaField]) -> List:
+        return [[field.name, field.field_type, field.mode, fields(field.fields)] for field in schema]
+
+    return hashlib.sha256(json.dumps(fields(schema)).encode("utf-8")).hexdigest()
+
+
+def changed_partitions(partitions: Dict[str, int], manifest: Dict, schema: str) -> List[str]:
+    """
+    :param partitions: the last modified time of each partition of the table
+    :param manifest: the manifest of the cached partitions
+    :param schema: the fingerprint of the schema of the table
+    :return: the partitions to extract again, every partition if the schema changed
+    """
+    cached = manifest["partitions"] if manifest.get("schema") == schema else {}
+    return sorted(partition_id for partition_id, last_modified in partitions.items()
+                  if cached.get(partition_id, {}).get("last_modified") != last_modified)
+
+
+def export_partition(config: ExportConfig, partition_id: str, storage_client: storage.Client,
+                     bigquery_client: bigquery.Client, executor: concurrent.futures.ThreadPoolExecutor) -> str:
+    """
+    Extract one partition through its partition decorator and compose it into its cached composite
+    :return: the path of the composite
+    """
+    prefix = f'{config.temp_folder}/{partition_id}/partition'
+    composite_path = f'{cache_prefix(config)}{partition_id}{config.extension}'
+    # under the folder of the run, deleted with it if the export fails
+    compose = f'{config.temp_folder}/{partition_id}/compose/'
+    bq_export(config.project, config.dataset_id, f'{config.table_id}${partition_id}', config.location,
+              f'gs://{config.bucket}/{prefix}*{config.extension}', bigquery_client, compression=config.compression,
+              destination_format=config.export_format.destination_format)
+    shards = list_file(config.bucket, prefix, storage_client)
+    if not shards:
+        raise ValueError('file not found')
+    composite = storage.Blob.from_string(f'gs://{config.bucket}/{composite_path}')
+    intermediates = compose_tree(composite, shards, storage_client, executor, prefix=compose)
+    delete_objects_concurrent(shards + intermediates, executor, storage_client=storage_client)
+    return composite_path
+
+
+def run_incremental_export(config: ExportConfig, storage_client: storage.Client, bigquery_client: bigquery.Client,
+                           progress: Progress = None, limits: Dict[str, threading.Semaphore] = None,
+                           metadata: Dict[str, str] = None) -> Dict:
+    """
+    Export only the partitions modified since the previous export of the table, then rebuild the
+    final file from the cached per-partition composites. Tables without partitions, or with rows out of
+    any partition (streaming buffer, NULL partitioning column), are fully exported.
+    :param config: the export configuration
+    :param storage_client: Google Cloud Storage Client
+    :param bigquery_client: BigQuery Client
+    :param progress: callback notified when a stage starts and ends
+    :param limits: semaphores bounding the concurrent runs of a stage, shared by the exports of a batch
+    :param metadata: custom metadata set on the final file
+    :return: the result of the export
+    """
+    from utils.export import run_export
+
+    export_format = config.export_format
+    partitions = bq_partitions(config.project, config.dataset_id, config.table_id, config.location,
+                               bigquery_client)
+    if not partitions:
+        logger.info("Table {}.{} is not {}, exporting it fully".format(
+            config.dataset_id, config.table_id, "partitioned" if partitions == {} else "fully partitioned"))
+        return run_export(replace(config, incremental=False), storage_client, bigquery_client, progress, limits,
+                          metadata)
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=COMPOSE_WORKERS)
+    stats = {}
+
+    def header() -> List[str]:
+        return bq_header(config.project, config.dataset_id, config.table_id, bigquery_client)
+
+    def header_file(header: List[str]) -> storage.Blob:
+        if not export_format.header:
+            return None
+        return write_initial_file_with_header(config.temp_header_uri, header, storage_client,
+                                              compression=config.compression)
+
+    def manifest() -> Dict:
+        return read_manifest(config, storage_client)
+
+    def partition_files(manifest: Dict) -> Dict:
+        # a change of the type or mode of a field changes the content of every partition, not only its name
+        schema = schema_fingerprint(bq_table(config.project, config.dataset_id, config.table_id,
+                                             bigquery_client).schema)
+        changed = changed_partitions(partitions, manifest, schema)
+        stats.update(partitions=len(partitions), extracted=len(changed))
+        logger.info("Extracting {} of {} partitions".format(len(changed), len(partitions)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PARTITION_CONCURRENCY) as partition_executor:
+            futures = {partition_id: partition_executor.submit(export_partition, config, partition_id,
+                                                               storage_client, bigquery_client, executor)
+                       for partition_id in changed}
+            paths = {partition_id: future.result() for partition_id, future in futures.items()}
+        cached = manifest["partitions"] if manifest.get("schema") == schema else {}
+        manifest = {"schema": schema, "partitions": {}}
+        for partition_id in sorted(partitions):
+            path = paths[partition_id] if partition_id in paths else cached[partition_id]["path"]
+            manifest["partitions"][partition_id] = {"last_modified": partitions[partition_id], "path": path}
+        return manifest
+
+    def compose(partition_files: Dict, header_file: storage.Blob) -> List[storage.Blob]:
+        composites = [storage.Blob.from_string(f'gs://{config.bucket}/{entry["path"]}')
+                      for _, entry in sorted(partition_files["partitions"].items())]
+        sources = ([header_file] if header_file else []) + composites
+        return export_format.merge(config.file_uri, sources, storage_client, export_format, config.compression,
+                                   metadata=metadata, prefix=config.temp_compose_prefix)
+
+    def save_manifest(partition_files: Dict, compose: List[storage.Blob]) -> None:
+        write_manifest(config, partition_files, storage_client)
+
+    def cleanup(manifest: Dict = None, partition_files: Dict = None, compose: List[storage.Blob] = None,
+                header_file: storage.Blob = None) -> None:
+        if compose is None:
+            # the export failed, the files of its run (header, shards, composites of an interrupted compose) are
+            # not part of any file, the cached composites written are extracted again by the next export
+            temporaries = (list_file(config.bucket, config.temp_folder + "/", storage_client)
+                           + list_file(config.bucket, config.temp_compose_prefix, storage_client))
+        else:
+            kept = {entry["path"] for entry in partition_files["partitions"].values()}
+            # composites of the partitions dropped from the table
+            dropped = [storage.Blob.from_string(f'gs://{config.bucket}/{entry["path"]}')
+                       for entry in manifest["partitions"].values() if entry["path"] not in kept]
+            temporaries = ([header_file] if header_file else []) + compose + dropped
+        if not temporaries:
+            return
+        cleanup_executor = concurrent.futures.ThreadPoolExecutor(max_workers=COMPOSE_WORKERS)
+        delete_objects_concurrent(temporaries, cleanup_executor, storage_client=storage_client)
+        cleanup_executor.shutdown(True)
+
+    pipeline = Pipeline("incremental export {}.{}".format(config.dataset_id, config.table_id), progress, limits)
+    pipeline.add("header", header)
+    pipeline.add("header_file", header_file, deps=["header"])
+    pipeline.add("manifest", manifest)
+    pipeline.add("partition_files", partition_files, deps=["manifest"])
+    pipeline.add("compose", compose, deps=["partition_files", "header_file"])
+    pipeline.add("save_manifest", save_manifest, deps=["partition_files", "compose"])
+    pipeline.add("cleanup", cleanup, deps=["manifest", "partition_files", "compose", "header_file"], detached=True,
+                 always=True)
+    try:
+        pipeline.run()
+    finally:
+        # the partitions are composed, the cleanup deletes with an executor of its own
+        executor.shutdown(False)
+
+    logger.info("final result : {}".format(config.file_uri))
+    return {"path": config.file_uri, "format": export_format.name, "timings": pipeline.timings,
+            "partitions": stats}
@@ -0,0 +1,315 @@
+import asyncio
+import concurrent.futures
+import io
+import json
+import os
+import re
+import threading
+import traceback
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from time import monotonic
+from typing import Awaitable, Callable, Dict, Iterator, List, Optional, Set
+
+from google.cloud.exceptions import NotFound
+
+from utils import tracing
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.ratelimit import scheduler
+
+storage = lazy_import("google.cloud.storage")
+
+# Background exports are not bound by the gunicorn threads
+MAX_WORKERS = int(os.environ.get("EXPORT_JOB_WORKERS", 32))
+# Finished jobs are forgotten after this many seconds, their status objects are deleted
+RETENTION = int(os.environ.get("EXPORT_JOB_RETENTION", 3600))
+# Folder of the status objects of the jobs, e.g. gs://bucket/jobs, so that any instance answers for a job;
+# unset, a job is only known to the worker process which runs it
+STATUS_URI = os.environ.get("EXPORT_JOB_STATUS_URI")
+# Concurrent writes of the status objects, a write per stage of a job
+STATUS_WRITERS = int(os.environ.get("EXPORT_JOB_STATUS_WRITERS", 4))
+
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class Job:
+    """State of a background export, updated by the pipeline through ``progress``"""
+
+    def __init__(self, stages: List[str], on_change: Callable[["Job"], None] = None):
+        """
+        :param stages: the stages reported by the pipeline
+        :param on_change: called after every change of the job, to save it
+        """
+        self.id = uuid.uuid4().hex
+        self.status = "pending"
+        self.created = _now()
+        self.stages: Dict[str, Dict] = {stage: {"status": "pending"} for stage in stages}
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.finished: Optional[str] = None
+        self.finished_at: Optional[float] = None
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        # serializes the writes of the status object, whether one is queued and not started yet
+        self._write_lock = threading.Lock()
+        self._write_pending = False
+        self._deleted = False
+
+    @classmethod
+    def from_dict(cls, job: Dict) -> "Job":
+        """
+        :param job: the status object of the job, see ``to_dict``
+        :return: a snapshot of the job, which is run by another process
+        """
+        snapshot = cls([])
+        snapshot.id = job["job_id"]
+        snapshot.status = job["status"]
+        snapshot.created = job["created"]
+        snapshot.stages = job["stages"]
+        snapshot.result = job.get("result")
+        snapshot.error = job.get("error")
+        snapshot.finished = job.get("finished")
+        return snapshot
+
+    def _changed(self) -> None:
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def progress(self, stage: str, status: str) -> None:
+        """
+        :param stage: the name of the stage
+        :param status: "running" or "done"
+        """
+        with self._lock:
+            entry = self.stages.setdefault(stage, {})
+            entry["status"] = status
+            entry["started" if status == "running" else "finished"] = _now()
+        self._changed()
+
+    def update(self, status: str, result: Dict = None, error: str = None) -> None:
+        """
+        :param status: "running", "succeeded" or "failed"
+        :param result: the result of the pipeline, once it succeeded
+        :param error: the error of the pipeline, once it failed
+        """
+        with self._lock:
+            self.status = status
+            if result is not None:
+                self.result = result
+            if error is not None:
+                self.error = error
+            if status in ("succeeded", "failed"):
+                self.finished = _now()
+                self.finished_at = monotonic()
+        self._changed()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            job = {
+                "job_id": self.id,
+                "status": self.status,
+                "created": self.created,
+                "stages": {stage: dict(entry) for stage, entry in self.stages.items()},
+            }
+            if self.result is not None:
+                job["result"] = self.result
+            if self.error is not None:
+                job["error"] = self.error
+            if self.finished is not None:
+                job["finished"] = self.finished
+            return job
+
+
+class JobStore:
+    """Registry of background exports, run by the worker process which submitted them.
+
+    The jobs are kept in memory. Without ``status_uri`` a job is only known to that process: with
+    several gunicorn workers or Cloud Run instances, the poll of a job must reach the same process,
+    e.g. a single worker on a single instance. With ``status_uri`` every change of a job is also
+    written to ``{status_uri}/{job_id}.json``, so any instance answers for any job. The writes run
+    in the background, those of a job are serialized, and a burst of changes is written once.
+    The status object of a finished job is deleted once the job expires, by the process which ran
+    it, or by the first read after its retention if that process is gone.
+
+    Note: on Cloud Run the instance must have CPU always allocated for jobs to
+    progress once the request that submitted them has returned.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, retention: int = RETENTION,
+                 status_uri: str = STATUS_URI, storage_client: storage.Client = None):
+        """
+        :param status_uri: the folder of the status objects of the jobs, None to keep them in memory only
+        :param storage_client: Google Cloud Storage Client, the one of the process by default
+        """
+        self.retention = retention
+        self.status_uri = status_uri.rstrip("/") if status_uri else None
+        self._storage_client = storage_client
+        self._jobs: Dict[str, Job] = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="export-job")
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=STATUS_WRITERS,
+                                                             thread_name_prefix="export-job-status")
+        # the jobs of the asynchronous service, referenced until they are done
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def storage_client(self) -> storage.Client:
+        if self._storage_client is None:
+            from utils.clients import registry
+            self._storage_client = registry.gcs_client()
+        return self._storage_client
+
+    def _status_blob(self, job_id: str) -> storage.Blob:
+        return storage.Blob.from_string("{}/{}.json".format(self.status_uri, job_id))
+
+    def _persist(self, job: Job) -> None:
+        """Queue a write of the status object of the job, unless one is queued already"""
+        with job._lock:
+            if job._write_pending:
+                return
+            job._write_pending = True
+        self._writer.submit(self._write, job)
+
+    def _write(self, job: Job) -> None:
+        # the snapshot is taken under the write lock, the last write of the job has its last changes
+        with job._write_lock:
+            with job._lock:
+                job._write_pending = False
+            if job._deleted:
+                return
+            data = json.dumps(job.to_dict()).encode("utf-8")
+            blob = self._status_blob(job.id)
+            try:
+                scheduler.call(lambda: blob.upload_from_file(io.BytesIO(data), content_type="application/json",
+                                                             client=self.storage_client),
+                               blob.bucket.name, [blob.name])
+            except Exception as err:
+                logger.warning("Could not save the status of job {}: {}".format(job.id, err))
+
+    def _delete(self, job: Job) -> None:
+        # the writes of the job still queued are dropped
+        with job._write_lock:
+            job._deleted = True
+            blob = self._status_blob(job.id)
+            try:
+                scheduler.call(lambda: blob.delete(client=self.storage_client), blob.bucket.name, [blob.name])
+            except NotFound:
+                pass
+            except Exception as err:
+                logger.warning("Could not delete the status of job {}: {}".format(job.id, err))
+
+    def _read(self, job_id: str) -> Optional[Job]:
+        if self.status_uri is None or not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            data = self._status_blob(job_id).download_as_bytes(client=self.storage_client)
+        except NotFound:
+            return None
+        job = Job.from_dict(json.loads(data))
+        if job.finished is not None and \
+                (datetime.now(timezone.utc) - datetime.fromisoformat(job.finished)).total_seconds() > self.retention:
+            # left by a process which stopped before the job expired
+            self._writer.submit(self._delete, job)
+            return None
+        return job
+
+    def _add(self, stages: List[str]) -> Job:
+        job = Job(stages, self._persist if self.status_uri else None)
+        with self._lock:
+            expired = self._expire()
+            self._jobs[job.id] = job
+        if self.status_uri:
+            for old in expired:
+                self._writer.submit(self._delete, old)
+        job._changed()
+        return job
+
+    def submit(self, fn: Callable[[Job], Dict], stages: List[str]) -> Job:
+        """
+        :param fn: the pipeline to run, called with the job to report its progress
+        :param stages: the stages reported by the pipeline
+        :return: the pending job
+        """
+        job = self._add(stages)
+        # the spans of the job are children of the span of the request which submitted it
+        self._executor.submit(tracing.propagate(self._run), job, fn)
+        logger.info("Submitted job {}".format(job.id))
+        return job
+
+    def submit_async(self, fn: Callable[[Job], Awaitable[Dict]], stages: List[str]) -> Job:
+        """
+        Run the job as a task of the running event loop, not bound by the workers of the store
+        :param fn: the coroutine function of the pipeline, called with the job to report its progress
+        :param stages: the stages reported by the pipeline
+        :return: the pending job
+        """
+        job = self._add(stages)
+        task = asyncio.get_running_loop().create_task(self._run_async(job, fn))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        logger.info("Submitted job {}".format(job.id))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """
+        :return: the job run by this process, else the snapshot of its status object if any
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else self._read(job_id)
+
+    def _run(self, job: Job, fn: Callable[[Job], Dict]) -> None:
+        with self._running(job) as done:
+            done(fn(job))
+
+    async def _run_async(self, job: Job, fn: Callable[[Job], Awaitable[Dict]]) -> None:
+        with self._running(job) as done:
+            done(await fn(job))
+
+    @staticmethod
+    @contextmanager
+    def _running(job: Job) -> Iterator[Callable[[Dict], None]]:
+        """
+        Track the status of the job while it runs, its failure is recorded and not raised
+        :return: called with the result of the job
+        """
+        job.update("running")
+        results = []
+        try:
+            yield results.append
+            job.update("succeeded", result=results[0] if results else None)
+            logger.info("Job {} succeeded".format(job.id))
+        except Exception as err:
+            job.update("failed", error=str(err))
+            logger.error("Job {} failed: {}".format(job.id, err))
+            logger.debug(''.join(traceback.format_exception(type(err), value=err, tb=err.__traceback__)))
+        finally:
+            if job.status == "running":
+                # cancelled, e.g. the task of the asynchronous service when the event loop stops, and raised
+                job.update("failed", error="cancelled")
+                logger.error("Job {} cancelled".format(job.id))
+
+    def _expire(self) -> List[Job]:
+        """
+        :return: the finished jobs dropped after their retention
+        """
+        deadline = monotonic() - self.retention
+        expired = [job for job in self._jobs.values() if job.finished_at is not None and job.finished_at < deadline]
+        for job in expired:
+            del self._jobs[job.id]
+        return expired
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait)
+        # the last status of the jobs is written once they are done
+        self._writer.shutdown(wait)
+
+
+jobs = JobStore()
@@ -0,0 +1,83 @@
+import importlib
+import importlib.util
+import threading
+import types
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+# Called with the name of a module and the seconds its first import took
+_observers: List[Callable[[str, float], None]] = []
+# One proxy per module, shared by the modules importing it
+_modules: Dict[str, "LazyModule"] = {}
+
+
+class LazyModule(types.ModuleType):
+    """Stands for a module imported on the first access to one of its attributes.
+
+    The attributes set on the proxy, as ``unittest.mock.patch`` does, are set on the module.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        # set on the instance dictionary, they never reach the module
+        object.__setattr__(self, "_module", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _load(self) -> types.ModuleType:
+        module = object.__getattribute__(self, "_module")
+        if module is not None:
+            return module
+        with object.__getattribute__(self, "_lock"):
+            module = object.__getattribute__(self, "_module")
+            if module is None:
+                start = perf_counter()
+                module = importlib.import_module(self.__name__)
+                for observer in _observers:
+                    observer(self.__name__, perf_counter() - start)
+                object.__setattr__(self, "_module", module)
+        return module
+
+    @property
+    def loaded(self) -> bool:
+        return object.__getattribute__(self, "_module") is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name: str, value) -> None:
+        setattr(self._load(), name, value)
+
+    def __delattr__(self, name: str) -> None:
+        delattr(self._load(), name)
+
+    def __dir__(self) -> List[str]:
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        return "<lazy module '{}'{}>".format(self.__name__, "" if self.loaded else " (not loaded)")
+
+
+def lazy_import(name: str, optional: bool = False) -> Optional[LazyModule]:
+    """
+    :param name: the absolute name of the module
+    :param optional: return None if the module is not installed
+    :return: the module, imported on first use
+    """
+    if optional and importlib.util.find_spec(name) is None:
+        return None
+    if name not in _modules:
+        _modules[name] = LazyModule(name)
+    return _modules[name]
+
+
+def load_all() -> None:
+    """Import the modules not used yet, see the warm-up of ``gunicorn.conf.py``"""
+    for module in list(_modules.values()):
+        module._load()
+
+
+def observe(observer: Callable[[str, float], None]) -> None:
+    """
+    :param observer: called with the name of a module and the seconds of its import, once per lazy module
+    """
+    _observers.append(observer)
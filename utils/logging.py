@@ -12,13 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Dict
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+from time import monotonic
+from typing import Dict, List, Optional, TextIO
 
 from flask import request
 import structlog
 
 from utils import metadata
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# Request threads block once this many log lines are waiting to be written
+MAX_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+LOG_BATCH_SIZE = 256
+
 
 def field_name_modifier(
     logger: structlog._loggers.PrintLogger, log_method: str, event_dict: Dict
@@ -52,15 +68,110 @@ def trace_modifier(
         # Only append the trace if it exists in the request
         if trace_header:
             trace = trace_header.split("/")
-            project = metadata.get_project_id()
+            project = metadata.project_id.get()
             event_dict[
                 "logging.googleapis.com/trace"
             ] = f"projects/{project}/traces/{trace[0]}"
     return event_dict
 
 
+def _dumps(event_dict: Dict, **kwargs) -> str:
+    if orjson is not None:
+        return orjson.dumps(event_dict, default=kwargs.get("default")).decode("utf-8")
+    return json.dumps(event_dict, **kwargs)
+
+
+class LogWriter:
+    """Renders queued event dicts to JSON and writes them in batches from a background thread"""
+
+    def __init__(self, stream: Optional[TextIO] = None, max_queue_size: int = MAX_QUEUE_SIZE,
+                 batch_size: int = LOG_BATCH_SIZE):
+        # the stream defaults to the sys.stdout of the time of the write
+        self.stream = stream
+        self.batch_size = batch_size
+        self.renderer = structlog.processors.JSONRenderer(serializer=_dumps)
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def put(self, event_dict: Dict) -> None:
+        self._ensure_started()
+        self._queue.put(event_dict)
+
+    def _ensure_started(self) -> None:
+        # the writer thread does not survive a fork, start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            batch: List[Dict] = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                # a dead writer would block the request threads on the full queue, the batch is dropped instead
+                sys.stderr.write("Failed to write {} log lines: {}\n".format(len(batch), e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write(self, batch: List[Dict]) -> None:
+        lines = []
+        for event_dict in batch:
+            try:
+                lines.append(self.renderer(None, "", event_dict))
+            except Exception as e:
+                lines.append(json.dumps({"severity": "error", "message": "Failed to render log: {}".format(e)}))
+        stream = self.stream or sys.stdout
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+
+    def flush(self, timeout: float) -> bool:
+        """
+        Wait until every queued event is written
+        :param timeout: the deadline in seconds
+        :return: False if the deadline was reached first
+        """
+        deadline = monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+
+class QueueLogger:
+    """structlog logger handing the processed event dicts over to a LogWriter"""
+
+    def __init__(self, writer: LogWriter):
+        self._writer = writer
+
+    def msg(self, **event_dict) -> None:
+        self._writer.put(event_dict)
+
+    log = debug = info = warn = warning = msg
+    fatal = failure = err = error = critical = exception = msg
+
+
+writer = LogWriter()
+
+
 def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
-    """Create a JSON logger using the field name and trace modifiers created above"""
+    """Create a JSON logger using the field name and trace modifiers created above.
+    The request thread only runs the processors, rendering and writing happen in the LogWriter."""
     # extend using https://www.structlog.org/en/stable/processors.html
     structlog.configure(
         processors=[
@@ -69,9 +180,9 @@ def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
             field_name_modifier,
             trace_modifier,
             structlog.processors.TimeStamper("iso"),
-            structlog.processors.JSONRenderer(),
         ],
         wrapper_class=structlog.stdlib.BoundLogger,
+        logger_factory=lambda *args: QueueLogger(writer),
     )
     return structlog.get_logger()
 
@@ -79,11 +190,10 @@ def getJSONLogger() -> structlog._config.BoundLoggerLazyProxy:
 logger = getJSONLogger()
 
 
-def flush() -> None:
-    # Setting PYTHONUNBUFFERED in Dockerfile/Buildpack ensured no buffering
+def flush(timeout: float = 5.0) -> None:
+    """Write the queued log lines, Cloud Run leaves 10 seconds between SIGTERM and SIGKILL"""
+    if not writer.flush(timeout):
+        sys.stderr.write("Log queue not drained within {}s\n".format(timeout))
+
 
-    # https://docs.python.org/3/library/logging.html#logging.shutdown
-    # When the logging module is imported, it registers this
-    # function as an exit handler (see atexit), so normally
-    # there’s no need to do that manually.
-    pass
+atexit.register(flush)
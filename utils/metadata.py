@@ -12,11 +12,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import threading
+from time import monotonic
+from typing import Any, Callable
+
 import google.auth
-import requests
+
+from utils.lazy import lazy_import
+
+requests = lazy_import("requests")
+transport = lazy_import("google.auth.transport.requests")
+id_token = lazy_import("google.oauth2.id_token")
 
 METADATA_URI = "http://metadata.google.internal/computeMetadata/v1/"
 
+# Seconds before a cached metadata value is resolved again
+METADATA_TTL = float(os.environ.get("METADATA_TTL", 3600))
+
 
 def get_project_id() -> str:
     """Use the 'google-auth-library' to make a request to the metadata server or
@@ -33,14 +46,51 @@ def get_service_region() -> str:
     return data.content
 
 
+class CachedValue:
+    """A value resolved once by ``loader`` and kept in memory for ``ttl`` seconds.
+    If a refresh fails, the previous value is kept until the next refresh."""
+
+    def __init__(self, loader: Callable[[], Any], ttl: float = METADATA_TTL):
+        self.loader = loader
+        self.ttl = ttl
+        self._value = None
+        self._expires = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        # lock free when fresh, this is read on every log line
+        if monotonic() < self._expires:
+            return self._value
+        return self.refresh()
+
+    def refresh(self) -> Any:
+        with self._lock:
+            if monotonic() < self._expires:
+                return self._value
+            try:
+                self._value = self.loader()
+            except Exception:
+                if self._value is None:
+                    raise
+            self._expires = monotonic() + self.ttl
+            return self._value
+
+    def invalidate(self) -> None:
+        self._expires = 0.0
+
+
+project_id = CachedValue(get_project_id)
+service_region = CachedValue(get_service_region)
+
+
 def authenticated_request(url: str, method: str) -> str:
     """Make a request with an ID token to a protected service
     https://cloud.google.com/functions/docs/securing/authenticating#functions-bearer-token-example-python"""
 
-    auth_req = google.auth.transport.requests.Request()
-    id_token = google.oauth2.id_token.fetch_id_token(auth_req, url)
+    auth_req = transport.Request()
+    token = id_token.fetch_id_token(auth_req, url)
 
     resp = requests.request(
-        method, url, headers={"Authorization": f"Bearer {id_token}"}
+        method, url, headers={"Authorization": f"Bearer {token}"}
     )
     return resp.content
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Iterator
+
+# CONTENT_TYPE_LATEST is re-exported, the media type of ``exposition`` for the routes
+from prometheus_client import CONTENT_TYPE_LATEST  # noqa: F401
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import PlatformCollector, ProcessCollector
+
+# Metrics of the worker process, gunicorn runs a single worker with several threads
+registry = CollectorRegistry()
+ProcessCollector(registry=registry)
+PlatformCollector(registry=registry)
+
+# From a header upload to a full table extract
+SECONDS_BUCKETS = (.01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+COUNT_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Duration of the HTTP requests",
+                            ["route", "method", "status"], buckets=SECONDS_BUCKETS, registry=registry)
+REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being served", registry=registry)
+
+EXPORTS = Counter("exports_total", "Exports by engine, format and result (exported, cached, coalesced, failed)",
+                  ["engine", "format", "result"], registry=registry)
+EXPORT_SECONDS = Histogram("export_duration_seconds", "Duration of the exports", ["engine", "format"],
+                           buckets=SECONDS_BUCKETS, registry=registry)
+EXPORTS_IN_FLIGHT = Gauge("exports_in_flight", "Exports running in the worker", registry=registry)
+ADMISSIONS = Counter("export_admissions_total", "Export requests by admission (admitted, shared, rejected)",
+                     ["result"], registry=registry)
+ADMITTED_SHARDS = Gauge("export_admitted_shards", "Estimated shards of the admitted exports", registry=registry)
+STAGE_SECONDS = Histogram("export_stage_duration_seconds", "Duration of the stages of the export pipelines",
+                          ["stage", "status"], buckets=SECONDS_BUCKETS, registry=registry)
+ERRORS = Counter("export_errors_total", "Failed stages by error class", ["stage", "error"], registry=registry)
+
+EXTRACT_SECONDS = Histogram("bigquery_extract_duration_seconds", "Wait for the BigQuery extract jobs",
+                            ["format"], buckets=SECONDS_BUCKETS, registry=registry)
+COMPOSE_SOURCES = Histogram("gcs_compose_sources", "Files merged by a compose tree", buckets=COUNT_BUCKETS,
+                            registry=registry)
+COMPOSE_ROUND_SECONDS = Histogram("gcs_compose_round_duration_seconds", "Duration of the rounds of parallel "
+                                  "composes, the final compose is round \"final\"", ["round"],
+                                  buckets=SECONDS_BUCKETS, registry=registry)
+COMPOSES = Counter("gcs_compose_requests_total", "Compose requests", registry=registry)
+COMPOSED_BYTES = Counter("gcs_composed_bytes_total", "Size of the files composed into final files",
+                         registry=registry)
+DELETES = Counter("gcs_deletes_total", "Deleted temporary files by result (deleted, failed)", ["result"],
+                  registry=registry)
+DELETE_SECONDS = Histogram("gcs_delete_duration_seconds", "Duration of the deletes of the temporary files",
+                           buckets=SECONDS_BUCKETS, registry=registry)
+RATE_LIMIT_SECONDS = Counter("gcs_rate_limit_wait_seconds_total", "Time the GCS mutations waited for their tokens",
+                             registry=registry)
+TABLE_CACHE_LOOKUPS = Counter("bigquery_table_cache_lookups_total", "Reads of the table metadata cache by result "
+                              "(hit, revalidated, miss)", ["result"], registry=registry)
+TABLE_CACHE_EVICTIONS = Counter("bigquery_table_cache_evictions_total", "Tables evicted from the metadata cache",
+                                registry=registry)
+MUTATION_RETRIES = Counter("gcs_mutation_retries_total", "GCS mutations retried after a throttling or failed "
+                           "answer, by status", ["status"], registry=registry)
+
+
+@contextmanager
+def timed(histogram: Histogram, **labels) -> Iterator[None]:
+    """Observe the duration of the block, whether it succeeds or not"""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        (histogram.labels(**labels) if labels else histogram).observe(perf_counter() - start)
+
+
+def exposition() -> bytes:
+    """
+    :return: the metrics in the Prometheus text format
+    """
+    return generate_latest(registry)
@@ -0,0 +1,263 @@
+import asyncio
+import concurrent.futures
+import threading
+import traceback
+from contextlib import nullcontext
+from time import perf_counter
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from utils import metrics, tracing
+from utils.logging import logger
+
+# progress(stage, status) is called when a stage is "running" and "done"
+Progress = Callable[[str, str], None]
+
+# Detached stages outlive the pipeline run, e.g. the cleanup of temporary files
+_background = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="pipeline-background")
+# The detached stages of the asynchronous pipelines, referenced until they are done
+_background_tasks: Set[asyncio.Task] = set()
+
+
+class Cancelled(Exception):
+    """The pipeline failed, a running stage which checks ``Pipeline.check`` stops"""
+
+
+class Stage:
+    def __init__(self, name: str, fn: Callable[..., Any], deps: List[str], detached: bool, always: bool = False):
+        self.name = name
+        self.fn = fn
+        self.deps = deps
+        self.detached = detached
+        self.always = always
+
+
+class Pipeline:
+    """A small dependency graph of stages, run concurrently wherever possible.
+
+    Each stage is called with the results of its dependencies as keyword
+    arguments. A detached stage runs in the background once its dependencies
+    are done, ``run`` does not wait for it and its failure is only logged.
+    An ``always`` stage also runs in the background when the pipeline fails,
+    with the results of its dependencies done, e.g. to delete temporary files,
+    once the stages still running have stopped. A long stage calls ``check``
+    to stop early. ``limits`` bounds the number of concurrent runs of a stage
+    across pipelines.
+    """
+
+    def __init__(self, name: str, progress: Optional[Progress] = None,
+                 limits: Optional[Dict[str, threading.Semaphore]] = None):
+        self.name = name
+        self.progress = progress or (lambda stage, status: None)
+        self.limits = limits or {}
+        self.stages: Dict[str, Stage] = {}
+        self.timings: Dict[str, float] = {}
+        # set on the first failure, with its error
+        self.failed = threading.Event()
+        self.error: Optional[BaseException] = None
+
+    def check(self) -> None:
+        """
+        :raise Cancelled: the pipeline failed, the running stage should stop
+        """
+        if self.failed.is_set():
+            raise Cancelled("{} failed".format(self.name))
+
+    def add(self, name: str, fn: Callable[..., Any], deps: List[str] = None, detached: bool = False,
+            always: bool = False) -> "Pipeline":
+        """
+        :param name: the name of the stage, used as keyword for the dependent stages
+        :param fn: the work of the stage
+        :param deps: the stages to wait for
+        :param detached: run in the background without holding the pipeline
+        :param always: run in the background if the pipeline fails before the stage started, called
+            without the results of the dependencies not done
+        :return: the pipeline
+        """
+        deps = deps or []
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError("Unknown dependency {} of stage {}".format(dep, name))
+            if self.stages[dep].detached:
+                raise ValueError("Stage {} cannot depend on detached stage {}".format(name, dep))
+        self.stages[name] = Stage(name, fn, deps, detached, always)
+        return self
+
+    def _failed_stages(self, pending: Dict[str, Stage], results: Dict[str, Any]) -> List[Tuple[Stage, Dict]]:
+        """
+        :param pending: the stages not started when the pipeline failed
+        :return: the ``always`` stages to run, with the results of their dependencies done
+        """
+        stages = []
+        for stage in pending.values():
+            if stage.always:
+                logger.info("{} running stage {} after the failure".format(self.name, stage.name))
+                # called with the results it got, the dependencies not done are left out
+                stages.append((Stage(stage.name, stage.fn, [dep for dep in stage.deps if dep in results],
+                                     detached=True), dict(results)))
+        return stages
+
+    def _after_failure(self, running: Dict[concurrent.futures.Future, Stage], pending: Dict[str, Stage],
+                       results: Dict[str, Any]) -> None:
+        """
+        Run the ``always`` stages once the stages running at the failure have stopped, with their results
+        if they succeeded, so that they see every temporary file written
+        """
+        concurrent.futures.wait(running)
+        for future, stage in running.items():
+            if not future.cancelled() and future.exception() is None:
+                results[stage.name] = future.result()
+        for failed, done_results in self._failed_stages(pending, results):
+            self._run_detached(failed, done_results)
+
+    def _run_stage(self, stage: Stage, results: Dict[str, Any]) -> Any:
+        limit = self.limits.get(stage.name)
+        with limit if limit is not None else nullcontext():
+            self.progress(stage.name, "running")
+            start = perf_counter()
+            try:
+                with tracing.span("stage {}".format(stage.name), pipeline=self.name):
+                    result = stage.fn(**{dep: results[dep] for dep in stage.deps})
+            except Exception as err:
+                metrics.STAGE_SECONDS.labels(stage=stage.name, status="error").observe(perf_counter() - start)
+                metrics.ERRORS.labels(stage=stage.name, error=type(err).__name__).inc()
+                raise
+            self.timings[stage.name] = perf_counter() - start
+            metrics.STAGE_SECONDS.labels(stage=stage.name, status="ok").observe(self.timings[stage.name])
+        logger.info("{} stage {} done in {:.3f}s".format(self.name, stage.name, self.timings[stage.name]))
+        self.progress(stage.name, "done")
+        return result
+
+    def _run_detached(self, stage: Stage, results: Dict[str, Any]) -> None:
+        try:
+            self._run_stage(stage, results)
+        except Exception as err:
+            logger.error("{} stage {} failed: {}".format(self.name, stage.name, err))
+            logger.debug(''.join(traceback.format_exception(type(err), value=err, tb=err.__traceback__)))
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Run the stages, the first failure cancels the stages not yet started and is raised without
+        waiting for the running ones, the ``always`` stages not started run in the background once those stopped
+        :return: the results of the attached stages by name
+        """
+        results: Dict[str, Any] = {}
+        pending = dict(self.stages)
+        running: Dict[concurrent.futures.Future, Stage] = {}
+        start = perf_counter()
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(self.stages), 1),
+                                                         thread_name_prefix=self.name)
+        while pending or running:
+            for stage in [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]:
+                del pending[stage.name]
+                if stage.detached:
+                    _background.submit(tracing.propagate(self._run_detached), stage, dict(results))
+                else:
+                    running[executor.submit(tracing.propagate(self._run_stage), stage, results)] = stage
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    logger.error("{} stage {} failed: {}".format(self.name, stage.name, error))
+                    self.error = error
+                    self.failed.set()
+                    # the running stages finish in their threads, or stop at their next check
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    _background.submit(tracing.propagate(self._after_failure), dict(running), pending,
+                                       dict(results))
+                    raise error
+                results[stage.name] = future.result()
+        executor.shutdown(wait=True)
+
+        logger.info("{} done in {:.3f}s".format(self.name, perf_counter() - start))
+        return results
+
+
+class AsyncPipeline(Pipeline):
+    """The pipeline of the asynchronous service: the stages are coroutine functions, run as tasks
+    of the event loop, and ``limits`` holds ``asyncio.Semaphore``. ``run`` is a coroutine."""
+
+    async def _run_stage(self, stage: Stage, results: Dict[str, Any]) -> Any:
+        limit = self.limits.get(stage.name)
+        async with limit if limit is not None else nullcontext():
+            self.progress(stage.name, "running")
+            start = perf_counter()
+            try:
+                with tracing.span("stage {}".format(stage.name), pipeline=self.name):
+                    result = await stage.fn(**{dep: results[dep] for dep in stage.deps})
+            except Exception as err:
+                metrics.STAGE_SECONDS.labels(stage=stage.name, status="error").observe(perf_counter() - start)
+                metrics.ERRORS.labels(stage=stage.name, error=type(err).__name__).inc()
+                raise
+            self.timings[stage.name] = perf_counter() - start
+            metrics.STAGE_SECONDS.labels(stage=stage.name, status="ok").observe(self.timings[stage.name])
+        logger.info("{} stage {} done in {:.3f}s".format(self.name, stage.name, self.timings[stage.name]))
+        self.progress(stage.name, "done")
+        return result
+
+    async def _run_detached(self, stage: Stage, results: Dict[str, Any]) -> None:
+        try:
+            await self._run_stage(stage, results)
+        except Exception as err:
+            logger.error("{} stage {} failed: {}".format(self.name, stage.name, err))
+            logger.debug(''.join(traceback.format_exception(type(err), value=err, tb=err.__traceback__)))
+
+    async def _after_failure(self, running: Dict[asyncio.Task, Stage], pending: Dict[str, Stage],
+                             results: Dict[str, Any]) -> None:
+        if running:
+            await asyncio.wait(running)
+        for task, stage in running.items():
+            if not task.cancelled() and task.exception() is None:
+                results[stage.name] = task.result()
+        for failed, done_results in self._failed_stages(pending, results):
+            await self._run_detached(failed, done_results)
+
+    def _spawn(self, coroutine: Awaitable[None]) -> None:
+        task = asyncio.create_task(coroutine)
+        # referenced until done, the event loop keeps weak references only
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    async def run(self) -> Dict[str, Any]:
+        """
+        Run the stages, the first failure cancels the running stages and is raised, the ``always``
+        stages not started run in the background once those stopped
+        :return: the results of the attached stages by name
+        """
+        results: Dict[str, Any] = {}
+        pending = dict(self.stages)
+        running: Dict[asyncio.Task, Stage] = {}
+        start = perf_counter()
+
+        while pending or running:
+            for stage in [stage for stage in pending.values() if all(dep in results for dep in stage.deps)]:
+                del pending[stage.name]
+                if stage.detached:
+                    self._spawn(self._run_detached(stage, dict(results)))
+                else:
+                    running[asyncio.create_task(self._run_stage(stage, results))] = stage
+
+            if not running:
+                break
+
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                stage = running.pop(task)
+                error = task.exception()
+                if error is not None:
+                    logger.error("{} stage {} failed: {}".format(self.name, stage.name, error))
+                    self.error = error
+                    self.failed.set()
+                    for other in running:
+                        other.cancel()
+                    self._spawn(self._after_failure(dict(running), pending, dict(results)))
+                    raise error
+                results[stage.name] = task.result()
+
+        logger.info("{} done in {:.3f}s".format(self.name, perf_counter() - start))
+        return results
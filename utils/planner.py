@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import math
+import os
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from utils.export import ExportConfig
+from utils.lazy import lazy_import
+from utils.logging import logger
+
+bigquery = lazy_import("google.cloud.bigquery")
+
+# Up to this size the table is extracted into a single file, BigQuery writes at most 1 GB per file
+TINY_BYTES = int(os.environ.get("EXPORT_TINY_BYTES", 256 << 20))
+# From this size the extract is split among parallel writers, one per this many bytes
+HUGE_BYTES = int(os.environ.get("EXPORT_HUGE_BYTES", 50 << 30))
+# https://cloud.google.com/bigquery/docs/exporting-data#exporting_data_into_one_or_more_files
+MAX_WRITERS = 20
+
+# "tiny": one file, no listing; "mid": one wildcard uri; "huge": a wildcard uri per writer
+STRATEGIES = ["tiny", "mid", "huge"]
+
+
+@dataclass
+class ExportPlan:
+    strategy: str
+    # the destination uris of the extract job
+    destination_uris: List[str]
+    num_bytes: Optional[int]
+    num_rows: Optional[int]
+    partitioned: bool
+
+    @property
+    def single_file(self) -> bool:
+        """The extract writes exactly the file of ``destination_uris``, it is not listed"""
+        return self.strategy == "tiny"
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, plan: Dict) -> "ExportPlan":
+        return cls(**plan)
+
+
+def plan_export(config: ExportConfig, table: bigquery.Table) -> ExportPlan:
+    """
+    Pick the cheapest strategy for the size of the extracted table
+    :param config: the export configuration
+    :param table: the extracted table, the result of the query if any
+    :return: the plan of the extract
+    """
+    num_bytes, num_rows = table.num_bytes, table.num_rows
+    partitioned = table.time_partitioning is not None or table.range_partitioning is not None
+    prefix = "gs://{}/{}".format(config.bucket, config.temp_file_prefix)
+    if num_bytes is None:
+        # unknown, as before the planner
+        strategy, uris = "mid", [config.temp_destination_uri]
+    elif num_bytes <= TINY_BYTES:
+        # named like the first file of a wildcard extract
+        strategy, uris = "tiny", ["{}{:012d}{}".format(prefix, 0, config.extension)]
+    elif num_bytes < HUGE_BYTES:
+        strategy, uris = "mid", [config.temp_destination_uri]
+    else:
+        writers = min(MAX_WRITERS, max(2, math.ceil(num_bytes / HUGE_BYTES)))
+        strategy, uris = "huge", ["{}{:03d}-*{}".format(prefix, writer, config.extension)
+                                  for writer in range(writers)]
+    plan = ExportPlan(strategy, uris, num_bytes, num_rows, partitioned)
+    logger.info("Export plan of {}.{}: {} table of {} bytes, {} destination uris".format(
+        config.dataset_id, config.table_id, strategy, num_bytes, len(uris)), plan=plan.to_dict())
+    return plan
@@ -0,0 +1,211 @@
+import asyncio
+import os
+import random
+import threading
+from collections import OrderedDict
+from time import monotonic, sleep
+from typing import Awaitable, Callable, Dict, Iterable, List, Tuple, TypeVar
+
+from google.api_core.exceptions import ServiceUnavailable, TooManyRequests
+
+from utils import metrics
+from utils.logging import logger
+
+# https://cloud.google.com/storage/quotas#objects: about one update per second of an object
+OBJECT_WRITES_PER_SECOND = float(os.environ.get("GCS_OBJECT_WRITES_PER_SECOND", 1))
+OBJECT_BURST = float(os.environ.get("GCS_OBJECT_BURST", 2))
+# https://cloud.google.com/storage/docs/request-rate: a bucket scales up its write rate as it is used,
+# 0 leaves it unpaced until it answers 503
+BUCKET_WRITES_PER_SECOND = float(os.environ.get("GCS_BUCKET_WRITES_PER_SECOND", 0))
+BUCKET_BURST = float(os.environ.get("GCS_BUCKET_BURST", 1000))
+RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 32.0
+# The buckets of the objects are forgotten once refilled, beyond this many
+MAX_TRACKED_OBJECTS = 10000
+
+T = TypeVar("T")
+
+
+class TokenBucket:
+    """``rate`` tokens per second, up to ``burst``, unlimited if ``rate`` is 0. A reservation may overdraw
+    the bucket, the caller then waits until the tokens it took are refilled, so the concurrent callers
+    queue in order."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._paused_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, tokens: float = 1) -> float:
+        """
+        :return: the seconds to wait before using the tokens
+        """
+        now = monotonic()
+        paused = max(0.0, self._paused_until - now)
+        if self.rate <= 0:
+            return paused
+        self._refill(now)
+        self._tokens -= tokens
+        return max(paused, -self._tokens / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """No token is available for ``seconds``"""
+        self._paused_until = max(self._paused_until, monotonic() + seconds)
+
+    def full(self) -> bool:
+        now = monotonic()
+        if self._paused_until > now:
+            return False
+        if self.rate <= 0:
+            return True
+        self._refill(now)
+        return self._tokens >= self.burst
+
+
+class MutationScheduler:
+    """Paces the mutations of GCS objects, shared by the threads of the worker.
+
+    A mutation takes a token of its bucket and of each object it writes. A 429 answer, for an
+    object updated too often, pauses the buckets of its objects; a 503 answer, for a bucket
+    scaling up, or another failure pauses the bucket. The pause grows exponentially with the
+    retries, with jitter, and is waited by the next mutations of every thread.
+    """
+
+    def __init__(self, object_rate: float = OBJECT_WRITES_PER_SECOND, object_burst: float = OBJECT_BURST,
+                 bucket_rate: float = BUCKET_WRITES_PER_SECOND, bucket_burst: float = BUCKET_BURST,
+                 retries: int = RETRIES):
+        self.object_rate = object_rate
+        self.object_burst = object_burst
+        self.bucket_rate = bucket_rate
+        self.bucket_burst = bucket_burst
+        self.retries = retries
+        self._lock = threading.Lock()
+        self._buckets: Dict[str, TokenBucket] = {}
+        # in the order of their last use
+        self._objects: "OrderedDict[Tuple[str, str], TokenBucket]" = OrderedDict()
+
+    def _bucket(self, bucket: str) -> TokenBucket:
+        if bucket not in self._buckets:
+            self._buckets[bucket] = TokenBucket(self.bucket_rate, self.bucket_burst)
+        return self._buckets[bucket]
+
+    def _object(self, bucket: str, name: str) -> TokenBucket:
+        key = (bucket, name)
+        if key in self._objects:
+            self._objects.move_to_end(key)
+            return self._objects[key]
+        # the least recently used first, a refilled bucket is the same as a new one
+        while len(self._objects) >= MAX_TRACKED_OBJECTS and next(iter(self._objects.values())).full():
+            self._objects.popitem(last=False)
+        tokens = self._objects[key] = TokenBucket(self.object_rate, self.object_burst)
+        return tokens
+
+    def _reserve(self, bucket: str, names: List[str]) -> float:
+        """
+        :return: the seconds to wait for the tokens of a mutation of the objects ``names`` of ``bucket``
+        """
+        with self._lock:
+            delay = self._bucket(bucket).reserve(len(names))
+            for name in names:
+                delay = max(delay, self._object(bucket, name).reserve())
+        if delay > 0:
+            metrics.RATE_LIMIT_SECONDS.inc(delay)
+        return delay
+
+    def wait(self, bucket: str, names: Iterable[str]) -> float:
+        """
+        Wait for the tokens of a mutation of the objects ``names`` of ``bucket``
+        :return: the seconds waited
+        """
+        delay = self._reserve(bucket, list(names))
+        if delay > 0:
+            sleep(delay)
+        return delay
+
+    async def await_tokens(self, bucket: str, names: Iterable[str]) -> float:
+        """
+        ``wait`` on the event loop
+        :return: the seconds waited
+        """
+        delay = self._reserve(bucket, list(names))
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
+
+    @staticmethod
+    def backoff(attempt: int) -> float:
+        """
+        :return: the jittered pause before the retry ``attempt``, from 1
+        """
+        ceiling = min(MAX_BACKOFF, BACKOFF * 2 ** (attempt - 1))
+        return random.uniform(ceiling / 2, ceiling)
+
+    def pause_after(self, bucket: str, names: Iterable[str], status: int, attempt: int) -> float:
+        """
+        Pause the mutations after a failed attempt, the next ``wait`` waits for the pause
+        :param status: the HTTP status of the answer, 429 pauses the objects, any other the bucket
+        :param attempt: the failed attempt, from 1
+        :return: the pause in seconds
+        """
+        pause = self.backoff(attempt)
+        with self._lock:
+            if status == 429:
+                for name in names:
+                    self._object(bucket, name).pause(pause)
+            else:
+                self._bucket(bucket).pause(pause)
+        metrics.MUTATION_RETRIES.labels(status=str(status)).inc()
+        return pause
+
+    def call(self, fn: Callable[[], T], bucket: str, names: Iterable[str], idempotent: bool = True) -> T:
+        """
+        Run a mutation when its tokens are available, retried when GCS throttles it
+        :param fn: the mutation
+        :param bucket: the bucket of the objects
+        :param names: the objects written or deleted by the mutation
+        :param idempotent: whether it may be run twice, a 503 may come after the mutation was applied.
+            A 429 is always retried, the mutation was refused.
+        :return: the result of ``fn``
+        """
+        names = list(names)
+        for attempt in range(1, self.retries + 2):
+            self.wait(bucket, names)
+            try:
+                return fn()
+            except (TooManyRequests, ServiceUnavailable) as err:
+                self._throttled(err, bucket, names, idempotent, attempt)
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], bucket: str, names: Iterable[str],
+                    idempotent: bool = True) -> T:
+        """
+        ``call`` on the event loop
+        :param fn: the coroutine function of the mutation
+        """
+        names = list(names)
+        for attempt in range(1, self.retries + 2):
+            await self.await_tokens(bucket, names)
+            try:
+                return await fn()
+            except (TooManyRequests, ServiceUnavailable) as err:
+                self._throttled(err, bucket, names, idempotent, attempt)
+
+    def _throttled(self, err: Exception, bucket: str, names: List[str], idempotent: bool, attempt: int) -> None:
+        """
+        Pause the mutations after a throttled attempt
+        :raise err: the mutation must not be retried
+        """
+        if attempt > self.retries or (isinstance(err, ServiceUnavailable) and not idempotent):
+            raise err
+        pause = self.pause_after(bucket, names, int(err.code), attempt)
+        logger.warning("GCS throttled a mutation of {}, retrying in {:.2f}s: {}".format(
+            names[0] if len(names) == 1 else "{} objects".format(len(names)), pause, err))
+
+
+scheduler = MutationScheduler()
@@ -0,0 +1,182 @@
+import importlib.machinery
+import os
+import sys
+import threading
+from time import perf_counter, time
+from typing import Dict, List, Optional, Tuple
+
+# only the standard library is imported before the profile starts
+from utils import lazy
+
+# Import groups reported by the startup profile, the others are summed up
+TOP_IMPORTS = 15
+# Created per module, unlike the shared builtin and frozen importers
+FILE_LOADERS = (importlib.machinery.SourceFileLoader, importlib.machinery.SourcelessFileLoader,
+                importlib.machinery.ExtensionFileLoader)
+
+
+def _group(name: str) -> str:
+    parts = name.split(".")
+    if parts[0] == "google" and len(parts) > 2 and parts[1] == "cloud":
+        return ".".join(parts[:3])
+    if parts[0] == "google" and len(parts) > 1:
+        return ".".join(parts[:2])
+    return parts[0]
+
+
+def process_uptime() -> Optional[float]:
+    """
+    :return: seconds since the process was started, forked for a gunicorn worker, None off Linux
+    """
+    try:
+        with open("/proc/self/stat") as file:
+            # the name in parentheses may contain spaces
+            start_ticks = int(file.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as file:
+            uptime = float(file.read().split()[0])
+        return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class ImportTimer:
+    """Finder of ``sys.meta_path`` timing the modules imported while it is installed, the time of a
+    module excludes the modules it imports. The loaders found by the other finders are kept."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+        self._stack: List[List[float]] = []
+        self._lock = threading.Lock()
+
+    def install(self) -> None:
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+    def uninstall(self) -> None:
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                if isinstance(spec.loader, FILE_LOADERS):
+                    spec.loader.exec_module = self._timed(name, spec.loader.exec_module)
+                return spec
+        return None
+
+    def _timed(self, name: str, exec_module):
+        def timed(module) -> None:
+            # the imports of other threads are not nested in the current one
+            if threading.current_thread() is not threading.main_thread():
+                return exec_module(module)
+            frame = [perf_counter(), 0.0]
+            self._stack.append(frame)
+            try:
+                exec_module(module)
+            finally:
+                self._stack.pop()
+                total = perf_counter() - frame[0]
+                if self._stack:
+                    self._stack[-1][1] += total
+                with self._lock:
+                    group = _group(name)
+                    self.seconds[group] = self.seconds.get(group, 0.0) + total - frame[1]
+        return timed
+
+    def top(self, count: int = TOP_IMPORTS) -> List[Tuple[str, float]]:
+        ranked = sorted(self.seconds.items(), key=lambda item: item[1], reverse=True)
+        top = ranked[:count]
+        if len(ranked) > count:
+            top.append(("other", sum(seconds for _, seconds in ranked[count:])))
+        return top
+
+
+class StartupProfile:
+    """Timings of the boot of a worker, logged once it is warm, and of its first response.
+
+    ``start`` is called by the ``post_fork`` hook of gunicorn, before the app is imported.
+    """
+
+    def __init__(self):
+        self.imports = ImportTimer()
+        self.phases: Dict[str, float] = {}
+        self.lazy_imports: Dict[str, float] = {}
+        self.started: Optional[float] = None
+        self.forked_at: Optional[float] = None
+        self._first_response = threading.Event()
+        self._phase_start: Dict[str, float] = {}
+        lazy.observe(self._lazy_import)
+
+    def _lazy_import(self, name: str, seconds: float) -> None:
+        self.lazy_imports[name] = seconds
+
+    @property
+    def active(self) -> bool:
+        return self.started is not None
+
+    def start(self) -> None:
+        self.started = perf_counter()
+        uptime = process_uptime()
+        self.forked_at = time() - uptime if uptime is not None else time()
+        self.imports.install()
+
+    def begin(self, phase: str) -> None:
+        self._phase_start[phase] = perf_counter()
+
+    def end(self, phase: str) -> None:
+        if phase in self._phase_start:
+            self.phases[phase] = perf_counter() - self._phase_start.pop(phase)
+
+    def elapsed(self) -> float:
+        """
+        :return: seconds since the worker process started
+        """
+        return time() - self.forked_at
+
+    def report(self) -> Dict:
+        return {
+            "seconds_since_start": round(self.elapsed(), 3),
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+            "imports": {group: round(seconds, 3) for group, seconds in self.imports.top()},
+            "lazy_imports": {name: round(seconds, 3) for name, seconds in self.lazy_imports.items()},
+        }
+
+    def ready(self) -> None:
+        """The worker is warm: stop timing the imports and log the profile"""
+        from utils.logging import logger
+
+        self.imports.uninstall()
+        logger.info("Startup profile", startup=self.report())
+
+    def first_response(self) -> None:
+        """Log the time to the first response of the worker, once"""
+        if not self.active or self._first_response.is_set():
+            return
+        from utils.logging import logger
+
+        self._first_response.set()
+        logger.info("First response {:.3f}s after the start of the worker".format(self.elapsed()),
+                    time_to_first_response=round(self.elapsed(), 3))
+
+
+profile = StartupProfile()
+
+
+def warm_up() -> None:
+    """Import the client libraries deferred by ``utils.lazy`` and warm the shared clients, in a background
+    thread of the worker so it answers its first request meanwhile"""
+    from utils.clients import registry
+    from utils.logging import logger
+
+    profile.begin("warm_up")
+    try:
+        lazy.load_all()
+    except ImportError as e:
+        logger.warning("Failed to import the client libraries: {}".format(e))
+    registry.warm_up()
+    profile.end("warm_up")
+    if profile.active:
+        profile.ready()
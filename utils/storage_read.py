@@ -0,0 +1,252 @@
+from __future__ import annotations
+
+import base64
+import concurrent.futures
+import csv
+import gzip
+import io
+import json
+import os
+import queue
+import threading
+from datetime import date, datetime, time, timezone
+from decimal import Decimal
+from typing import Any, Dict, Iterable, List
+
+from utils.bigquery import bq_header
+from utils.export import ExportConfig
+from utils import tracing
+from utils.lazy import lazy_import
+from utils.logging import logger
+from utils.pipeline import Pipeline, Progress
+
+bigquery = lazy_import("google.cloud.bigquery")
+storage = lazy_import("google.cloud.storage")
+# the storage_read engine is optional
+bigquery_storage = lazy_import("google.cloud.bigquery_storage", optional=True)
+
+# Streams read in parallel, the service may return fewer for small tables
+READ_STREAMS = int(os.environ.get("STORAGE_READ_STREAMS", 8))
+# Encoded pages waiting to be uploaded, bounds the memory used by an export
+QUEUE_SIZE = int(os.environ.get("STORAGE_READ_QUEUE_SIZE", 16))
+# Size of the resumable upload requests, a multiple of 256 KiB
+UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+
+_END = object()
+
+
+def get_read_client(**kwargs) -> "bigquery_storage.BigQueryReadClient":
+    """
+    :param kwargs: forwarded to BigQueryReadClient (credentials, client_options)
+    :return: BigQuery Storage Read API Client
+    """
+    if bigquery_storage is None:
+        raise ImportError("the storage_read engine requires google-cloud-bigquery-storage")
+    try:
+        return bigquery_storage.BigQueryReadClient(**kwargs)
+    except Exception as e:
+        logger.error("Error creating client: \n\t{}".format(e))
+        raise
+
+
+def _field(row: Dict, name: str) -> Any:
+    # a selected field of a record column is nested in the row
+    for part in name.split("."):
+        if row is None:
+            return None
+        row = row.get(part)
+    return row
+
+
+def _timestamp(value: datetime) -> str:
+    """Render a TIMESTAMP like BigQuery does, e.g. 2022-01-01 12:00:00.5 UTC"""
+    value = value.astimezone(timezone.utc)
+    text = value.strftime("%Y-%m-%d %H:%M:%S")
+    if value.microsecond:
+        text += ".{:06d}".format(value.microsecond).rstrip("0")
+    return text + " UTC"
+
+
+def _scalar(value: Any) -> Any:
+    """Render the values the Avro rows decode to python objects like a BigQuery extract does, in both formats"""
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    if isinstance(value, datetime):
+        # a TIMESTAMP is aware, a DATETIME is naive
+        return _timestamp(value) if value.tzinfo is not None else value.isoformat()
+    if isinstance(value, (date, time)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        # NUMERIC and BIGNUMERIC without the trailing zeros of their scale
+        return format(value.normalize(), "f")
+    return value
+
+
+def _json_value(value: Any) -> Any:
+    """Render the values like a BigQuery NEWLINE_DELIMITED_JSON extract does, INT64 as strings"""
+    if isinstance(value, dict):
+        return {key: _json_value(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_json_value(item) for item in value]
+    if isinstance(value, int) and not isinstance(value, bool):
+        return str(value)
+    return _scalar(value)
+
+
+def _csv_value(value: Any) -> Any:
+    """Render the values like a BigQuery CSV extract does"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (dict, list)):
+        return json.dumps(_json_value(value), separators=(",", ":"))
+    return _scalar(value)
+
+
+def encode_csv(rows: Iterable[Dict], fields: List[str]) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    for row in rows:
+        writer.writerow([_csv_value(_field(row, name)) for name in fields])
+    return buffer.getvalue().encode("utf-8")
+
+
+def encode_ndjson(rows: Iterable[Dict], fields: List[str] = None) -> bytes:
+    return "".join(json.dumps(_json_value(row), separators=(",", ":")) + "\n" for row in rows).encode("utf-8")
+
+
+class _Unclosed(io.RawIOBase):
+    """Writes through to ``stream`` and leaves it open, like GzipFile does"""
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data: bytes) -> int:
+        return self.stream.write(data)
+
+
+def run_storage_read_export(config: ExportConfig, storage_client: storage.Client, bigquery_client: bigquery.Client,
+                            progress: Progress = None, limits: Dict[str, threading.Semaphore] = None,
+                            metadata: Dict[str, str] = None, read_client=None) -> Dict:
+    """
+    Read the table through the Storage Read API with parallel streams and upload the encoded rows
+    straight to the final file, without extract job, temporary shards, compose nor delete.
+
+    The readers hand encoded pages to a single writer through a bounded queue, so
+    the memory used does not depend on the size of the table.
+    :param config: the export configuration
+    :param storage_client: Google Cloud Storage Client
+    :param bigquery_client: BigQuery Client
+    :param progress: callback notified when a stage starts and ends
+    :param limits: semaphores bounding the concurrent runs of a stage, shared by the exports of a batch
+    :param metadata: custom metadata set on the final file
+    :param read_client: BigQuery Storage Read API Client, the one of the worker by default
+    :return: the result of the export
+    """
+    if read_client is None:
+        from utils.clients import registry
+
+        read_client = registry.bigquery_read_client()
+
+    export_format = config.export_format
+    encode = encode_csv if export_format.header else encode_ndjson
+    stats = {}
+
+    def header() -> List[str]:
+        if config.columns:
+            return list(config.columns)
+        return bq_header(config.project, config.dataset_id, config.table_id, bigquery_client)
+
+    def session():
+        read_options = {}
+        if config.columns:
+            read_options["selected_fields"] = config.columns
+        if config.filter:
+            read_options["row_restriction"] = config.filter
+        read_session = {
+            "table": "projects/{}/datasets/{}/tables/{}".format(config.project, config.dataset_id, config.table_id),
+            "data_format": "AVRO",
+            "read_options": read_options,
+        }
+        read_session = read_client.create_read_session(parent="projects/{}".format(config.project),
+                                                       read_session=read_session, max_stream_count=READ_STREAMS)
+        logger.info("Read session {} with {} streams".format(read_session.name, len(read_session.streams)))
+        return read_session
+
+    def read(session, header: List[str] = None) -> None:
+        pages = queue.Queue(maxsize=QUEUE_SIZE)
+        # set when a stream fails, the other streams stop reading
+        failed = threading.Event()
+        # set when the writer is gone, nothing reads the queue anymore
+        abandoned = threading.Event()
+        rows = [0] * len(session.streams)
+
+        def put(item) -> None:
+            while not abandoned.is_set():
+                try:
+                    pages.put(item, timeout=.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def read_stream(index: int, stream) -> None:
+            try:
+                with tracing.span("read stream", stream=stream.name) as span:
+                    for page in read_client.read_rows(stream.name).rows(session).pages:
+                        if failed.is_set() or abandoned.is_set():
+                            # another stream or the upload failed, the rows would be dropped
+                            return
+                        page = list(page)
+                        rows[index] += len(page)
+                        put(encode(page, header))
+                    span.set_attribute("rows", rows[index])
+            except Exception:
+                failed.set()
+                raise
+            finally:
+                put(_END)
+
+        blob = storage.Blob.from_string(config.file_uri, client=storage_client)
+        blob.metadata = metadata
+        blob.content_encoding = export_format.content_encoding(config.compression)
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(len(session.streams), 1),
+                                                         thread_name_prefix="storage-read")
+        try:
+            # a failure terminates the resumable upload, the final file is never partially written
+            with blob.open("wb", chunk_size=UPLOAD_CHUNK_SIZE, content_type=export_format.content_type) as upload:
+                with (gzip.GzipFile(fileobj=upload, mode="wb") if config.compression == "gzip"
+                      else _Unclosed(upload)) as output:
+                    if header:
+                        output.write(f"{','.join(header)} \n".encode("utf-8"))
+                    futures = [executor.submit(tracing.propagate(read_stream), i, stream) for i, stream in enumerate(session.streams)]
+                    finished = 0
+                    while finished < len(futures):
+                        page = pages.get()
+                        if page is _END:
+                            finished += 1
+                        else:
+                            output.write(page)
+                    for future in futures:
+                        future.result()
+        finally:
+            abandoned.set()
+            executor.shutdown(wait=True)
+        stats.update(rows=sum(rows), streams=len(session.streams))
+
+    pipeline = Pipeline("storage read export {}.{}".format(config.dataset_id, config.table_id), progress, limits)
+    pipeline.add("session", session)
+    read_deps = ["session"]
+    if export_format.header:
+        pipeline.add("header", header)
+        read_deps.append("header")
+    pipeline.add("read", read, deps=read_deps)
+    pipeline.run()
+
+    logger.info("final result : {}, {} rows".format(config.file_uri, stats["rows"]))
+    return {"path": config.file_uri, "format": export_format.name, "timings": pipeline.timings,
+            "engine": config.engine, "rows": stats["rows"]}
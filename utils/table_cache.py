@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import threading
+from collections import OrderedDict
+from time import monotonic
+from typing import Optional, Tuple
+
+from utils import metrics
+from utils.lazy import lazy_import
+from utils.logging import logger
+
+bigquery = lazy_import("google.cloud.bigquery")
+
+# Tables kept in the cache, the least recently used ones are evicted beyond, a table with its schema
+# weighs a few KB up to a few hundred KB for the widest ones
+TABLE_CACHE_SIZE = int(os.environ.get("TABLE_CACHE_SIZE", 512))
+# Seconds a cached table is used without asking BigQuery whether it changed
+TABLE_CACHE_TTL = float(os.environ.get("TABLE_CACHE_TTL", 60))
+
+
+class TableCache:
+    """The metadata of the BigQuery tables (schema, etag, last modified time, size), shared by the
+    exports of the process.
+
+    A table cached for less than ``max_age`` seconds is used as is. An older one is revalidated by
+    its etag: the table is read again, a few KB, and the cached one is kept when the etag did not
+    change, so that the readers holding it see the same object. A reader
+    which must see the current table, as the result cache of ``export_once``, passes ``max_age=0``,
+    the later readers of the same export then get the table it revalidated. The cached tables are
+    shared between the threads and must not be modified.
+    """
+
+    def __init__(self, max_tables: int = TABLE_CACHE_SIZE, ttl: float = TABLE_CACHE_TTL):
+        self.max_tables = max_tables
+        self.ttl = ttl
+        # the time the table was fetched or revalidated, and the table, by full table id
+        self._tables: OrderedDict[str, Tuple[float, bigquery.Table]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: str, max_age: Optional[float]) -> Tuple[Optional[bigquery.Table], bool]:
+        """
+        :return: the cached table if any, and whether it is fresh enough to be used without revalidation
+        """
+        with self._lock:
+            entry = self._tables.get(key)
+            if entry is None:
+                return None, False
+            self._tables.move_to_end(key)
+            validated, table = entry
+            return table, monotonic() - validated < (self.ttl if max_age is None else max_age)
+
+    def _revalidate(self, key: str, cached: Optional[bigquery.Table], table: bigquery.Table) -> bigquery.Table:
+        """
+        :param cached: the cached table if any
+        :param table: the table just read
+        :return: the cached table if it did not change, the table just read otherwise
+        """
+        if cached is not None and cached.etag and cached.etag == table.etag:
+            return self._store(key, cached, "revalidated")
+        return self._store(key, table, "miss")
+
+    def _store(self, key: str, table: bigquery.Table, result: str) -> bigquery.Table:
+        metrics.TABLE_CACHE_LOOKUPS.labels(result=result).inc()
+        with self._lock:
+            self._tables[key] = (monotonic(), table)
+            self._tables.move_to_end(key)
+            while len(self._tables) > self.max_tables:
+                evicted, _ = self._tables.popitem(last=False)
+                metrics.TABLE_CACHE_EVICTIONS.inc()
+                logger.debug("Evicted table {} from the cache".format(evicted))
+        return table
+
+    def get(self, bq_client: bigquery.Client, project: str, dataset_id: str, table_id: str,
+            max_age: float = None) -> bigquery.Table:
+        """
+        :param bq_client: BigQuery Client
+        :param max_age: seconds a cached table is used without revalidation, ``ttl`` by default
+        :return: the table, with its schema and statistics
+        """
+        key = "{}.{}.{}".format(project, dataset_id, table_id)
+        table, fresh = self._lookup(key, max_age)
+        if fresh:
+            metrics.TABLE_CACHE_LOOKUPS.labels(result="hit").inc()
+            return table
+        table_ref = bigquery.DatasetReference(project, dataset_id).table(table_id)
+        return self._revalidate(key, table, bq_client.get_table(table_ref))
+
+    async def aget(self, client, project: str, dataset_id: str, table_id: str,
+                   max_age: float = None) -> bigquery.Table:
+        """
+        ``get`` on the event loop
+        :param client: the ``utils.aio.AsyncClient`` of the process
+        """
+        key = "{}.{}.{}".format(project, dataset_id, table_id)
+        table, fresh = self._lookup(key, max_age)
+        if fresh:
+            metrics.TABLE_CACHE_LOOKUPS.labels(result="hit").inc()
+            return table
+        resource = await client.get_table(project, dataset_id, table_id)
+        return self._revalidate(key, table, bigquery.Table.from_api_repr(resource))
+
+    def peek(self, project: str, dataset_id: str, table_id: str) -> Optional[bigquery.Table]:
+        """
+        :return: the cached table whatever its age, None if it is not cached, BigQuery is not called
+        """
+        table, _ = self._lookup("{}.{}.{}".format(project, dataset_id, table_id), None)
+        return table
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+
+
+table_cache = TableCache()
@@ -0,0 +1,261 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import re
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterator, List, Optional
+
+from utils import metadata
+from utils.logging import logger
+
+# Share of the requests without X-Cloud-Trace-Context which are traced
+SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", 0))
+# "cloud" sends the spans to Cloud Trace, "file:<path>" appends them as json lines, empty disables tracing
+EXPORTER = os.environ.get("TRACE_EXPORTER", "")
+EXPORT_BATCH_SIZE = 100
+EXPORT_INTERVAL = 5.0
+
+# X-Cloud-Trace-Context: TRACE_ID/SPAN_ID;o=TRACE_TRUE
+TRACE_HEADER = re.compile(r"^(?P<trace_id>[0-9a-fA-F]{32})(/(?P<span_id>\d+))?(;o=(?P<sampled>[01]))?")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+class Span:
+    """A timed operation of a trace, ended and exported when its block exits"""
+
+    sampled = True
+
+    def __init__(self, name: str, trace_id: str, parent_span_id: Optional[str] = None, attributes: Dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "{:016x}".format(random.getrandbits(64) or 1)
+        self.parent_span_id = parent_span_id
+        self.attributes = dict(attributes or {})
+        self.start_time = _now()
+        self.end_time: Optional[str] = None
+        self.status = "ok"
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def end(self) -> None:
+        self.end_time = _now()
+        if _exporter is not None:
+            _exporter.export(self)
+
+    def to_dict(self) -> Dict:
+        return {"name": self.name, "trace_id": self.trace_id, "span_id": self.span_id,
+                "parent_span_id": self.parent_span_id, "start_time": self.start_time, "end_time": self.end_time,
+                "status": self.status, "attributes": self.attributes}
+
+
+class NoopSpan:
+    """Stands for every span of a trace which is not sampled, nothing is recorded"""
+
+    sampled = False
+    trace_id = span_id = None
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+_current: contextvars.ContextVar = contextvars.ContextVar("span", default=NOOP_SPAN)
+
+
+class InMemoryExporter:
+    """Keeps the ended spans, for the tests"""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def flush(self) -> None:
+        pass
+
+
+class FileExporter:
+    """Appends the ended spans to a file, one json object per line"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str) + "\n"
+        with self._lock, open(self.path, "a") as file:
+            file.write(line)
+
+    def flush(self) -> None:
+        pass
+
+
+class CloudTraceExporter:
+    """Sends the spans to the Cloud Trace v2 API in batches, from a background thread"""
+
+    def __init__(self, project: Callable[[], str], session: Callable):
+        """
+        :param project: resolves the project the traces belong to
+        :param session: returns an authorized HTTP session
+        """
+        self.project = project
+        self.session = session
+        self._spans: queue.Queue = queue.Queue(maxsize=10000)
+        self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        try:
+            self._spans.put_nowait(span)
+        except queue.Full:
+            logger.warning("Dropping span {}, the trace exporter is behind".format(span.name))
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._spans.get()]
+            try:
+                while len(batch) < EXPORT_BATCH_SIZE:
+                    batch.append(self._spans.get(timeout=EXPORT_INTERVAL))
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, spans: List[Span]) -> None:
+        project = self.project()
+        body = {"spans": [{
+            "name": "projects/{}/traces/{}/spans/{}".format(project, span.trace_id, span.span_id),
+            "spanId": span.span_id,
+            "parentSpanId": span.parent_span_id or "",
+            "displayName": {"value": span.name},
+            "startTime": span.start_time,
+            "endTime": span.end_time,
+            "attributes": {"attributeMap": {key: {"stringValue": {"value": str(value)}}
+                                            for key, value in span.attributes.items()}},
+            "status": {"code": 0 if span.status == "ok" else 2},
+        } for span in spans]}
+        try:
+            response = self.session().post(
+                "https://cloudtrace.googleapis.com/v2/projects/{}/traces:batchWrite".format(project), json=body,
+                timeout=10)
+            response.raise_for_status()
+        except Exception as e:
+            logger.warning("Failed to export {} spans: {}".format(len(spans), e))
+
+    def flush(self, timeout: float = 5.0) -> None:
+        batch = []
+        while not self._spans.empty() and len(batch) < EXPORT_BATCH_SIZE * 10:
+            batch.append(self._spans.get_nowait())
+        if batch:
+            self._write(batch)
+
+
+def _session():
+    from utils.clients import registry
+
+    return registry.session()
+
+
+def _default_exporter():
+    if EXPORTER == "cloud":
+        return CloudTraceExporter(metadata.project_id.get, _session)
+    if EXPORTER.startswith("file:"):
+        return FileExporter(EXPORTER[len("file:"):])
+    return None
+
+
+_exporter = _default_exporter()
+
+
+def set_exporter(exporter) -> None:
+    """
+    :param exporter: receives the ended spans, None disables tracing
+    """
+    global _exporter
+    _exporter = exporter
+
+
+def flush() -> None:
+    if _exporter is not None:
+        _exporter.flush()
+
+
+def current_span():
+    return _current.get()
+
+
+def start_trace(name: str, header: Optional[str] = None, **attributes):
+    """
+    Open the root span of a request, parented to the span of the X-Cloud-Trace-Context header.
+    The request is traced if the header says so, or for a share of the requests without it.
+    :param name: the name of the span
+    :param header: the value of the X-Cloud-Trace-Context header
+    :return: the span, to be ended with ``end_trace``, and the token restoring the context
+    """
+    match = TRACE_HEADER.match(header or "")
+    if match:
+        sampled = match.group("sampled") == "1"
+        trace_id = match.group("trace_id").lower()
+        parent = "{:016x}".format(int(match.group("span_id"))) if match.group("span_id") else None
+    else:
+        sampled = random.random() < SAMPLE_RATE
+        trace_id, parent = "{:032x}".format(random.getrandbits(128)), None
+    if not sampled or _exporter is None:
+        return NOOP_SPAN, _current.set(NOOP_SPAN)
+    span = Span(name, trace_id, parent, attributes)
+    return span, _current.set(span)
+
+
+def end_trace(span, token) -> None:
+    span.end()
+    _current.reset(token)
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator:
+    """
+    Time the block as a child of the current span, a no-op unless the trace is sampled
+    :param name: the name of the span
+    :param attributes: the attributes of the span
+    """
+    parent = _current.get()
+    if not parent.sampled:
+        yield NOOP_SPAN
+        return
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as err:
+        child.status = "error"
+        child.set_attribute("error", type(err).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        child.end()
+
+
+def propagate(fn: Callable) -> Callable:
+    """
+    :param fn: the function run by another thread
+    :return: the function run in a copy of the context of the caller, so its spans keep their parent
+    """
+    if not _current.get().sampled:
+        return fn
+    context = contextvars.copy_context()
+    # a context cannot be entered by two threads at once
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)